@@ -0,0 +1,83 @@
+"""float16で保存したスペクトログラムで、音楽構造の解析結果が変わらないことを確認する。
+
+float32のスペクトログラムと、それをfloat16にしたものでそれぞれ解析し、
+ビート・ダウンビート・拍位置・セクションを比較する。ファイルサイズと値の誤差も表示する。
+
+実行方法(allin1-webapiディレクトリで):
+    python benchmarks/spectrogram_precision.py {spectrograms.npy} [cuda|cpu]
+
+spectrograms.npyはfloat32で抽出したもの(allin1.spectrogram.extract_spectrogramsの出力等)を指定する。
+複数の楽曲で一致を確認できたら、allin1-webapiとdemucs-webapiの環境変数SPECTROGRAM_DTYPEをfloat16にする。
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from allin1.models.loaders import load_pretrained_model
+from structure_process import run_inference
+
+# 結果が一致しているとみなす時間の差(秒)。スペクトログラムの1フレーム分
+TIME_TOLERANCE = 0.01
+
+def analyze(spec_path: Path, model, device: str):
+    with torch.no_grad():
+        return run_inference(path=spec_path, spec_path=spec_path, model=model, device=device)
+
+def max_time_diff(a: list[float], b: list[float]) -> float:
+    if len(a) != len(b):
+        return float('inf')
+    if not a:
+        return 0.0
+    return float(np.max(np.abs(np.array(a) - np.array(b))))
+
+def compare(result32, result16) -> list[str]:
+    """解析結果の差異を返す。一致している場合は空のリスト。"""
+    mismatches = []
+    for name in ['beats', 'downbeats']:
+        diff = max_time_diff(getattr(result32, name), getattr(result16, name))
+        if diff > TIME_TOLERANCE:
+            mismatches.append(f'{name}: float32 {len(getattr(result32, name))}個, float16 {len(getattr(result16, name))}個, 最大差 {diff:.3f}s')
+    if result32.beat_positions != result16.beat_positions:
+        mismatches.append('beat_positions: 拍位置が異なる')
+    labels32 = [segment.label for segment in result32.segments]
+    labels16 = [segment.label for segment in result16.segments]
+    if labels32 != labels16:
+        mismatches.append(f'segments: ラベルが異なる {labels32} / {labels16}')
+    else:
+        bounds32 = [t for segment in result32.segments for t in (segment.start, segment.end)]
+        bounds16 = [t for segment in result16.segments for t in (segment.start, segment.end)]
+        diff = max_time_diff(bounds32, bounds16)
+        if diff > TIME_TOLERANCE:
+            mismatches.append(f'segments: 境界の最大差 {diff:.3f}s')
+    if result32.bpm != result16.bpm:
+        mismatches.append(f'bpm: {result32.bpm} / {result16.bpm}')
+    return mismatches
+
+if __name__ == '__main__':
+    spec32_path = Path(sys.argv[1])
+    device = sys.argv[2] if len(sys.argv) > 2 else ('cuda' if torch.cuda.is_available() else 'cpu')
+
+    spec32 = np.load(spec32_path).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spec32_copy_path = Path(tmp_dir) / 'spectrograms_f32.npy'
+        spec16_path = Path(tmp_dir) / 'spectrograms_f16.npy'
+        np.save(spec32_copy_path, spec32)
+        np.save(spec16_path, spec32.astype(np.float16))
+        print(f'ファイルサイズ float32:{os.path.getsize(spec32_copy_path) / 2**20:.2f}MiB, float16:{os.path.getsize(spec16_path) / 2**20:.2f}MiB')
+        print(f'値の最大誤差:{np.max(np.abs(spec32 - spec32.astype(np.float16).astype(np.float32))):.6f}')
+
+        model = load_pretrained_model(device=device)
+        result32 = analyze(spec32_copy_path, model, device)
+        result16 = analyze(spec16_path, model, device)
+
+    mismatches = compare(result32, result16)
+    if mismatches:
+        print('解析結果が一致しません')
+        for mismatch in mismatches:
+            print(f'  {mismatch}')
+        sys.exit(1)
+    print(f'解析結果は一致しています(ビート{len(result32.beats)}個, セクション{len(result32.segments)}個)')
@@ -0,0 +1,267 @@
+"""常駐推論ワーカーを扱うモジュール。
+
+torch/allin1のインポートとモデルのロードを子プロセスで一度だけ行い、
+以降の解析ジョブはパイプ経由で受け取って実行する。
+リクエスト毎にサブプロセスを起動していた際のコールドスタートを省くことが目的。
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from contextlib import asynccontextmanager
+from multiprocessing.connection import Connection
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class WorkerTerminatedError(Exception):
+    pass
+
+class WorkerJobError(Exception):
+    pass
+
+class WorkerPoolStartupError(Exception):
+    pass
+
+class WorkerPoolUnavailableError(Exception):
+    pass
+
+class WorkerAcquireCancelledError(Exception):
+    pass
+
+# ワーカーの起動に失敗した場合に再試行するまでの秒数(失敗する度に倍にする)
+SPAWN_RETRY_INITIAL_SECONDS = 1.0
+SPAWN_RETRY_MAX_SECONDS = 60.0
+
+def _worker_main(conn: Connection, device: str):
+    """子プロセスのエントリポイント。モデルをロードした後、ジョブを待ち受ける。
+
+    Args:
+        conn (Connection): 親プロセスとのパイプ。
+        device (str): 推論に使うデバイス。
+    """
+    # spectrograms_process等は src ディレクトリを起点にインポートされる前提
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import_start = time.perf_counter()
+    import torch
+    from allin1.models.loaders import load_pretrained_model
+    from spectrograms_process import ext_spectrograms
+    from structure_process import analyze_structure
+    import_seconds = time.perf_counter() - import_start
+
+    load_start = time.perf_counter()
+    model = load_pretrained_model(device=device)
+    model_load_seconds = time.perf_counter() - load_start
+
+    conn.send(('ready', {'import_seconds': import_seconds, 'model_load_seconds': model_load_seconds}))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        job_type, args = message
+        try:
+            if job_type == 'spectrograms':
+                ext_spectrograms(*args)
+            elif job_type == 'structure':
+                analyze_structure(*args, device=device, model=model)
+            else:
+                raise ValueError(f'未対応のジョブ種別:{job_type}')
+            conn.send(('done', None))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        finally:
+            if device == 'cuda':
+                torch.cuda.empty_cache()
+
+class InferenceWorker:
+    """モデルをロード済みの子プロセス1つを表す。"""
+
+    def __init__(self, ctx: multiprocessing.context.BaseContext, device: str):
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, device))
+        self.process.start()
+        child_conn.close()
+        self.terminated = False
+        self.import_seconds: Optional[float] = None
+        self.model_load_seconds: Optional[float] = None
+
+    async def wait_ready(self):
+        """子プロセスのモデルロード完了を待つ。"""
+        try:
+            status, value = await asyncio.to_thread(self._conn.recv)
+        except (EOFError, OSError):
+            raise WorkerTerminatedError()
+        self.import_seconds = value['import_seconds']
+        self.model_load_seconds = value['model_load_seconds']
+
+    def cold_start_seconds(self, job_type: str) -> float:
+        """サブプロセス方式の場合に、このジョブで追加で掛かっていた起動時間を返す。
+
+        スペクトログラム抽出はモデルを使わないため、インポート時間のみを対象とする。
+        """
+        if job_type == 'structure':
+            return self.import_seconds + self.model_load_seconds
+        return self.import_seconds
+
+    def is_alive(self) -> bool:
+        return not self.terminated and self.process.is_alive()
+
+    def terminate(self):
+        self.terminated = True
+        self.process.terminate()
+
+    async def run(self, job_type: str, args: tuple):
+        """ジョブを子プロセスに渡し、完了を待つ。
+
+        Raises:
+            WorkerTerminatedError: 実行中に子プロセスが終了させられた。
+            WorkerJobError: ジョブ内で例外が発生した。
+        """
+        try:
+            self._conn.send((job_type, args))
+            status, value = await asyncio.to_thread(self._conn.recv)
+        except (EOFError, OSError, BrokenPipeError):
+            raise WorkerTerminatedError()
+        if status == 'error':
+            raise WorkerJobError(value)
+
+    def discard(self):
+        """終了済みのワーカーのパイプを閉じる。"""
+        self._conn.close()
+
+    async def close(self):
+        try:
+            self._conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        await asyncio.to_thread(self.process.join, 10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+
+class InferenceWorkerPool:
+    """常駐推論ワーカーのプール。
+
+    ジョブの実行中にワーカーが終了させられた場合(クライアント切断によるキャンセル等)や、
+    起動に失敗した場合は、新しいワーカーをバックグラウンドで起動してプールに補充する。
+    補充に失敗した場合は間隔を空けながら成功するまで再試行する。
+    """
+
+    def __init__(self, size: int, device: str):
+        # CUDAを子プロセスで扱うためspawnで起動する
+        self._ctx = multiprocessing.get_context('spawn')
+        self._size = size
+        self._device = device
+        self._idle_workers: asyncio.Queue[InferenceWorker] = asyncio.Queue()
+        # 起動が完了したワーカーと、起動中のワーカー
+        self._workers: set[InferenceWorker] = set()
+        self._starting_workers: set[InferenceWorker] = set()
+        self._spawn_tasks: set[asyncio.Task] = set()
+        # 連続して起動に失敗した回数
+        self._spawn_failures = 0
+
+    async def start(self):
+        """ワーカーを起動する。
+
+        Raises:
+            WorkerPoolStartupError: 1つもワーカーを起動できなかった。
+        """
+        results = await asyncio.gather(*(self._spawn() for _ in range(self._size)))
+        if not any(results):
+            raise WorkerPoolStartupError('推論ワーカーを1つも起動できませんでした')
+        for _ in range(results.count(False)):
+            self._respawn_in_background()
+
+    async def _spawn(self) -> bool:
+        """ワーカーを1つ起動し、プールに加える。起動に失敗した場合はFalseを返す。"""
+        worker = InferenceWorker(self._ctx, self._device)
+        self._starting_workers.add(worker)
+        try:
+            await worker.wait_ready()
+        except WorkerTerminatedError:
+            logger.error('推論ワーカーの起動に失敗しました')
+            self._spawn_failures += 1
+            worker.terminate()
+            await asyncio.to_thread(worker.process.join, 10)
+            worker.discard()
+            return False
+        finally:
+            self._starting_workers.discard(worker)
+        logger.info(
+            f'推論ワーカー起動完了 pid:{worker.process.pid}, '
+            f'import:{worker.import_seconds:.2f}s, model_load:{worker.model_load_seconds:.2f}s'
+        )
+        self._spawn_failures = 0
+        self._workers.add(worker)
+        self._idle_workers.put_nowait(worker)
+        return True
+
+    async def _respawn(self):
+        delay = SPAWN_RETRY_INITIAL_SECONDS
+        while not await self._spawn():
+            logger.info(f'{delay:.0f}秒後に推論ワーカーの起動を再試行します')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SPAWN_RETRY_MAX_SECONDS)
+
+    def _respawn_in_background(self):
+        task = asyncio.create_task(self._respawn())
+        self._spawn_tasks.add(task)
+        task.add_done_callback(self._spawn_tasks.discard)
+
+    def is_available(self) -> bool:
+        """ワーカーが1つ以上あるか、補充中で起動に失敗していない場合はTrue。"""
+        return bool(self._workers) or self._spawn_failures == 0
+
+    async def _get_worker(self, cancel_when: Optional[asyncio.Future]) -> InferenceWorker:
+        get_task = asyncio.create_task(self._idle_workers.get())
+        if cancel_when is not None:
+            await asyncio.wait({get_task, cancel_when}, return_when=asyncio.FIRST_COMPLETED)
+            if cancel_when.done():
+                get_task.cancel()
+                try:
+                    # キャンセルと同時に取得できていた場合はプールに戻す
+                    self._idle_workers.put_nowait(await get_task)
+                except asyncio.CancelledError:
+                    pass
+                raise WorkerAcquireCancelledError()
+        return await get_task
+
+    @asynccontextmanager
+    async def acquire(self, cancel_when: Optional[asyncio.Future] = None):
+        """空いているワーカーを取得する。
+
+        Args:
+            cancel_when (Optional[asyncio.Future]): 完了した場合に、ワーカーの空きを待つのをやめる(クライアントの切断等)。
+
+        Raises:
+            WorkerPoolUnavailableError: ワーカーがなく、補充にも失敗している。
+            WorkerAcquireCancelledError: ワーカーの空きを待つ間にcancel_whenが完了した。
+        """
+        if not self.is_available():
+            raise WorkerPoolUnavailableError()
+        worker = await self._get_worker(cancel_when)
+        try:
+            yield worker
+        finally:
+            if worker.is_alive():
+                self._idle_workers.put_nowait(worker)
+            else:
+                self._workers.discard(worker)
+                worker.discard()
+                self._respawn_in_background()
+
+    async def close(self):
+        for task in self._spawn_tasks:
+            task.cancel()
+        for worker in self._starting_workers:
+            worker.terminate()
+        await asyncio.gather(*(worker.close() for worker in self._workers))
@@ -1,6 +1,6 @@
 import asyncio
 from enum import Enum
-import subprocess
+import os
 from datetime import datetime
 import logging
 from pydantic import BaseModel
@@ -9,6 +9,10 @@ import torch
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
 
+from src.inference_worker import (
+    InferenceWorker, InferenceWorkerPool, WorkerAcquireCancelledError, WorkerJobError, WorkerPoolUnavailableError, WorkerTerminatedError
+)
+
 # ログ設定
 logging.basicConfig(
     level=logging.INFO,  # INFO以上のログを出力
@@ -25,76 +29,77 @@ class AnalyzeExecutionError(Exception):
 class AnalyzeTerminatedException(Exception):
     pass
 
-class ClientDisconnectException(Exception):
-    pass
-
 class AnalyzeType(Enum):
     spectrograms = 'スペクトログラム抽出'
     structure = '音楽構造解析'
 
-async def monitor_disconnection(request: Request, process: asyncio.subprocess.Process):
+async def wait_for_disconnection(request: Request):
+    """クライアントが切断されるまで待つ。"""
     try:
         while True:
             message = await request.receive()
             if message["type"] == "http.disconnect":
                 logger.info("Client disconnected")
-                process.terminate()  # クライアントが切断された場合、プロセスを終了
-                break
+                return
     except Exception as e:
         logger.error(f"Error while monitoring disconnection: {e}")
-        process.terminate()  
-    raise ClientDisconnectException()
-
-async def monitor_analyze_process(process: asyncio.subprocess.Process, analyze_type: AnalyzeType):
-    # 標準出力（およびエラー出力）をリアルタイムで読み取る
-    async for line in process.stdout:
-        print(line.decode().strip())
-
-    # プロセスの終了を待つ
-    await process.wait()
-
-    if process.stderr:
-        stderr_output = await process.stderr.read()
-        logger.error("サブプロセスでエラー:", stderr_output.decode().strip())
 
-    logger.info(f'プロセス終了コード:{process.returncode}')
-
-    if process.returncode < 0:
+async def monitor_analyze_worker(worker: InferenceWorker, analyze_type: AnalyzeType, args: tuple):
+    try:
+        await worker.run(analyze_type.name, args)
+    except WorkerTerminatedError:
         raise AnalyzeTerminatedException()
-        
-    # プロセスが非ゼロの終了コードで終了した場合
-    elif process.returncode != 0:
+    except WorkerJobError as e:
+        logger.error(f"ワーカーでエラー:{e}")
         raise AnalyzeExecutionError(f'{analyze_type.value}処理で例外が発生:')
-    
-async def handle_subprocess(request: Request, start_time: datetime, process: asyncio.subprocess.Process, analyze_type: AnalyzeType):
+
+async def handle_worker(request: Request, start_time: datetime, analyze_type: AnalyzeType, args: tuple):
+    # ワーカーの空きを待っている間の切断も検知できるよう、取得する前から接続状況を監視する
+    disconnection_task = asyncio.create_task(wait_for_disconnection(request))
     try:
-        # クライアントとの接続状況を監視
-        disconnection_task = asyncio.create_task(monitor_disconnection(request, process=process))
-
-        # サブプロセスを監視
-        await monitor_analyze_process(process=process, analyze_type=analyze_type)
-        end_time = datetime.now()
-        duration = end_time - start_time
-        logger.info(f"end:{end_time}, duration:{duration}")
-        return {"end":end_time}
-    except subprocess.CalledProcessError:
+        async with worker_pool.acquire(cancel_when=disconnection_task) as worker:
+            def terminate_on_disconnect(task: asyncio.Task):
+                # クライアントが切断された場合、ワーカーを終了
+                if not task.cancelled():
+                    worker.terminate()
+            disconnection_task.add_done_callback(terminate_on_disconnect)
+            try:
+                # 常駐ワーカーで解析を実行
+                await monitor_analyze_worker(worker=worker, analyze_type=analyze_type, args=args)
+            finally:
+                disconnection_task.remove_done_callback(terminate_on_disconnect)
+            end_time = datetime.now()
+            duration = end_time - start_time
+            # サブプロセス方式で毎回掛かっていたインポートとモデルロードの時間を省略できた時間として報告
+            saved_seconds = worker.cold_start_seconds(analyze_type.name)
+            logger.info(f"end:{end_time}, duration:{duration}, saved:{saved_seconds:.2f}s")
+            return {"end":end_time, "saved_seconds": saved_seconds}
+    except WorkerPoolUnavailableError:
+        raise HTTPException(
+            status_code=503,
+            detail='推論ワーカーを起動できていません'
+        )
+    except AnalyzeExecutionError:
         raise HTTPException(
             status_code=500,
             detail='解析処理失敗'
         )
     except AnalyzeTerminatedException:
         logger.info(f'{analyze_type.value}処理を中断しました')
-    except ClientDisconnectException:
+    except WorkerAcquireCancelledError:
         logger.info(f"クライアントとの接続が失われたので{analyze_type.value}処理をキャンセルしました")
     finally:
         disconnection_task.cancel()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global device
+    global device, worker_pool
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     logger.info(f"{device} モードで起動")
+    worker_pool = InferenceWorkerPool(size=int(os.getenv('INFERENCE_WORKERS', '1')), device=device)
+    await worker_pool.start()
     yield
+    await worker_pool.close()
     logger.info("shutdown")
 
 app = FastAPI(lifespan=lifespan)
@@ -112,13 +117,8 @@ async def ext_spectrograms(request: Request, body: SpectrogramsCreateBody):
     now = datetime.now()
     logger.info(f"処理開始:{now}")
 
-    # 解析処理をサブプロセスで実行
-    proc = await asyncio.create_subprocess_exec(
-        'python3', '/app/src/spectrograms_process.py', body.separated_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    endtime = await handle_subprocess(request=request, start_time=now, process=proc, analyze_type=AnalyzeType.spectrograms)
+    # 解析処理を常駐ワーカーで実行
+    endtime = await handle_worker(request=request, start_time=now, analyze_type=AnalyzeType.spectrograms, args=(body.separated_path,))
     return endtime
 
 
@@ -128,11 +128,6 @@ async def analyze_structure(request: Request, body: StructureCreateBody):
     now = datetime.now()
     logger.info(f"処理開始:{now}")
 
-    # 解析処理をサブプロセスで実行
-    proc = await asyncio.create_subprocess_exec(
-        'python3', '/app/src/structure_process.py', body.file_path, body.spectrograms_path, device,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    endtime = await handle_subprocess(request=request, start_time=now, process=proc, analyze_type=AnalyzeType.structure)
+    # 解析処理を常駐ワーカーで実行
+    endtime = await handle_worker(request=request, start_time=now, analyze_type=AnalyzeType.structure, args=(body.file_path, body.spectrograms_path))
     return endtime
\ No newline at end of file
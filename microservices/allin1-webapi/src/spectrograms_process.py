@@ -2,14 +2,32 @@ from datetime import datetime
 import os
 from pathlib import Path
 import sys
+import numpy as np
 from allin1.spectrogram import extract_spectrograms
 
+# 保存するスペクトログラムの型。構造解析ではメモリマップで開き、デバイス上でfloat32にする
+# float16はbenchmarks/spectrogram_precision.pyで解析結果が一致することを確認してから使う
+SPECTROGRAM_DTYPE = np.dtype(os.getenv('SPECTROGRAM_DTYPE', 'float32'))
+
+def save_spectrograms_as(src_path: Path, dst_path: Path):
+    """extract_spectrogramsの出力(float32)を、SPECTROGRAM_DTYPEでdst_pathに保存する。"""
+    if SPECTROGRAM_DTYPE == np.float32:
+        os.rename(src_path, dst_path)
+        return
+    spec = np.load(src_path, mmap_mode='r')
+    tmp_path = dst_path.with_name(f'.{dst_path.name}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, spec.astype(SPECTROGRAM_DTYPE))
+    del spec
+    os.replace(tmp_path, dst_path)
+    os.remove(src_path)
+
 def ext_spectrograms(separated_path: str):
     separated_path = Path(separated_path)
     save_path = separated_path.parent
     extract_spectrograms([separated_path], save_path, True)
     print('スペクトログラム抽出が完了')
-    os.rename(separated_path.parent / 'separated.npy', separated_path.parent / 'spectrograms.npy')
+    save_spectrograms_as(separated_path.parent / 'separated.npy', separated_path.parent / 'spectrograms.npy')
     end_time = datetime.now()
     return {"end":end_time}
 
@@ -1,23 +1,59 @@
 import sys
+import warnings
 from datetime import datetime
 from pathlib import Path
-import demucs
+import numpy as np
 import torch
-from allin1.helpers import run_inference
 from allin1.models.loaders import load_pretrained_model
-from utility import adjust_segments_to_beat, analysis_result_to_json, generate_click_sound
+from allin1.postprocessing import estimate_tempo_from_beats, postprocess_functional_structure, postprocess_metrical_structure
+from allin1.typings import AnalysisResult
+from utility import adjust_segments_to_beat, analysis_result_to_json
 
-def analyze_structure(file_path, spec_path, device):
+def load_spectrograms(spec_path: Path, device) -> torch.Tensor:
+    """スペクトログラムをメモリマップで開き、デバイスに転送してからfloat32にする。
+
+    float16で保存されたスペクトログラムは、ファイル全体をfloat32としてメモリに読み込まずに済む。
+    float32で保存された従来のスペクトログラムもそのまま扱える。
+    """
+    spec = np.load(spec_path, mmap_mode='r')
+    with warnings.catch_warnings():
+        # 読み取り専用のメモリマップから作るテンソルへの警告。メモリマップを共有したまま返さないため書き込まれない
+        warnings.simplefilter('ignore', UserWarning)
+        mapped = torch.from_numpy(spec)
+    spec = mapped.unsqueeze(0).to(device).float()
+    if spec.data_ptr() == mapped.data_ptr():
+        # CPUでfloat32の場合は.to()も.float()もコピーしないため、メモリマップから切り離す
+        spec = spec.clone()
+    return spec
+
+def run_inference(path: Path, spec_path: Path, model, device) -> AnalysisResult:
+    """allin1.helpers.run_inferenceと同じ解析を、メモリマップで開いたスペクトログラムで行う。"""
+    spec = load_spectrograms(spec_path, device)
+    logits = model(spec)
+
+    metrical_structure = postprocess_metrical_structure(logits, model.cfg)
+    functional_structure = postprocess_functional_structure(logits, model.cfg)
+    bpm = estimate_tempo_from_beats(metrical_structure['beats'])
+
+    return AnalysisResult(
+        path=path,
+        bpm=bpm,
+        segments=functional_structure,
+        **metrical_structure,
+    )
+
+def analyze_structure(file_path, spec_path, device, model=None):
     file_path = Path(file_path)
     spec_path = Path(spec_path)
+    if model is None:
+        # 常駐ワーカーからロード済みのモデルが渡されない場合のみロードする
+        model = load_pretrained_model(device=device)
     with torch.no_grad():
         result = run_inference(
             path=file_path,
             spec_path=spec_path,
-            model=load_pretrained_model(device=device),
-            device=device,
-            include_activations=False,
-            include_embeddings=False
+            model=model,
+            device=device
         )
     print('音楽構造の解析が完了')
     save_dir = Path(file_path.parent / 'structure')
@@ -28,11 +64,7 @@ def analyze_structure(file_path, spec_path, device):
 
     # 結果をjsonとして保存
     analysis_result_to_json(result, save_dir)
-
-    y = demucs.separate.load_track(file_path, 2, 44100).numpy()
-    length = y.shape[-1]
-    # ビートの結果からクリック音を生成
-    generate_click_sound(result, length, save_dir)
+    # クリック音はutility-webapiでstructure.jsonから必要な時に生成する
     
     end_time = datetime.now()
     return {"end": end_time}
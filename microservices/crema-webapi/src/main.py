@@ -1,47 +1,94 @@
+import asyncio
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from contextlib import asynccontextmanager
 import json
 from pathlib import Path
+import time
 from typing import Annotated
 from crema.analyze import analyze, _load_models
 from tempfile import NamedTemporaryFile
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, HTTPException, UploadFile
+import numpy as np
 import shutil
 import os
 
 from pydantic import BaseModel
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+# 同時に実行するコード解析の上限。CPUの取り合いを防ぐため既定は1
+MAX_CONCURRENCY = int(os.getenv('CREMA_MAX_CONCURRENCY', '1'))
+
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix='crema')
+pending_jobs = 0
+last_queue_wait = None
+# モデルのロードに失敗した場合の例外。失敗した場合は解析リクエストを受け付けない
+models_load_error = None
+
+def load_and_warm_up_models():
     now = datetime.now()
     print(f"モデルロード開始:{now}")
-    _load_models
+    _load_models()
+    # 初回推論時のグラフ構築を済ませるため、短い無音に近い信号で一度解析しておく
+    sr = 44100
+    analyze(y=np.random.default_rng(0).uniform(-1e-3, 1e-3, sr * 5).astype(np.float32), sr=sr)
     end_time = datetime.now()
     duration = end_time - now
     print(f"end:{end_time}, duration:{duration}")
+
+def _on_models_loaded(future: asyncio.Future):
+    global models_load_error
+    if future.cancelled():
+        models_load_error = asyncio.CancelledError()
+    elif future.exception() is not None:
+        models_load_error = future.exception()
+        print(f"モデルのロードに失敗:{models_load_error}")
+    models_ready.set()
+
+def raise_if_models_unavailable():
+    if models_load_error is not None:
+        raise HTTPException(
+            status_code=503,
+            detail=f'モデルのロードに失敗しています:{models_load_error}'
+        )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global models_ready
+    # モデルのロードと暖機が完了したかどうか。完了するまで解析リクエストを待たせる
+    models_ready = asyncio.Event()
+    load_task = asyncio.get_running_loop().run_in_executor(executor, load_and_warm_up_models)
+    load_task.add_done_callback(_on_models_loaded)
     yield
+    executor.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(lifespan=lifespan)
 
 class FilePathBody(BaseModel):
     file_path: str
-    
+
 @app.get("/")
 def read_root():
     jam = analyze(filename='../input/soramo_toberuhazu.wav')
     print(jam)
     return(jam)
 
-@app.post("/")
-def analyze_chord(body: FilePathBody):
-    file_path = body.file_path
-    now = datetime.now()
-    print(f"処理開始:{now}")
-    
+@app.get("/status")
+def read_status():
+    raise_if_models_unavailable()
+    return {
+        'ready': models_ready.is_set(),
+        'max_concurrency': MAX_CONCURRENCY,
+        'pending_jobs': pending_jobs,
+        'last_queue_wait': last_queue_wait
+    }
+
+def run_analyze_chord(file_path: str, submitted_at: float) -> float:
+    queue_wait = time.perf_counter() - submitted_at
+
     jam = analyze(filename=file_path)
     json_result = {'chords': []}
-    
+
     annotations = jam.search(namespace='chord')
     for annotation in annotations:
         for obs in annotation.data:
@@ -52,11 +99,33 @@ def analyze_chord(body: FilePathBody):
             }
             json_result['chords'].append(result_dict)
     save_dir = Path(file_path).parent / 'chord'
-    save_dir.mkdir()        
+    save_dir.mkdir()
     with open(save_dir / 'chord.json', 'w', encoding='utf-8') as f:
         json.dump(json_result, f)
+    return queue_wait
+
+@app.post("/")
+async def analyze_chord(body: FilePathBody):
+    global pending_jobs, last_queue_wait
+    file_path = body.file_path
+    now = datetime.now()
+    print(f"処理開始:{now}")
+
+    # モデルの準備が整うまで待つ
+    await models_ready.wait()
+    raise_if_models_unavailable()
+
+    pending_jobs += 1
+    try:
+        # 専用のエグゼキュータで実行し、同時実行数をMAX_CONCURRENCYに制限する
+        queue_wait = await asyncio.get_running_loop().run_in_executor(
+            executor, run_analyze_chord, file_path, time.perf_counter()
+        )
+    finally:
+        pending_jobs -= 1
+    last_queue_wait = queue_wait
 
     end_time = datetime.now()
     duration = end_time - now
-    print(f"end:{end_time}, duration:{duration}")
-    return {"end":end_time}
\ No newline at end of file
+    print(f"end:{end_time}, duration:{duration}, queue_wait:{queue_wait:.3f}s")
+    return {"end":end_time, "queue_wait": queue_wait}
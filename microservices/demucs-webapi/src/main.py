@@ -1,13 +1,18 @@
 import asyncio
 from enum import Enum
 import logging
+import os
 from pathlib import Path
-import subprocess
+from typing import Optional
 from fastapi import FastAPI, HTTPException, Request
 from contextlib import asynccontextmanager
 from datetime import datetime
 from pydantic import BaseModel
 
+from src.separator_pool import (
+    SeparatorPool, SeparatorWorker, WorkerAcquireCancelledError, WorkerJobError, WorkerPoolUnavailableError, WorkerTerminatedError
+)
+
 # ログ設定
 logging.basicConfig(
     level=logging.INFO,  # INFO以上のログを出力
@@ -24,81 +29,88 @@ class AnalyzeExecutionError(Exception):
 class AnalyzeTerminatedException(Exception):
     pass
 
-class ClientDisconnectException(Exception):
-    pass
-
 class AnalyzeType(Enum):
     separate = 'パート別音源分離'
    
 
-async def monitor_disconnection(request: Request, process: asyncio.subprocess.Process):
+async def wait_for_disconnection(request: Request):
+    """クライアントが切断されるまで待つ。"""
     try:
         while True:
             message = await request.receive()
             if message["type"] == "http.disconnect":
                 logger.info("Client disconnected")
-                process.terminate()  # クライアントが切断された場合、プロセスを終了
-                break
+                return
     except Exception as e:
         logger.error(f"Error while monitoring disconnection: {e}")
-        process.terminate()  
-    raise ClientDisconnectException()
-
-async def monitor_analyze_process(process: asyncio.subprocess.Process, analyze_type: AnalyzeType):
-    # 標準出力（およびエラー出力）をリアルタイムで読み取る
-    async for line in process.stdout:
-        print(line.decode().strip())
-
-    # プロセスの終了を待つ
-    await process.wait()
 
-    if process.stderr:
-        stderr_output = await process.stderr.read()
-        logger.error("サブプロセスでエラー:", stderr_output.decode().strip())
-
-    logger.info(f'プロセス終了コード:{process.returncode}')
-
-    if process.returncode < 0:
+async def monitor_separate_worker(worker: SeparatorWorker, analyze_type: AnalyzeType, file_path: str, save_dir_path: str, spectrograms_path: Optional[str]) -> dict[str, float]:
+    try:
+        return await worker.run(file_path, save_dir_path, spectrograms_path)
+    except WorkerTerminatedError:
         raise AnalyzeTerminatedException()
-        
-    # プロセスが非ゼロの終了コードで終了した場合
-    elif process.returncode != 0:
+    except WorkerJobError as e:
+        logger.error(f"ワーカーでエラー:{e}")
         raise AnalyzeExecutionError(f'{analyze_type.value}処理で例外が発生:')
     
-async def handle_subprocess(request: Request, start_time: datetime, process: asyncio.subprocess.Process, analyze_type: AnalyzeType):
+async def handle_worker(request: Request, start_time: datetime, analyze_type: AnalyzeType, file_path: str, save_dir_path: str, spectrograms_path: Optional[str] = None):
+    # ワーカーの空きを待っている間の切断も検知できるよう、取得する前から接続状況を監視する
+    disconnection_task = asyncio.create_task(wait_for_disconnection(request))
     try:
-        # クライアントとの接続状況を監視
-        disconnection_task = asyncio.create_task(monitor_disconnection(request, process=process))
-
-        # サブプロセスを監視
-        await monitor_analyze_process(process=process, analyze_type=analyze_type)
-        end_time = datetime.now()
-        duration = end_time - start_time
-        logger.info(f"end:{end_time}, duration:{duration}")
-        return {"end":end_time}
-    except subprocess.CalledProcessError:
+        async with separator_pool.acquire(cancel_when=disconnection_task) as worker:
+            acquired_time = datetime.now()
+            def terminate_on_disconnect(task: asyncio.Task):
+                # クライアントが切断された場合、ワーカーを終了
+                if not task.cancelled():
+                    worker.terminate()
+            disconnection_task.add_done_callback(terminate_on_disconnect)
+            try:
+                # 常駐ワーカーで分離を実行
+                timings = await monitor_separate_worker(worker, analyze_type, file_path, save_dir_path, spectrograms_path)
+            finally:
+                disconnection_task.remove_done_callback(terminate_on_disconnect)
+            end_time = datetime.now()
+            duration = end_time - start_time
+            songs_per_hour = separator_pool.record_completion()
+            logger.info(
+                f"end:{end_time}, duration:{duration}, queue_wait:{acquired_time - start_time}, "
+                f"time_to_first_sample:{timings.get('first_sample')}s, "
+                f"time_to_first_stem_written:{timings.get('first_stem_written')}s, songs/hour:{songs_per_hour}"
+            )
+            return {"end":end_time}
+    except WorkerPoolUnavailableError:
+        raise HTTPException(
+            status_code=503,
+            detail='Separatorワーカーを起動できていません'
+        )
+    except AnalyzeExecutionError:
         raise HTTPException(
             status_code=500,
             detail='解析処理失敗'
         )
     except AnalyzeTerminatedException:
         logger.info(f'{analyze_type.value}処理を中断しました')
-    except ClientDisconnectException:
+    except WorkerAcquireCancelledError:
         logger.info(f"クライアントとの接続が失われたので{analyze_type.value}処理をキャンセルしました")
     finally:
         disconnection_task.cancel()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model_name
+    global model_name, separator_pool
     model_name = 'htdemucs_6s'
+    separator_pool = SeparatorPool(size=int(os.getenv('SEPARATOR_POOL_SIZE', '1')), model_name=model_name)
+    await separator_pool.start()
     yield
+    await separator_pool.close()
     logger.info("shutdown")
     
 app = FastAPI(lifespan=lifespan)
 
 class FilePathBody(BaseModel):
     file_path: str
+    # 指定した場合は、分離したステムからallin1のスペクトログラムも抽出してこのパスに保存する
+    spectrograms_path: Optional[str] = None
 
 
 @app.post("/")
@@ -106,13 +118,15 @@ async def separate(request: Request, body: FilePathBody):
     now = datetime.now()
     logger.info(f"処理開始:{now}")
 
-    # 解析処理をサブプロセスで実行
-    proc = await asyncio.create_subprocess_exec(
-        'python3', '/app/src/separate_process.py', model_name, body.file_path, str(Path(body.file_path).parent / 'separated'),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+    # 分離処理を常駐ワーカーで実行
+    endtime = await handle_worker(
+        request=request, 
+        start_time=now, 
+        analyze_type=AnalyzeType.separate, 
+        file_path=body.file_path, 
+        save_dir_path=str(Path(body.file_path).parent / 'separated'),
+        spectrograms_path=body.spectrograms_path
     )
-    endtime = await handle_subprocess(request=request, start_time=now, process=proc, analyze_type=AnalyzeType.separate)
     return endtime
     
      
\ No newline at end of file
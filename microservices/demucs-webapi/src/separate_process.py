@@ -1,37 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import os
 from pathlib import Path
 import sys
-from pydub import AudioSegment
+from typing import Callable, Optional
+import torch
+import torchaudio
 import demucs.api
+from demucs.audio import i16_pcm, prevent_clip
+from spectrogram import save_spectrograms
 
+# 分離結果のステムを重ねて生成する音声。"{ファイル名}={ステム}+{ステム}..."をセミコロンで区切って指定する
+# other.wavはallin1のスペクトログラム抽出(4ステム前提)で使うため、常に生成する
+# 例: other=other_6s+piano+guitar;no_guitar=vocals+drums+bass+piano+other_6s
+DEFAULT_DERIVED_MIXES = 'other=other_6s+piano+guitar'
 
-def separate(model_name: str, file_path: str, save_dir_path: str):
-    separator = demucs.api.Separator(model=model_name, progress=True)
+def parse_derived_mixes(value: str) -> dict[str, list[str]]:
+    mixes = {}
+    for entry in value.split(';'):
+        if not entry.strip():
+            continue
+        name, stems = entry.split('=', 1)
+        mixes[name.strip()] = [stem.strip() for stem in stems.split('+')]
+    if 'other' not in mixes:
+        mixes.update(parse_derived_mixes(DEFAULT_DERIVED_MIXES))
+    return mixes
+
+def load_separator(model_name: str) -> demucs.api.Separator:
+    return demucs.api.Separator(model=model_name, progress=True)
+
+def mix_stems(pcm_stems: list[torch.Tensor]) -> torch.Tensor:
+    """16bitのステムを重ねる。範囲外の値はクリップする(pydubのoverlayと同じ)。"""
+    mixed = pcm_stems[0].to(torch.int32)
+    for pcm in pcm_stems[1:]:
+        mixed += pcm
+    return mixed.clamp_(-2**15, 2**15 - 1).to(torch.int16)
+
+def save_pcm(pcm: torch.Tensor, path: Path, samplerate: int):
+    torchaudio.save(str(path), pcm, samplerate, encoding='PCM_S', bits_per_sample=16)
+
+def separate_with(
+        separator: demucs.api.Separator,
+        file_path: str,
+        save_dir_path: str,
+        on_first_stem_saved: Optional[Callable[[], None]] = None,
+        spectrograms_path: Optional[str] = None,
+        on_first_chunk_separated: Optional[Callable[[], None]] = None
+):
+    """音声ファイルを分離し、ステムと重ねた音声をsave_dir_pathに保存する。
+
+    Args:
+        separator (demucs.api.Separator): 分離に使うSeparator。
+        file_path (str): 分離する音声ファイル。
+        save_dir_path (str): 保存先のディレクトリ。
+        on_first_stem_saved (Optional[Callable[[], None]]): 最初のステムのファイルを書き出した時に呼ばれる。
+        spectrograms_path (Optional[str]): 指定した場合は、allin1のスペクトログラムも抽出して保存する。
+        on_first_chunk_separated (Optional[Callable[[], None]]): 最初の区間の分離結果(最初の出力サンプル)が得られた時に呼ばれる。
+    """
     file_path = Path(file_path)
-    origin, separated = separator.separate_audio_file(file_path)
+    if on_first_chunk_separated is not None:
+        def on_progress(progress: dict):
+            # demucsは区間(segment)ごとに推論し、区間の推論が終わる度に'end'で呼び出す
+            nonlocal on_first_chunk_separated
+            if progress['state'] == 'end' and on_first_chunk_separated is not None:
+                on_first_chunk_separated()
+                on_first_chunk_separated = None
+        separator.update_parameter(callback=on_progress)
+    try:
+        _, separated = separator.separate_audio_file(file_path)
+    finally:
+        separator.update_parameter(callback=None)
     print('分離処理が完了')
     save_dir_path: Path = Path(save_dir_path)
     save_dir_path.mkdir()
 
-    for stem, source in separated.items():
-        if stem == 'other': stem = 'other_6s'
-        demucs.api.save_audio(source, save_dir_path / f'{stem}.wav', separator.samplerate)
-    
-    # ピアノ、ギター、その他パートの音声を重ねてother.wavを生成する
-    combined = AudioSegment.from_wav(save_dir_path / 'other_6s.wav')
-    for file_name in ['piano.wav', 'guitar.wav']:
-            audio = AudioSegment.from_wav(save_dir_path / file_name)
-            # 音声を重ねる
-            combined = combined.overlay(audio)
+    # demucs.api.save_audioと同じ方法で16bitに変換し、以降はこれを書き出しと重ね合わせに使う
+    pcm_stems: dict[str, torch.Tensor] = {}
+    for stem in list(separated):
+        source = separated.pop(stem)
+        pcm_stems['other_6s' if stem == 'other' else stem] = i16_pcm(prevent_clip(source, mode='rescale'))
+        del source
+
+    # ステムを書き出しながら、重ねた音声をメモリ上で生成する
+    derived_mixes = parse_derived_mixes(os.getenv('DERIVED_MIXES', DEFAULT_DERIVED_MIXES))
+    with ThreadPoolExecutor(max_workers=len(pcm_stems) + len(derived_mixes) + 1) as executor:
+        futures = [
+            executor.submit(save_pcm, pcm, save_dir_path / f'{stem}.wav', separator.samplerate)
+            for stem, pcm in pcm_stems.items()
+        ]
+        for name, stems in derived_mixes.items():
+            pcm_stems[name] = mix_stems([pcm_stems[stem] for stem in stems])
+            futures.append(executor.submit(save_pcm, pcm_stems[name], save_dir_path / f'{name}.wav', separator.samplerate))
+        if spectrograms_path is not None:
+            # 分離結果を読み直さずに、allin1のスペクトログラムを抽出する
+            spectrograms_future = executor.submit(save_spectrograms, pcm_stems, separator.samplerate, Path(spectrograms_path))
+        for future in as_completed(futures):
+            future.result()
+            if on_first_stem_saved is not None:
+                on_first_stem_saved()
+                on_first_stem_saved = None
+        if spectrograms_path is not None:
+            spectrograms_future.result()
+            print('スペクトログラム抽出が完了')
 
-    combined.export(save_dir_path / 'other.wav', format='wav')
+    end_time = datetime.now()
+    return {"end":end_time}
 
-    end_time = datetime.now
-    return {"end":end_time}    
+def separate(model_name: str, file_path: str, save_dir_path: str, spectrograms_path: Optional[str] = None):
+    separator = load_separator(model_name)
+    return separate_with(separator, file_path, save_dir_path, spectrograms_path=spectrograms_path)
 
 if __name__ == "__main__":
      model_name = sys.argv[1]
      file_path = sys.argv[2]
      save_dir_path = sys.argv[3]
+     spectrograms_path = sys.argv[4] if len(sys.argv) > 4 else None
 
-     separate(model_name=model_name, file_path=file_path, save_dir_path=save_dir_path)
\ No newline at end of file
+     separate(model_name=model_name, file_path=file_path, save_dir_path=save_dir_path, spectrograms_path=spectrograms_path)
@@ -0,0 +1,266 @@
+"""常駐Separatorプールを扱うモジュール。
+
+demucsのSeparatorを生成済みの子プロセスを常駐させ、パイプ経由で分離ジョブを受け取る。
+リクエスト毎にPythonプロセスを起動し、重みをロードし直すコストを省くことが目的。
+"""
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from contextlib import asynccontextmanager
+from multiprocessing.connection import Connection
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class WorkerTerminatedError(Exception):
+    pass
+
+class WorkerJobError(Exception):
+    pass
+
+class WorkerPoolStartupError(Exception):
+    pass
+
+class WorkerPoolUnavailableError(Exception):
+    pass
+
+class WorkerAcquireCancelledError(Exception):
+    pass
+
+# ワーカーの起動に失敗した場合に再試行するまでの秒数(失敗する度に倍にする)
+SPAWN_RETRY_INITIAL_SECONDS = 1.0
+SPAWN_RETRY_MAX_SECONDS = 60.0
+
+def _worker_main(conn: Connection, model_name: str):
+    """子プロセスのエントリポイント。Separatorを生成した後、ジョブを待ち受ける。
+
+    Args:
+        conn (Connection): 親プロセスとのパイプ。
+        model_name (str): demucsのモデル名。
+    """
+    # separate_processは src ディレクトリを起点にインポートされる前提
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    load_start = time.perf_counter()
+    from separate_process import load_separator, separate_with
+    separator = load_separator(model_name)
+    conn.send(('ready', time.perf_counter() - load_start))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        file_path, save_dir_path, spectrograms_path = message
+        job_start = time.perf_counter()
+        try:
+            separate_with(
+                separator, file_path, save_dir_path,
+                on_first_stem_saved=lambda: conn.send(('first_stem_written', time.perf_counter() - job_start)),
+                spectrograms_path=spectrograms_path,
+                on_first_chunk_separated=lambda: conn.send(('first_sample', time.perf_counter() - job_start))
+            )
+            conn.send(('done', None))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+class SeparatorWorker:
+    """Separatorを生成済みの子プロセス1つを表す。"""
+
+    def __init__(self, ctx: multiprocessing.context.BaseContext, model_name: str):
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, model_name))
+        self.process.start()
+        child_conn.close()
+        self.terminated = False
+        self.load_seconds: Optional[float] = None
+
+    async def wait_ready(self):
+        """子プロセスのSeparator生成完了を待つ。"""
+        try:
+            status, value = await asyncio.to_thread(self._conn.recv)
+        except (EOFError, OSError):
+            raise WorkerTerminatedError()
+        self.load_seconds = value
+
+    def is_alive(self) -> bool:
+        return not self.terminated and self.process.is_alive()
+
+    def terminate(self):
+        self.terminated = True
+        self.process.terminate()
+
+    async def run(self, file_path: str, save_dir_path: str, spectrograms_path: Optional[str] = None) -> dict[str, float]:
+        """分離ジョブを子プロセスに渡し、完了を待つ。
+
+        spectrograms_pathを指定した場合は、分離したステムからallin1のスペクトログラムも抽出して保存する。
+
+        Returns:
+            dict[str, float]: ジョブ開始からの経過秒数。
+                first_sampleは最初の区間の分離結果が得られるまで、first_stem_writtenは最初のステムのファイルを書き出すまで。
+
+        Raises:
+            WorkerTerminatedError: 実行中に子プロセスが終了させられた。
+            WorkerJobError: ジョブ内で例外が発生した。
+        """
+        timings = {}
+        try:
+            self._conn.send((file_path, save_dir_path, spectrograms_path))
+            while True:
+                status, value = await asyncio.to_thread(self._conn.recv)
+                if status in ('first_sample', 'first_stem_written'):
+                    timings[status] = value
+                    continue
+                break
+        except (EOFError, OSError, BrokenPipeError):
+            raise WorkerTerminatedError()
+        if status == 'error':
+            raise WorkerJobError(value)
+        return timings
+
+    def discard(self):
+        """終了済みのワーカーのパイプを閉じる。"""
+        self._conn.close()
+
+    async def close(self):
+        try:
+            self._conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        await asyncio.to_thread(self.process.join, 10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+
+class SeparatorPool:
+    """常駐Separatorのプール。
+
+    ジョブの実行中にワーカーが終了させられた場合(クライアント切断によるキャンセル等)や、
+    起動に失敗した場合は、新しいワーカーをバックグラウンドで起動してプールに補充する。
+    補充に失敗した場合は間隔を空けながら成功するまで再試行する。
+    """
+
+    def __init__(self, size: int, model_name: str):
+        # CUDAを子プロセスで扱うためspawnで起動する
+        self._ctx = multiprocessing.get_context('spawn')
+        self._size = size
+        self._model_name = model_name
+        self._idle_workers: asyncio.Queue[SeparatorWorker] = asyncio.Queue()
+        # 起動が完了したワーカーと、起動中のワーカー
+        self._workers: set[SeparatorWorker] = set()
+        self._starting_workers: set[SeparatorWorker] = set()
+        self._spawn_tasks: set[asyncio.Task] = set()
+        # 連続して起動に失敗した回数
+        self._spawn_failures = 0
+        # 直近1時間に完了したジョブの時刻
+        self._completed_at: collections.deque[float] = collections.deque()
+
+    async def start(self):
+        """ワーカーを起動する。
+
+        Raises:
+            WorkerPoolStartupError: 1つもワーカーを起動できなかった。
+        """
+        results = await asyncio.gather(*(self._spawn() for _ in range(self._size)))
+        if not any(results):
+            raise WorkerPoolStartupError('Separatorワーカーを1つも起動できませんでした')
+        for _ in range(results.count(False)):
+            self._respawn_in_background()
+
+    async def _spawn(self) -> bool:
+        """ワーカーを1つ起動し、プールに加える。起動に失敗した場合はFalseを返す。"""
+        worker = SeparatorWorker(self._ctx, self._model_name)
+        self._starting_workers.add(worker)
+        try:
+            await worker.wait_ready()
+        except WorkerTerminatedError:
+            logger.error('Separatorワーカーの起動に失敗しました')
+            self._spawn_failures += 1
+            worker.terminate()
+            await asyncio.to_thread(worker.process.join, 10)
+            worker.discard()
+            return False
+        finally:
+            self._starting_workers.discard(worker)
+        logger.info(f'Separatorワーカー起動完了 pid:{worker.process.pid}, load:{worker.load_seconds:.2f}s')
+        self._spawn_failures = 0
+        self._workers.add(worker)
+        self._idle_workers.put_nowait(worker)
+        return True
+
+    async def _respawn(self):
+        delay = SPAWN_RETRY_INITIAL_SECONDS
+        while not await self._spawn():
+            logger.info(f'{delay:.0f}秒後にSeparatorワーカーの起動を再試行します')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SPAWN_RETRY_MAX_SECONDS)
+
+    def _respawn_in_background(self):
+        task = asyncio.create_task(self._respawn())
+        self._spawn_tasks.add(task)
+        task.add_done_callback(self._spawn_tasks.discard)
+
+    def is_available(self) -> bool:
+        """ワーカーが1つ以上あるか、補充中で起動に失敗していない場合はTrue。"""
+        return bool(self._workers) or self._spawn_failures == 0
+
+    async def _get_worker(self, cancel_when: Optional[asyncio.Future]) -> SeparatorWorker:
+        get_task = asyncio.create_task(self._idle_workers.get())
+        if cancel_when is not None:
+            await asyncio.wait({get_task, cancel_when}, return_when=asyncio.FIRST_COMPLETED)
+            if cancel_when.done():
+                get_task.cancel()
+                try:
+                    # キャンセルと同時に取得できていた場合はプールに戻す
+                    self._idle_workers.put_nowait(await get_task)
+                except asyncio.CancelledError:
+                    pass
+                raise WorkerAcquireCancelledError()
+        return await get_task
+
+    @asynccontextmanager
+    async def acquire(self, cancel_when: Optional[asyncio.Future] = None):
+        """空いているワーカーを取得する。
+
+        Args:
+            cancel_when (Optional[asyncio.Future]): 完了した場合に、ワーカーの空きを待つのをやめる(クライアントの切断等)。
+
+        Raises:
+            WorkerPoolUnavailableError: ワーカーがなく、補充にも失敗している。
+            WorkerAcquireCancelledError: ワーカーの空きを待つ間にcancel_whenが完了した。
+        """
+        if not self.is_available():
+            raise WorkerPoolUnavailableError()
+        worker = await self._get_worker(cancel_when)
+        try:
+            yield worker
+        finally:
+            if worker.is_alive():
+                self._idle_workers.put_nowait(worker)
+            else:
+                self._workers.discard(worker)
+                worker.discard()
+                self._respawn_in_background()
+
+    def record_completion(self) -> int:
+        """ジョブの完了を記録し、直近1時間に処理した曲数(songs/hour)を返す。"""
+        now = time.monotonic()
+        self._completed_at.append(now)
+        while self._completed_at and now - self._completed_at[0] > 3600:
+            self._completed_at.popleft()
+        return len(self._completed_at)
+
+    async def close(self):
+        for task in self._spawn_tasks:
+            task.cancel()
+        for worker in self._starting_workers:
+            worker.terminate()
+        await asyncio.gather(*(worker.close() for worker in self._workers))
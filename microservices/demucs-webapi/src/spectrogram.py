@@ -0,0 +1,59 @@
+"""分離直後のステムからallin1のスペクトログラムを抽出するモジュール。
+
+allin1-webapiの/spectrogramsは分離結果のWAVを読み直して抽出するが、
+分離済みのステムをメモリ上で受け取り、同じ設定(allin1.spectrogram.extract_spectrograms)で抽出する。
+"""
+import os
+from pathlib import Path
+import numpy as np
+import torch
+
+# allin1のスペクトログラムに使うステムと、その並び順
+SPECTROGRAM_STEMS = ['bass', 'drums', 'other', 'vocals']
+SPECTROGRAM_SAMPLE_RATE = 44100
+# 保存するスペクトログラムの型(allin1-webapiのSPECTROGRAM_DTYPEと合わせる)
+SPECTROGRAM_DTYPE = np.dtype(os.getenv('SPECTROGRAM_DTYPE', 'float32'))
+
+_processor = None
+
+def get_spectrogram_processor():
+    """allin1.spectrogram.extract_spectrogramsと同じ設定のプロセッサを返す。"""
+    global _processor
+    if _processor is None:
+        # madmomはスペクトログラムを抽出する場合のみ必要
+        from madmom.audio.signal import FramedSignalProcessor
+        from madmom.audio.stft import ShortTimeFourierTransformProcessor
+        from madmom.audio.spectrogram import FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor
+        from madmom.processors import SequentialProcessor
+        frames = FramedSignalProcessor(frame_size=2048, fps=int(SPECTROGRAM_SAMPLE_RATE / 441))
+        stft = ShortTimeFourierTransformProcessor()
+        filt = FilteredSpectrogramProcessor(num_bands=12, fmin=30, fmax=17000, norm_filters=True)
+        spec = LogarithmicSpectrogramProcessor(mul=1, add=1)
+        _processor = SequentialProcessor([frames, stft, filt, spec])
+    return _processor
+
+def _extract(pcm: torch.Tensor) -> np.ndarray:
+    from madmom.audio.signal import Signal
+    # WAVを読み込む場合(Signal(path, num_channels=1))と同じく、整数のままチャンネルを平均してモノラルにする
+    mono = pcm.numpy().mean(axis=0).astype(np.int16)
+    return get_spectrogram_processor()(Signal(mono, sample_rate=SPECTROGRAM_SAMPLE_RATE, num_channels=1))
+
+def save_spectrograms(pcm_stems: dict[str, torch.Tensor], samplerate: int, save_path: Path):
+    """16bitのステムからスペクトログラムを抽出し、allin1と同じ形式(ステム, 時間, 周波数)のSPECTROGRAM_DTYPEで保存する。
+
+    Args:
+        pcm_stems (dict[str, torch.Tensor]): ステム名と16bitの音声(チャンネル, サンプル)。SPECTROGRAM_STEMSを含む必要がある。
+        samplerate (int): ステムのサンプリングレート。
+        save_path (Path): 保存先。
+
+    Raises:
+        ValueError: サンプリングレートがallin1の前提と異なる。
+    """
+    if samplerate != SPECTROGRAM_SAMPLE_RATE:
+        raise ValueError(f'スペクトログラムの抽出には{SPECTROGRAM_SAMPLE_RATE}Hzの音声が必要です:{samplerate}')
+    spec = np.stack([_extract(pcm_stems[stem]).astype(SPECTROGRAM_DTYPE) for stem in SPECTROGRAM_STEMS])
+    # 途中の状態が後続の解析から見えないよう、書き込み後にリネームする
+    tmp_path = save_path.with_name(f'.{save_path.name}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, spec)
+    os.replace(tmp_path, save_path)
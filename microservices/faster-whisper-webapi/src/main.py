@@ -1,10 +1,13 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 from pathlib import Path
+import threading
 from fastapi import FastAPI, HTTPException, Request
 from contextlib import asynccontextmanager
 from pydantic import BaseModel, field_validator
-from faster_whisper import WhisperModel, tokenizer
+from faster_whisper import BatchedInferencePipeline, WhisperModel, tokenizer
 from datetime import datetime
 import logging
 
@@ -18,27 +21,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 同時に文字起こしできるリクエスト数。ロード済みのモデルをこの数のスレッドで共有する
+NUM_WORKERS = int(os.getenv('WHISPER_NUM_WORKERS', '2'))
+# Trueの場合はバッチ推論パイプラインで文字起こしする
+BATCHED_MODE = os.getenv('WHISPER_BATCHED_MODE', 'False') == 'True'
+BATCH_SIZE = int(os.getenv('WHISPER_BATCH_SIZE', '8'))
+
+class TranscriptionCancelledException(Exception):
+    pass
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global whisper_model
+    global whisper_model, batched_model, executor
     logger.info("モデルをロードします")
     model_size = 'large-v3-turbo'
     if os.getenv('GPU_MODE', 'True') == 'True':
         logger.info('GPUモードで起動します')
         whisper_model = WhisperModel(
-            model_size_or_path=model_size)
+            model_size_or_path=model_size,
+            num_workers=NUM_WORKERS
+        )
     else:
         logger.info('CPUモードで起動します')
         whisper_model = WhisperModel(
             device='cpu',
             model_size_or_path=model_size,
-            compute_type='int8'
+            compute_type='int8',
+            num_workers=NUM_WORKERS
         )
+    batched_model = None
+    if BATCHED_MODE:
+        logger.info(f'バッチ推論モードで起動します batch_size:{BATCH_SIZE}')
+        batched_model = BatchedInferencePipeline(model=whisper_model)
+    executor = ThreadPoolExecutor(max_workers=NUM_WORKERS, thread_name_prefix='whisper')
     
     logger.info("モデルのロードが完了しました")
     logging.basicConfig()
     logging.getLogger("faster_whisper").setLevel(logging.DEBUG)
     yield
+    executor.shutdown(wait=False, cancel_futures=True)
     print("shutdown")
 
 app = FastAPI(lifespan=lifespan)
@@ -54,41 +75,70 @@ class AnalyzeLyricRequest(BaseModel):
         return v
 
 
+def transcribe_lyric(file_path: str, language_code: str, cancel_event: threading.Event):
+    """文字起こしを行い、結果をlyric.txtに保存する。イベントループ外のスレッドで実行される。
+
+    Args:
+        file_path (str): ボーカル音声のパス。
+        language_code (str): 言語コード。
+        cancel_event (threading.Event): セットされた場合は文字起こしを中断する。
+
+    Raises:
+        TranscriptionCancelledException: 文字起こしが中断された。
+    """
+    if batched_model is not None:
+        segments, info = batched_model.transcribe(file_path, language=language_code, word_timestamps=True, batch_size=BATCH_SIZE)
+    else:
+        segments, info = whisper_model.transcribe(file_path, language=language_code, word_timestamps=True, hallucination_silence_threshold=2)
+    word_results = []
+    segment_results = []
+    for segment in segments:
+        # 接続が切断されているか確認
+        if cancel_event.is_set():
+            raise TranscriptionCancelledException()
+
+        segment_dics = {'start': segment.start, 'end': segment.end, 'text': segment.text}
+        segment_results.append(segment_dics)
+        for word in segment.words:
+            print("[%.2fs -> %.2fs] %s" % (word.start, word.end, word.word))
+            word_dict = {'start': word.start, 'end': word.end, 'text': word.word}
+            word_results.append(word_dict)
+    
+    with open(Path(file_path).parent.parent / 'lyric.txt', 'w', encoding='utf-8') as txt:
+        json.dump({'segments': segment_results, 'word': word_results}, txt)
+
+async def monitor_disconnection(request: Request, cancel_event: threading.Event):
+    try:
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                logger.info('クライアントとの接続が切断されました')
+                break
+    finally:
+        cancel_event.set()
+
 @app.post("/")
 async def analyze_lyric(body: AnalyzeLyricRequest, request: Request):
     file_path = body.file_path
     now = datetime.now()
     logger.info(f'処理開始:{now}')
     
+    cancel_event = threading.Event()
+    disconnection_task = asyncio.create_task(monitor_disconnection(request, cancel_event))
     try:
-        segments, info = whisper_model.transcribe(file_path, language=body.language_code, word_timestamps=True, hallucination_silence_threshold=2)
-        word_results = []
-        segment_results = []
-        for segment in segments:
-            # 接続が切断されているか確認
-            if await request.is_disconnected():
-                logger.info('クライアントとの接続が切断されました')
-                raise HTTPException(status_code=499, detail="Client Disconnected")
-                
-            segment_dics = {'start': segment.start, 'end': segment.end, 'text': segment.text}
-            segment_results.append(segment_dics)
-            for word in segment.words:
-                if await request.is_disconnected():
-                    logger.info('クライアントとの接続が切断されました')
-                    raise HTTPException(status_code=499, detail="Client Disconnected")
-                print("[%.2fs -> %.2fs] %s" % (word.start, word.end, word.word))
-                word_dict = {'start': word.start, 'end': word.end, 'text': word.word}
-                word_results.append(word_dict)
-        
-        with open(Path(file_path).parent.parent / 'lyric.txt', 'w', encoding='utf-8') as txt:
-            json.dump({'segments': segment_results, 'word': word_results}, txt)
-    except HTTPException as http_exception:
-        raise http_exception 
+        # 文字起こしはイベントループを塞がないようにワーカースレッドで実行する
+        await asyncio.get_running_loop().run_in_executor(
+            executor, transcribe_lyric, file_path, body.language_code, cancel_event
+        )
+    except TranscriptionCancelledException:
+        raise HTTPException(status_code=499, detail="Client Disconnected")
     except Exception as e:
         print(f"エラーが発生:{e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        disconnection_task.cancel()
     
     end_time = datetime.now()
     duration = end_time - now
     logger.info(f"end:{end_time}, duration:{duration}")
-    return end_time
\ No newline at end of file
+    return end_time
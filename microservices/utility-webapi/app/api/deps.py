@@ -1,11 +1,22 @@
 import redis.asyncio
+from redis import Redis
 from app.core.config import settings, UPLOAD_FILE_CONTENT_TYPE
 from app.core.heavy_job import HeavyJob
-from app.models import Audiofile, ChordList, Consumer, ConsumerHeaders, Structure
+from app.core.notify_stream import NotifyStreamHub
+from app.core.redis_pool import CountingAsyncConnectionPool, CountingBlockingConnectionPool
+from app.services.audio_ingest import resolve_normalization_status
+from app.models import AUDIOFILE_METADATA_FILE_NAME, Audiofile, AudiofileMetadata, BeatSubdivision, ChordList, Consumer, ConsumerHeaders, Structure
 from fastapi import Depends, File, HTTPException, Header, Path as fastapi_path, Query, Request, UploadFile
 from pathlib import Path
+from typing import Optional
 
 def get_consumer_headers(consumer_id :str = Header(settings.ANONYMOUS_CONSUMER_NAME, alias=settings.HTTP_HEADER_CONSUMER_ID)) -> ConsumerHeaders:
+    if consumer_id == settings.ANALYSIS_STORE_DIRECTORY_NAME:
+        # 解析結果のストアはコンシューマーとして扱わない
+        raise HTTPException(
+            status_code=400,
+            detail='このコンシューマーIDは使用できません。'
+        )
     return ConsumerHeaders(consumer_id=consumer_id)
 
 def get_consumer(consumer_headers: ConsumerHeaders = Depends(get_consumer_headers)) -> Consumer:
@@ -24,7 +35,39 @@ def validate_audiofile(file: UploadFile = File(...)) -> UploadFile:
 def get_audiofile(audiofile_id: str = fastapi_path(...), audiofile: Audiofile = Depends(get_consumer)) -> Audiofile:
     audiofile_dir = Path(audiofile.consumer_directory, audiofile_id)
     audiofile_path = audiofile_dir / (f'{audiofile_id}.wav')
-    return Audiofile(**audiofile.model_dump(), audiofile_id=audiofile_id, audiofile_directory=audiofile_dir, audiofile_path=audiofile_path)
+    audio_hash = None
+    audio_info = None
+    normalization = 'done'
+    if (audiofile_dir / AUDIOFILE_METADATA_FILE_NAME).exists():
+        metadata = AudiofileMetadata.load_from_json_file(audiofile_dir / AUDIOFILE_METADATA_FILE_NAME)
+        audio_hash = metadata.sha256
+        audio_info = metadata.audio
+        normalization = metadata.normalization
+    return Audiofile(
+        **audiofile.model_dump(), 
+        audiofile_id=audiofile_id, 
+        audiofile_directory=audiofile_dir, 
+        audiofile_path=audiofile_path, 
+        audio_hash=audio_hash, 
+        audio_info=audio_info,
+        normalization=normalization
+    )
+
+def get_normalized_audiofile(audiofile: Audiofile = Depends(get_audiofile)) -> Audiofile:
+    """wavへの正規化が完了したオーディオファイルを取得する。音声を解析するエンドポイントで使う。"""
+    # 変換ジョブが失われて'pending'のまま残っている場合は'failed'になる
+    audiofile.normalization = resolve_normalization_status(get_redis_pool(), audiofile)
+    if audiofile.normalization == 'pending':
+        raise HTTPException(
+            status_code=409,
+            detail='オーディオファイルをwavに変換中です。完了してから再度リクエストしてください。'
+        )
+    if audiofile.normalization == 'failed':
+        raise HTTPException(
+            status_code=422,
+            detail='オーディオファイルをwavに変換できませんでした。'
+        )
+    return audiofile
 
 def get_chords(audiofile: Audiofile = Depends(get_audiofile)) -> ChordList:
     chord_directory = audiofile.audiofile_directory / 'chord'
@@ -38,23 +81,26 @@ def get_chords(audiofile: Audiofile = Depends(get_audiofile)) -> ChordList:
 
 def get_structure(
         audiofile: Audiofile = Depends(get_audiofile), 
-        eighth_beat: bool = Query(False, alias='eighth-beat')
+        eighth_beat: bool = Query(False, alias='eighth-beat'),
+        beat_subdivision: Optional[BeatSubdivision] = Query(None, alias='beat-subdivision', description='eighth-beatより優先される')
 ) -> Structure:
+    if beat_subdivision is None and eighth_beat:
+        beat_subdivision = 'eighth'
     try:
-        structure = Structure.load_from_json_file(audiofile.audiofile_directory / 'structure' / 'structure.json')
+        # 分割結果はファイルの更新時刻と分割方法毎に保持されている
+        return Structure.load_subdivided_from_json_file(audiofile.audiofile_directory / 'structure' / 'structure.json', beat_subdivision)
     except FileNotFoundError:
         raise HTTPException(
             status_code=400,
             detail='音楽構造の解析結果が見つかりません。'
         )
-    return structure.convert_splited_beats_into_eighths() if eighth_beat else structure
 
 _redis_pool = None
 def get_redis_asyncio_pool():
     global _redis_pool
     if _redis_pool is None:
         _redis_pool = redis.asyncio.Redis.from_pool(
-            redis.asyncio.ConnectionPool(
+            CountingAsyncConnectionPool(
                 host=settings.REDIS_HOST, 
                 port=settings.REDIS_PORT,
                 decode_responses=True,
@@ -67,9 +113,46 @@ def get_redis_asyncio_pool():
     print('最大接続数：' ,_redis_pool.connection_pool.max_connections)
     return _redis_pool
 
+_redis_sync_pool = None
+def get_redis_pool() -> Redis:
+    """プロセス全体で共有する同期Redisのコネクションプールを取得する。
+
+    RQのQueueやJobはdecode_responses=Falseのコネクションを前提とする。
+    プールが上限に達した場合は、コネクションが返却されるまで待つ。
+    """
+    global _redis_sync_pool
+    if _redis_sync_pool is None:
+        _redis_sync_pool = Redis.from_pool(
+            CountingBlockingConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                health_check_interval=10,
+                socket_connect_timeout=5,
+                retry_on_timeout=True,
+                socket_keepalive=True
+            )
+        )
+    return _redis_sync_pool
+
+def get_redis_pool_stats() -> dict:
+    """同期・非同期それぞれのRedisのコネクションプールの使用状況を返す。"""
+    return {
+        'sync': get_redis_pool().connection_pool.stats(),
+        'asyncio': get_redis_asyncio_pool().connection_pool.stats()
+    }
+
+_notify_stream_hub = None
+def get_notify_stream_hub() -> NotifyStreamHub:
+    global _notify_stream_hub
+    if _notify_stream_hub is None:
+        _notify_stream_hub = NotifyStreamHub(get_redis_asyncio_pool())
+    return _notify_stream_hub
+
 def get_heavy_job() -> HeavyJob:
     return HeavyJob(
-        redis_host=settings.REDIS_HOST, 
-        redis_port=settings.REDIS_PORT, 
+        redis_conn=get_redis_pool(), 
         redis_asyncio_conn= get_redis_asyncio_pool(), 
+        notify_stream_hub=get_notify_stream_hub(),
     )
\ No newline at end of file
@@ -1,16 +1,19 @@
 import asyncio
 import os
 import shutil
-from typing import Literal
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from typing import Literal, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
 from fastapi.responses import FileResponse
 from sse_starlette import EventSourceResponse
-from app.api.deps import get_audiofile, get_heavy_job
+from app.api.deps import get_audiofile, get_heavy_job, get_normalized_audiofile
+from app.core.derived_artifact import DerivedArtifactCache, sweep_stale_artifacts
 from app.core.heavy_job import ApiJob, HeavyJob
-from app.models import Audiofile, Structure
+from app.core.range_file_response import RangeFileResponse
+from app.models import Audiofile, BeatSubdivision, Structure
 from app.core.config import settings
 
-from app.services.audio_conversion import AudioConversionService
+from app.services.audio_probe import get_audio_info
+from app.services.click_track import CLICK_DURATION, CLICK_SAMPLE_RATE, render_click_track, save_click_track
 
 router = APIRouter()
 
@@ -45,11 +48,13 @@ def spectrograms(request: Request, audiofile: Audiofile = Depends(get_audiofile)
         job_timeout=settings.ALLIN1_SPECTROGRAMS_JOB_TIMEOUT,
         request_body=request_body,
         request_read_timeout=settings.ALLIN1_SPECTROGRAMS_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('spectrograms'),
     )
 
-    job = job_router.submit_jobs([api_job])[0]
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs([api_job])
+    jobs = job_router.submit_jobs(api_jobs)
     return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
     )
 
 @router.delete("/spectrograms/{audiofile_id}")
@@ -64,7 +69,7 @@ async def delete_spectrograms(audiofile: Audiofile = Depends(get_audiofile)):
         )
     
 @router.post("/structure/{audiofile_id}")
-def analyze_structure(request: Request, audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse:
+def analyze_structure(request: Request, audiofile: Audiofile = Depends(get_normalized_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse:
     if os.path.exists(audiofile.audiofile_directory / 'structure'):
         raise HTTPException(
             status_code=400,
@@ -84,88 +89,148 @@ def analyze_structure(request: Request, audiofile: Audiofile = Depends(get_audio
         job_timeout=settings.ALLIN1_STRUCTURE_JOB_TIMEOUT,
         request_body=request_body,
         request_read_timeout=settings.ALLIN1_STRUCTURE_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('structure'),
     )
 
-    job = job_router.submit_jobs([api_job])[0]
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs([api_job])
+    jobs = job_router.submit_jobs(api_jobs)
     return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
     )
 
 @router.get("/structure/{audiofile_id}")
 def response_structure(
+    background_tasks: BackgroundTasks,
     audiofile: Audiofile = Depends(get_audiofile), 
     download_file_format: Literal['json', 'csv'] = Query('json', alias='download-file-format'),
     csv_data: Literal['beats', 'segments'] = Query(None, alias='csv-data'),
-    eighth_beat: bool = Query(False, alias='eighth-beat')
+    eighth_beat: bool = Query(False, alias='eighth-beat'),
+    beat_subdivision: Optional[BeatSubdivision] = Query(None, alias='beat-subdivision', description='eighth-beatより優先される')
 ):
     structure_directory = audiofile.audiofile_directory / 'structure'
+    structure_path = structure_directory / 'structure.json'
+    if beat_subdivision is None and eighth_beat:
+        beat_subdivision = 'eighth'
+    if download_file_format == 'csv' and not csv_data:
+        raise HTTPException(
+            status_code=400,
+            detail='"download-file-format=csv"の場合は、"csv-data"の入力が必須です。(beats または segments)'
+        )
+    if download_file_format == 'json' and beat_subdivision in (None, 'quarter'):
+        # 解析結果をそのまま返す
+        if not structure_path.exists():
+            raise HTTPException(
+                status_code=404,
+                detail='結果が見つかりませんでした。'
+            )
+        return FileResponse(
+            path=structure_path,
+            headers={"Content-Disposition": f'attachment; filename={audiofile.audiofile_id}_structure.json'}
+        )
+
+    stem = csv_data if download_file_format == 'csv' else f'structure_{beat_subdivision}'
+    # 変換したファイルは、音楽構造の解析結果とパラメータ毎にキャッシュする
     try:
-        structure = Structure.load_from_json_file(structure_directory / 'structure.json')
-        if eighth_beat:
-            structure = structure.convert_splited_beats_into_eighths()
+        cache = DerivedArtifactCache(
+            structure_directory / 'exports',
+            [structure_path],
+            {
+                'format': download_file_format,
+                'csv_data': csv_data if download_file_format == 'csv' else None,
+                'beat_subdivision': beat_subdivision or 'quarter'
+            }
+        )
     except FileNotFoundError:
         raise HTTPException(
             status_code=404,
             detail='結果が見つかりませんでした。'
         )
-    if download_file_format == 'csv':
-        if not csv_data:
-            raise HTTPException(
-                status_code=400,
-                detail='"download-file-format=csv"の場合は、"csv-data"の入力が必須です。(beats または segments)'
-            )
-        elif csv_data == 'beats':
-            stem = 'beats'
-            structure.to_csv(structure_directory / f'{stem}.csv', ['beats', 'beat_positions'])
-        elif csv_data == 'segments':
-            stem = 'segments'
-            structure.to_csv(structure_directory / f'{stem}.csv', ['segments'])
-    else:
-        stem = 'structure'
+    export_path = cache.path(f'{stem}.{download_file_format}')
+    if not export_path.exists():
+        structure = Structure.load_subdivided_from_json_file(structure_path, beat_subdivision)
+        with cache.build() as build_directory:
+            if csv_data == 'beats' and download_file_format == 'csv':
+                structure.to_csv(build_directory / export_path.name, ['beats', 'beat_positions'])
+            elif download_file_format == 'csv':
+                structure.to_csv(build_directory / export_path.name, ['segments'])
+            else:
+                # 分割したビートを含む音楽構造を保存する
+                structure.save_as_json_file(build_directory / export_path.name)
+        # 音楽構造の解析結果が変わった他のファイルは、レスポンスの送信後に削除する
+        background_tasks.add_task(sweep_stale_artifacts, cache.cache_directory)
     return FileResponse(
-        path=structure_directory / f'{stem}.{download_file_format}',
+        path=export_path,
         headers={"Content-Disposition": f'attachment; filename={audiofile.audiofile_id}_{stem}.{download_file_format}'}
     )
 
-@router.get('/structure/click-sound/{audiofile_id}')
+# クリック音の種類とテンポの倍率
+CLICK_SOUND_TEMPO_FACTORS = {
+    'normal': 1.0,
+    '2x': 2.0,
+    'half': 0.5
+}
+
+# クリック音の生成方法を変更した場合は上げる(既存のキャッシュを使わなくなる)
+CLICK_TRACK_VERSION = 1
+
+@router.get('/structure/click-sound/{audiofile_id}', description='音楽構造の解析結果のビートからクリック音を生成して返す。')
 def response_click_sound(
+    background_tasks: BackgroundTasks,
     audiofile: Audiofile = Depends(get_audiofile), 
     click_sound_type: Literal['normal', '2x', 'half'] = Query(default='normal', alias='click-sound-type'),
+    tempo_factor: Optional[float] = Query(None, gt=0.1, le=8.0, alias='tempo-factor', description='テンポの倍率。click-sound-typeより優先される'),
+    beat_click_freq: float = Query(1500, ge=20, le=20000, alias='beat-click-freq', description='ビートのクリック音の周波数(Hz)'),
+    downbeat_click_freq: float = Query(3000, ge=20, le=20000, alias='downbeat-click-freq', description='ダウンビートのクリック音の周波数(Hz)'),
     format: Literal['wav', 'mp3', 'ogg'] = Query(alias='format')
 ):
-    structure_directory = audiofile.audiofile_directory / 'structure'
-
-    # 初期はmp3ファイルしか存在しない
-    mp3_click_sound_path = structure_directory / f'clicks_{click_sound_type}.mp3'
+    structure_path = audiofile.audiofile_directory / 'structure' / 'structure.json'
+    if tempo_factor is None:
+        tempo_factor = CLICK_SOUND_TEMPO_FACTORS[click_sound_type]
+        file_stem = f'clicks_{click_sound_type}'
+    else:
+        file_stem = f'clicks_{tempo_factor:g}x'
 
-    if not os.path.exists(mp3_click_sound_path):
-        raise HTTPException(
-            status_code=404,
-            detail='結果が見つかりませんでした。'
-        )
-
-    # 実際にダウンロードされる拡張子のファイルパス
-    download_click_sound_path = mp3_click_sound_path.with_suffix(f'.{format}')
-    
-    if not format == 'mp3':
-        if not os.path.exists(download_click_sound_path):
-            AudioConversionService.convert_audiofile_to_format([mp3_click_sound_path], 'mp3', structure_directory, format)
+    # クリック音の長さは元の楽曲に合わせる
+    audio_info = get_audio_info(audiofile)
+    length = audio_info.frames_at(CLICK_SAMPLE_RATE) if audio_info is not None else None
 
+    # 生成したクリック音は、音楽構造の解析結果とパラメータ毎にキャッシュする
     try:
-        return FileResponse(
-            path=download_click_sound_path, 
-            media_type=MEDIA_TYPE[format],
-            headers={"Content-Disposition": f'attachment; filename={download_click_sound_path.stem}{download_click_sound_path.suffix}'})
+        cache = DerivedArtifactCache(
+            audiofile.audiofile_directory / 'structure' / 'clicks',
+            [structure_path],
+            {
+                'version': CLICK_TRACK_VERSION,
+                'tempo_factor': tempo_factor,
+                'beat_click_freq': beat_click_freq,
+                'downbeat_click_freq': downbeat_click_freq,
+                'length': length,
+                'format': format
+            }
+        )
     except FileNotFoundError:
         raise HTTPException(
             status_code=404,
             detail='結果が見つかりませんでした。'
         )
-    except Exception:
-        raise HTTPException(
-            status_code=500,
-            detail='不明なエラー。'  
-        )
+    click_sound_path = cache.path(f'{file_stem}.{format}')
+    if not click_sound_path.exists():
+        structure = Structure.load_from_json_file(structure_path)
+        if length is None:
+            # 楽曲の長さが分からない場合は、最後のセクションの終わりまでとする
+            last_time = max([segment.end for segment in structure.segments] + structure.beats + [0])
+            length = int((last_time + CLICK_DURATION) * CLICK_SAMPLE_RATE)
+        signal = render_click_track(structure, length, tempo_factor, beat_click_freq, downbeat_click_freq)
+        with cache.build() as build_directory:
+            save_click_track(signal, build_directory / click_sound_path.name)
+        # 音楽構造の解析結果が変わった他のクリック音は、レスポンスの送信後に削除する
+        background_tasks.add_task(sweep_stale_artifacts, cache.cache_directory)
+
+    return RangeFileResponse(
+        path=click_sound_path, 
+        media_type=MEDIA_TYPE[format],
+        headers={"Content-Disposition": f'attachment; filename={click_sound_path.name}'}
+    )
 
 @router.delete("/structure/{audiofile_id}")
 async def delete_structure(audiofile: Audiofile = Depends(get_audiofile)):
@@ -2,26 +2,29 @@ import os
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sse_starlette import EventSourceResponse
 
-from app.api.deps import get_audiofile, get_heavy_job
+from app.api.deps import get_heavy_job, get_normalized_audiofile
+from app.api.routes.demucs import fuse_spectrograms_job, get_separate_job, get_stem_transcode_job
 from app.api.routes.whisper import LanguageCode
 from app.core.config import settings
 from app.core.heavy_job import ApiJob, HeavyJob
 from app.models import Audiofile
+from app.services.stem_transcode import record_stem_transcode_job
 
 
 router = APIRouter()
 
 @router.get('/status')
 def getJobStatus(job_id: str, job_router: HeavyJob = Depends(get_heavy_job))-> EventSourceResponse: 
-    job = job_router.get_job(job_id)
+    # 同時にキューに入れたジョブ全体の状況を通知する
+    jobs = job_router.get_job_graph(job_id)
     return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+        job_router.stream_job_status(jobs=jobs)
     )
 
 @router.post('/process-audio/{audiofile_id}')
 def processAudio(
     request: Request, 
-    audiofile: Audiofile = Depends(get_audiofile), 
+    audiofile: Audiofile = Depends(get_normalized_audiofile), 
     job_router: HeavyJob = Depends(get_heavy_job),
     is_analyze_lyric: bool = Query(True, alias='is-analyze-lyric'),
     language_code: LanguageCode = Query(LanguageCode.ja, alias='language-code')
@@ -49,16 +52,9 @@ def processAudio(
             job_timeout=settings.CREMA_JOB_TIMEOUT,
             request_body={'file_path': str(audiofile.audiofile_path)},
             request_read_timeout=settings.CREMA_JOB_TIMEOUT,
+            cache_artifacts=audiofile.analysis_artifacts('chord'),
         ),
-        ApiJob(
-            job_name=settings.DEMUCS_JOB_NAME,
-            dst_api_url=f'http://{settings.DEMUCS_HOST}:{8000}',
-            queue_name=settings.DEMUCS_JOB_QUEUE,
-            request_path='/',
-            job_timeout=settings.DEMUCS_JOB_TIMEOUT,
-            request_body={'file_path': str(audiofile.audiofile_path)},
-            request_read_timeout=settings.DEMUCS_JOB_TIMEOUT,
-        ),
+        get_separate_job(audiofile),
         ApiJob(
             job_name=settings.ALLIN1_SPECTROGRAMS_JOB_NAME,
             dst_api_url=f'http://{settings.ALLIN1_HOST}:{8000}',
@@ -67,6 +63,8 @@ def processAudio(
             job_timeout=settings.ALLIN1_SPECTROGRAMS_JOB_TIMEOUT,
             request_body={'separated_path':str(audiofile.audiofile_directory / 'separated')},
             request_read_timeout=settings.ALLIN1_SPECTROGRAMS_JOB_TIMEOUT,
+            cache_artifacts=audiofile.analysis_artifacts('spectrograms'),
+            depends_on=[settings.DEMUCS_JOB_NAME],
         ),
         ApiJob(
             job_name=settings.ALLIN1_STRUCTURE_JOB_NAME,
@@ -76,6 +74,8 @@ def processAudio(
             job_timeout=settings.ALLIN1_STRUCTURE_JOB_TIMEOUT,
             request_body={"file_path":str(audiofile.audiofile_path), 'spectrograms_path':str(audiofile.audiofile_directory / 'spectrograms.npy')},
             request_read_timeout=settings.ALLIN1_STRUCTURE_JOB_TIMEOUT,
+            cache_artifacts=audiofile.analysis_artifacts('structure'),
+            depends_on=[settings.ALLIN1_SPECTROGRAMS_JOB_NAME],
         ),
     ]
     analyze_lyric_apijob = ApiJob(
@@ -86,11 +86,19 @@ def processAudio(
         job_timeout=settings.WHISPER_JOB_TIMEOUT,
         request_body={'file_path': str(audiofile.audiofile_directory / 'separated' / 'vocals.wav'), 'language_code': language_code},
         request_read_timeout=settings.WHISPER_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('lyric', variant=language_code.value),
+        # 分離したボーカルのみを使うため、音楽構造の解析とは並行して実行できる
+        depends_on=[settings.DEMUCS_JOB_NAME],
     )
     if is_analyze_lyric: 
         api_jobs.append(analyze_lyric_apijob)
+    api_jobs.append(get_stem_transcode_job(audiofile))
         
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs(api_jobs)
+    # 分離もスペクトログラム抽出も実行が必要な場合は、分離ジョブでスペクトログラムも抽出する
+    api_jobs = fuse_spectrograms_job(audiofile, api_jobs)
     jobs = job_router.submit_jobs(api_jobs)
+    record_stem_transcode_job(job_router.redis_conn, audiofile.audiofile_directory, jobs)
     return EventSourceResponse(
-        job_router.stream_job_status(job=jobs[0])
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
     )
\ No newline at end of file
@@ -1,40 +1,73 @@
 import asyncio
-import mimetypes
+import hashlib
+import os
 from pathlib import Path
 import shutil
 import anyio
+import anyio.to_thread
 import shortuuid
 from fastapi import APIRouter, Depends, HTTPException, UploadFile
-from app.models import Audiofile, AudiofileCreateResponse, Consumer
-from app.api.deps import get_audiofile, get_consumer, validate_audiofile
-from pydub import AudioSegment
+from app.core.config import settings
+from app.models import Audiofile, AudiofileCreateResponse, AudiofileMetadata, AudiofileStatusResponse, Consumer
+from app.api.deps import get_audiofile, get_consumer, get_heavy_job, validate_audiofile
+from app.core.heavy_job import HeavyJob, LocalJob
+from app.services.audio_ingest import record_normalize_job, resolve_normalization_status, save_audiofile_metadata
+from app.services.audio_probe import probe_audio
 
 router = APIRouter()
 
-@router.post("/", response_model=AudiofileCreateResponse, description='オーディオファイルをアップロードする。')
-async def save_audiofile(validated_file: UploadFile = Depends(validate_audiofile), consumer: Consumer = Depends(get_consumer)):
-    audiofile_stem = Path(validated_file.filename).stem
+def get_normalize_job(audiofile_path: Path, wav_audiofile_path: Path) -> LocalJob:
+    """アップロードされた音声をwavに変換するジョブ。"""
+    return LocalJob(
+        job_name=settings.NORMALIZE_JOB_NAME,
+        queue_name=settings.NORMALIZE_JOB_QUEUE,
+        func='app.services.audio_ingest.normalize_audiofile',
+        kwargs={'audiofile_path': str(audiofile_path), 'wav_audiofile_path': str(wav_audiofile_path)},
+        job_timeout=settings.NORMALIZE_JOB_TIMEOUT,
+    )
+
+@router.post("/", response_model=AudiofileCreateResponse, description='オーディオファイルをアップロードする。wav以外はワーカーでwavに変換され、完了はステータスで確認できる。')
+async def save_audiofile(validated_file: UploadFile = Depends(validate_audiofile), consumer: Consumer = Depends(get_consumer), job_router: HeavyJob = Depends(get_heavy_job)):
     audiofile_suffix = Path(validated_file.filename).suffix
 
-    
     audiofile_id = shortuuid.ShortUUID().random(length=7)
     audiofile_dir = Path(consumer.consumer_directory / audiofile_id)
     audiofile_dir.mkdir()
-    audiofile_path = audiofile_dir / (audiofile_id + audiofile_suffix)
-  
+    wav_audiofile_path = audiofile_dir / (audiofile_id + '.wav')
+    is_wav = validated_file.content_type == 'audio/wav'
+    audiofile_path = wav_audiofile_path if is_wav else audiofile_dir / (audiofile_id + audiofile_suffix)
+
+    # 受信しながらハッシュを計算する
+    sha256 = hashlib.sha256()
     async with await anyio.open_file(audiofile_path, 'wb') as buffer:
-        while chunk := await validated_file.read(2048):
+        while chunk := await validated_file.read(settings.UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
             await buffer.write(chunk)
-    
-    if validated_file.content_type != 'audio/wav':
-        if validated_file.content_type == 'audio/mpeg':
-            audio = AudioSegment.from_mp3(audiofile_path)
-        else:
-            audio = AudioSegment.from_file(audiofile_path, format=mimetypes.guess_extension(validated_file.content_type))
-        wav_audiofile_path = audiofile_dir / (audiofile_id + '.wav')
-        audio.export(wav_audiofile_path, format='wav')
-
-    return AudiofileCreateResponse(audiofile_id=audiofile_id)
+        await buffer.flush()
+        await anyio.to_thread.run_sync(os.fsync, buffer.wrapped.fileno())
+
+    # アップロードされたファイルのハッシュを解析結果のストアのキーとして記録
+    metadata = AudiofileMetadata(sha256=sha256.hexdigest(), normalization='pending')
+    if is_wav:
+        # 音声の長さ等を記録し、以降の処理で音声をデコードせずに済むようにする
+        metadata.audio = await asyncio.to_thread(probe_audio, wav_audiofile_path)
+        metadata.normalization = 'done'
+    await asyncio.to_thread(save_audiofile_metadata, metadata, audiofile_dir)
+
+    if not is_wav:
+        # wavへの変換はワーカーのジョブで行い、Webプロセスが再起動しても失われないようにする
+        jobs = await asyncio.to_thread(job_router.submit_jobs, [get_normalize_job(audiofile_path, wav_audiofile_path)])
+        await asyncio.to_thread(record_normalize_job, job_router.redis_conn, audiofile_dir, jobs)
+
+    return AudiofileCreateResponse(audiofile_id=audiofile_id, normalization=metadata.normalization)
+
+@router.get("/{audiofile_id}/status", response_model=AudiofileStatusResponse, description='オーディオファイルのwavへの正規化の状態を返す。')
+def response_audiofile_status(audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)):
+    return AudiofileStatusResponse(
+        audiofile_id=audiofile.audiofile_id,
+        normalization=resolve_normalization_status(job_router.redis_conn, audiofile),
+        audio=audiofile.audio_info
+    )
 
 @router.delete("/{audiofile_id}", description='オーディオファイルを削除する。')
 async def delete_audiofile(audiofile: Audiofile = Depends(get_audiofile)):
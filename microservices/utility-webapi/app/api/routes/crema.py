@@ -1,22 +1,25 @@
 import asyncio
 import os
 import shutil
+from pathlib import Path
 from typing import Literal
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
 from sse_starlette import EventSourceResponse
-from app.api.deps import get_audiofile, get_chords, get_heavy_job, get_structure
+from app.api.deps import get_audiofile, get_chords, get_heavy_job, get_structure, get_normalized_audiofile
+from app.core.derived_artifact import DerivedArtifactCache, sweep_stale_artifacts
+from app.core.range_file_response import RangeFileResponse
 from app.core.heavy_job import ApiJob, HeavyJob
 from app.models import Audiofile, ChordList, AdjustedChordList
 from app.core.config import settings
 from app.services.adjust_chord import adjust_chord_time
+from app.services.audio_probe import get_audio_info
 from app.services.chord_db import GuitarData
-from app.services.midi_generator import convert_chords_to_midi, convert_midi_to_audio, match_audio_length
+from app.services.midi_generator import convert_chords_to_midi, render_midi_to_audio
 
 router = APIRouter()
 
 @router.post("/chord/{audiofile_id}")
-def analyze_chord(request: Request, audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse:
+def analyze_chord(request: Request, audiofile: Audiofile = Depends(get_normalized_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse:
     if os.path.exists(audiofile.audiofile_directory / 'chord.json'):
         raise HTTPException(
             status_code=400,
@@ -32,11 +35,13 @@ def analyze_chord(request: Request, audiofile: Audiofile = Depends(get_audiofile
         job_timeout=settings.CREMA_JOB_TIMEOUT,
         request_body=request_body,
         request_read_timeout=settings.CREMA_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('chord'),
     )
 
-    job = job_router.submit_jobs([api_job])[0]
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs([api_job])
+    jobs = job_router.submit_jobs(api_jobs)
     return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
     )
 
 media_types = {
@@ -46,12 +51,58 @@ media_types = {
     'ogg': 'audio/ogg'
 }
 
+# 派生成果物の生成方法を変更した場合は上げる(既存のキャッシュを使わなくなる)
+DERIVED_CHORD_ARTIFACT_VERSION = 2
+
+def _build_chord_artifact(
+        build_directory: Path,
+        file_name: str,
+        audiofile: Audiofile,
+        apply_adjust_chord: bool,
+        eighth_beat: bool,
+        download_file_format: str,
+        gm_program_no: int
+):
+    """コード進行の解析結果から、ダウンロード形式の成果物をbuild_directoryに生成する。"""
+    chords = get_chords(audiofile)
+
+    if apply_adjust_chord or download_file_format in ('mid', 'ogg'):
+        structure = get_structure(audiofile, eighth_beat, None)
+
+        if apply_adjust_chord:
+            chords = adjust_chord_time(structure.beats, chords)
+
+        if download_file_format == 'mid':
+            convert_chords_to_midi(chords.chords, structure.bpm, gm_program_no, build_directory / f'{file_name}.mid')
+            return
+
+        if download_file_format == 'ogg':
+            # ダウンロードファイル形式がoggならmidiを音声に合成し、もとの楽曲の長さに合わせて保存する
+            midi = convert_chords_to_midi(chords.chords, structure.bpm, gm_program_no)
+            render_midi_to_audio(midi, build_directory / f'{file_name}.ogg', target_audio_info=get_audio_info(audiofile))
+            return
+
+    # コードDB形式に変換
+    guitar_data = GuitarData()
+    converted_chord_list = []
+    for chord in chords.chords:
+        chord.value = guitar_data.convert_shorthand_to_chords_json_format(chord.value)
+        converted_chord_list.append(chord)
+    if apply_adjust_chord:
+        converted_chord_model = AdjustedChordList(chords=converted_chord_list)
+    else:
+        converted_chord_model = ChordList(chords=converted_chord_list)
+    if download_file_format == 'csv':
+        converted_chord_model.to_csv(build_directory / f'{file_name}.csv')
+    else:
+        converted_chord_model.save_as_json_file(build_directory / f'{file_name}.json')
+
 @router.get('/chord/{audiofile_id}')
 def response_chord(
+    background_tasks: BackgroundTasks,
     apply_adjust_chord: bool = Query(True, alias='apply-adjust-chord'),
     eighth_beat: bool = Query(False, alias='eighth-beat'),
     audiofile: Audiofile = Depends(get_audiofile),
-    chords: ChordList = Depends(get_chords),
     download_file_format: Literal['json', 'csv', 'mid', 'ogg'] = Query('json', alias='download-file-format'),
     gm_program_no: int = Query(25, ge=0, le=127, description='General MIDIの音色番号', alias='gm-program-no')
 ):
@@ -60,48 +111,53 @@ def response_chord(
     file_stem = 'adjusted_' if apply_adjust_chord else ''
     file_stem += 'chord'
     eighth_stem = 'eighth_beat_' if eighth_beat else ''
-    
-    if apply_adjust_chord or download_file_format == 'mid' or 'ogg':
-        structure = get_structure(audiofile, eighth_beat)
-
-        if apply_adjust_chord:
-            chords = adjust_chord_time(structure.beats, chords)
-            chords.save_as_json_file(chord_directory / f'{file_stem}.json')
-
-        if download_file_format in ('mid', 'ogg'):
-            midi_save_path = chord_directory / f'{file_stem}.mid'
-            convert_chords_to_midi(chords.chords, structure.bpm, gm_program_no, midi_save_path)
-
-            if download_file_format == 'ogg':
-                # ダウンロードファイル形式がoggならmidiを音声ファイルに変換
-                audio_save_path = chord_directory / f'{file_stem}.ogg'
-                convert_midi_to_audio(midi_save_path, audio_save_path)
-                # 出力した音声をもとの楽曲の長さに合わせる
-                match_audio_length(audio_save_path, audiofile.audiofile_path, audio_save_path)
-    
-    if download_file_format == 'csv':
-        chords.to_csv(chord_directory / f'{file_stem}.csv')
-    
     if download_file_format in ('csv', 'json'):
-        # コードDB形式に変換
-        guitar_data = GuitarData()
-        converted_chord_list = []
-        converted_chord_model = None
         file_stem += '_converted_db_type'
-        for chord in chords.chords:
-            chord.value = guitar_data.convert_shorthand_to_chords_json_format(chord.value)
-            converted_chord_list.append(chord)
-        if apply_adjust_chord:
-            converted_chord_model = AdjustedChordList(chords=converted_chord_list)
-        else:
-            converted_chord_model = ChordList(chords=converted_chord_list)
-        if download_file_format == 'csv':
-            converted_chord_model.to_csv(chord_directory / f'{file_stem}.csv')
-        else:
-            converted_chord_model.save_as_json_file(chord_directory / f'{file_stem}.json')
+
+    # 成果物は入力ファイルの状態とパラメータをキーにキャッシュし、入力が変わらない限り再生成しない
+    uses_structure = apply_adjust_chord or download_file_format in ('mid', 'ogg')
+    chord_path = chord_directory / 'chord.json'
+    structure_path = audiofile.audiofile_directory / 'structure' / 'structure.json'
+    if not chord_path.exists():
+        raise HTTPException(
+            status_code=404,
+            detail='コード進行の解析結果が見つかりませんでした。'
+        )
+    if uses_structure and not structure_path.exists():
+        raise HTTPException(
+            status_code=400,
+            detail='音楽構造の解析結果が見つかりません。'
+        )
+    sources = [chord_path]
+    if uses_structure:
+        sources.append(structure_path)
+    if download_file_format == 'ogg':
+        sources.append(audiofile.audiofile_path)
+    params = {
+        'version': DERIVED_CHORD_ARTIFACT_VERSION,
+        'apply_adjust_chord': apply_adjust_chord,
+        'eighth_beat': eighth_beat if uses_structure else None,
+        'download_file_format': download_file_format,
+        'gm_program_no': gm_program_no if download_file_format in ('mid', 'ogg') else None,
+    }
+    try:
+        cache = DerivedArtifactCache(chord_directory / 'derived', sources, params)
+    except FileNotFoundError:
+        # キー計算中に解析結果が削除された
+        raise HTTPException(
+            status_code=404,
+            detail='コード進行の解析結果が見つかりませんでした。'
+        )
+
+    file_path = cache.path(f'{file_stem}.{download_file_format}')
+    if not file_path.exists():
+        with cache.build() as build_directory:
+            _build_chord_artifact(build_directory, file_stem, audiofile, apply_adjust_chord, eighth_beat, download_file_format, gm_program_no)
+        # 入力ファイルが変わった他の成果物は、レスポンスの送信後に削除する
+        background_tasks.add_task(sweep_stale_artifacts, cache.cache_directory)
         
-    return FileResponse(
-                path=chord_directory / f'{file_stem}.{download_file_format}',
+    return RangeFileResponse(
+                path=file_path,
                 media_type=media_types[download_file_format],
                 headers={"Content-Disposition": f'attachment; filename={audiofile.audiofile_id}_{eighth_stem}_{file_stem}.{download_file_format}'}
             )
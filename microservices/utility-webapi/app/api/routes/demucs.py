@@ -1,20 +1,20 @@
 import asyncio
-from pathlib import Path
-from typing import Literal
+from typing import Literal, Union
 import aiofiles
 import aiofiles.os
 from fastapi import APIRouter, HTTPException, Query, Request, Depends
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 import os
 import shutil
-import tempfile
-from pydub import AudioSegment
 from sse_starlette import EventSourceResponse
-from app.api.deps import get_heavy_job, get_audiofile
-from app.core.heavy_job import ApiJob, HeavyJob
+from app.api.deps import get_heavy_job, get_audiofile, get_normalized_audiofile
+from app.core.heavy_job import ApiJob, HeavyJob, LocalJob
+from app.core.range_file_response import RangeFileResponse
 from app.core.config import settings
 from app.models import Audiofile
-from app.services.audio_conversion import AudioConversionService
+from app.services.stem_archive import stream_separated_zip
+from app.services.stem_transcode import get_transcoded_stem_directory, is_stem_transcode_pending, record_stem_transcode_job, wait_for_transcoded_stem
+from app.services.transcode import stream_transcode_audio
 
 router = APIRouter()
 
@@ -25,37 +25,91 @@ MEDIA_TYPE = {
 }
 
 @router.post("/separated-audio/{audiofile_id}")
-def separate(request: Request, audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse: 
+def separate(request: Request, audiofile: Audiofile = Depends(get_normalized_audiofile), job_router: HeavyJob = Depends(get_heavy_job)) -> EventSourceResponse: 
     if os.path.exists(audiofile.audiofile_directory / 'separated'):
         raise HTTPException(
             status_code=400,
             detail='既に音声の分離がされています。'
         )
     
-    request_body = {'file_path': str(audiofile.audiofile_path)}
-    api_job = ApiJob(
+    api_job = get_separate_job(audiofile)
+
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs([api_job, get_stem_transcode_job(audiofile)])
+    jobs = job_router.submit_jobs(api_jobs)
+    record_stem_transcode_job(job_router.redis_conn, audiofile.audiofile_directory, jobs)
+    return EventSourceResponse(
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
+    )
+
+def get_separate_job(audiofile: Audiofile) -> ApiJob:
+    """音声を分離するジョブ。"""
+    return ApiJob(
         job_name=settings.DEMUCS_JOB_NAME,
         dst_api_url=f'http://{settings.DEMUCS_HOST}:{8000}',
         queue_name=settings.DEMUCS_JOB_QUEUE,
         request_path='/',
         job_timeout=settings.DEMUCS_JOB_TIMEOUT,
-        request_body=request_body,
+        request_body={'file_path': str(audiofile.audiofile_path)},
         request_read_timeout=settings.DEMUCS_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('separated'),
     )
 
-    job = job_router.submit_jobs([api_job])[0]
-    return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+def fuse_spectrograms_job(audiofile: Audiofile, api_jobs: list[Union[ApiJob, LocalJob]]) -> list[Union[ApiJob, LocalJob]]:
+    """分離ジョブとスペクトログラム抽出ジョブの両方を実行する場合に、抽出を分離ジョブで行うようにする。
+
+    分離したステムをメモリ上で受け取ってスペクトログラムを抽出するため、ステムを読み直す抽出ジョブは不要になる。
+    ストアから復元した後のジョブに対して使うため、分離結果とスペクトログラムはそれぞれ独立して復元される。
+    どちらかが復元できた場合や、DEMUCS_FUSED_SPECTROGRAMSが無効な場合はそのまま返す。
+
+    Args:
+        audiofile (Audiofile): 対象のオーディオファイル。
+        api_jobs (list[Union[ApiJob, LocalJob]]): 実行が必要なジョブのリスト。
+
+    Returns:
+        list[Union[ApiJob, LocalJob]]: スペクトログラム抽出ジョブを除き、依存先を分離ジョブに置き換えたジョブのリスト。
+    """
+    api_jobs_by_name = {api_job.job_name: api_job for api_job in api_jobs}
+    separate_job = api_jobs_by_name.get(settings.DEMUCS_JOB_NAME)
+    spectrograms_job = api_jobs_by_name.get(settings.ALLIN1_SPECTROGRAMS_JOB_NAME)
+    if not settings.DEMUCS_FUSED_SPECTROGRAMS or separate_job is None or spectrograms_job is None:
+        return api_jobs
+
+    fused_jobs = []
+    for api_job in api_jobs:
+        if api_job is spectrograms_job:
+            continue
+        if api_job is separate_job:
+            api_job = separate_job.model_copy(update={
+                'request_body': {**separate_job.request_body, 'spectrograms_path': str(audiofile.audiofile_directory / 'spectrograms.npy')},
+                'cache_artifacts': separate_job.cache_artifacts + spectrograms_job.cache_artifacts,
+            })
+        elif spectrograms_job.job_name in api_job.depends_on:
+            api_job = api_job.model_copy(update={
+                'depends_on': [settings.DEMUCS_JOB_NAME if job_name == spectrograms_job.job_name else job_name for job_name in api_job.depends_on]
+            })
+        fused_jobs.append(api_job)
+    return fused_jobs
+
+def get_stem_transcode_job(audiofile: Audiofile) -> LocalJob:
+    """音声の分離後に、全てのステムをダウンロード用の形式に変換するジョブ。"""
+    return LocalJob(
+        job_name=settings.STEM_TRANSCODE_JOB_NAME,
+        queue_name=settings.STEM_TRANSCODE_JOB_QUEUE,
+        func='app.services.stem_transcode.transcode_stems',
+        kwargs={'audiofile_directory': str(audiofile.audiofile_directory), 'formats': settings.STEM_TRANSCODE_FORMATS},
+        job_timeout=settings.STEM_TRANSCODE_JOB_TIMEOUT,
+        depends_on=[settings.DEMUCS_JOB_NAME],
     )
 
 @router.get('/separated-audio/stem/{audiofile_id}')
-def response_stem_audio(
+async def response_stem_audio(
     audiofile: Audiofile = Depends(get_audiofile),
     stem: Literal['vocals', 'drums', 'bass', 'guitar', 'piano', 'other'] = Query(alias='stem'),
-    format: Literal['wav', 'mp3', 'ogg'] = Query(alias='format')
+    format: Literal['wav', 'mp3', 'ogg'] = Query(alias='format'),
+    job_router: HeavyJob = Depends(get_heavy_job)
 ):
     separated_path = audiofile.audiofile_directory / 'separated'
-    if not os.path.exists(separated_path):
+    if not await aiofiles.os.path.exists(separated_path):
         raise HTTPException(
             status_code=400,
             detail='音声の分離結果が存在しません。'
@@ -64,52 +118,51 @@ def response_stem_audio(
         stem = 'other_6s'
 
     if format == 'wav':
-        response_directory = separated_path
+        stem_path = separated_path / f'{stem}.wav'
     else:
-        response_directory = audiofile.audiofile_directory / f'separated_{format}'
-        if not os.path.exists(response_directory / f'{stem}.{format}'):
-            # 保存ディレクトリが存在しない場合、変換処理を行う
-            if not os.path.exists(response_directory):
-                os.mkdir(response_directory)
-            
-            AudioConversionService.convert_audiofile_to_format([separated_path / f'{stem}.wav'], 'wav', response_directory, format)
-           
-            '''
-            input_files = [
-                separated_path / 'vocals.wav',
-                separated_path / 'drums.wav',
-                separated_path / 'bass.wav',
-                separated_path / 'guitar.wav',
-                separated_path / 'piano.wav',
-                separated_path / 'other_6s.wav',
-            ]
-            '''
-    try:
-        return FileResponse(
-            path=response_directory / f'{stem}.{format}',
-            media_type=MEDIA_TYPE[format],
-            headers={"Content-Disposition": f'attachment; filename={stem}.{format}'}
-        )
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=500,
-            detail='ファイルが見つかりませんでした。'
-        )
+        stem_path = get_transcoded_stem_directory(audiofile.audiofile_directory, format) / f'{stem}.{format}'
+        # 変換ジョブが実行中であれば、同じファイルを重複して変換しないよう完了を待つ
+        if not await wait_for_transcoded_stem(job_router.redis_conn, audiofile.audiofile_directory, stem_path):
+            if await asyncio.to_thread(is_stem_transcode_pending, job_router.redis_conn, audiofile.audiofile_directory):
+                raise HTTPException(
+                    status_code=503,
+                    detail='ステムの変換中です。しばらくしてから再度お試しください。',
+                    headers={'Retry-After': '10'}
+                )
+            # 変換ジョブがない(失敗した等)場合は、変換しながら送る。変換結果は保存され、以降はファイルとして返す
+            stem_path.parent.mkdir(exist_ok=True)
+            return StreamingResponse(
+                stream_transcode_audio(separated_path / f'{stem}.wav', stem_path),
+                media_type=MEDIA_TYPE[format],
+                headers={"Content-Disposition": f'attachment; filename={stem}.{format}'}
+            )
+    return RangeFileResponse(
+        path=stem_path,
+        media_type=MEDIA_TYPE[format],
+        headers={"Content-Disposition": f'attachment; filename={stem}.{format}'}
+    )
     
-@router.get('/separated-audio/{audiofile_id}')
-def response_separated_audio(request: Request, audiofile: Audiofile = Depends(get_audiofile)):
+@router.get('/separated-audio/{audiofile_id}', description='全てのステムをmp3にしたZIPを返す。初回は生成しながら返す。')
+def response_separated_audio(audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)):
     separated_zip_path = audiofile.audiofile_directory / 'separated.zip'
+    headers = {"Content-Disposition": f'attachment; filename={audiofile.audiofile_id}_separated.zip'}
     if os.path.exists(separated_zip_path):
-        return FileResponse(
+        return RangeFileResponse(
             path=separated_zip_path, 
             media_type='application/zip', 
-            headers={"Content-Disposition": f'attachment; filename={audiofile.audiofile_id}_separated.zip'}
+            headers=headers
         )
-    else:
+    if not os.path.exists(audiofile.audiofile_directory / 'separated'):
         raise HTTPException(
             status_code=400,
-            detail='圧縮する必要があります。'
+            detail='音声の分離結果が存在しません。'
         )
+    # ステムの変換が終わった順にZIPに追加して送り、同時にキャッシュファイルに保存する
+    return StreamingResponse(
+        stream_separated_zip(job_router.redis_conn, audiofile.audiofile_directory, separated_zip_path),
+        media_type='application/zip',
+        headers=headers
+    )
 
 @router.delete('/separated-audio/{audiofile_id}')
 async def delete_separated_audio(audiofile: Audiofile = Depends(get_audiofile)):
@@ -120,56 +173,14 @@ async def delete_separated_audio(audiofile: Audiofile = Depends(get_audiofile)):
     if await aiofiles.os.path.exists(audiofile.audiofile_directory / 'separated.zip'):
         await aiofiles.os.remove(audiofile.audiofile_directory / 'separated.zip')
         delete_count += 1
+    for format in MEDIA_TYPE:
+        # 変換済みのステム
+        transcoded_stem_directory = get_transcoded_stem_directory(audiofile.audiofile_directory, format)
+        if await aiofiles.os.path.exists(transcoded_stem_directory):
+            await asyncio.to_thread(shutil.rmtree, transcoded_stem_directory)
     if delete_count == 0:
         raise HTTPException(
             status_code=404,
             detail='音声の分離結果が存在しません。'
         )
     return('ok')
-
-@router.post('/separated-audio/compression/{audiofile_id}', description='処理結果を圧縮する。')
-def compression_separated_audio(request: Request, audiofile: Audiofile = Depends(get_audiofile), job_router: HeavyJob = Depends(get_heavy_job)):
-    separated_path = audiofile.audiofile_directory / 'separated'
-    separated_zip_path = audiofile.audiofile_directory / 'separated.zip'
-    if os.path.exists(separated_zip_path):
-        raise HTTPException(
-            status_code=400,
-            detail='既に圧縮が完了しています。'
-        )
-    elif os.path.exists(separated_path):
-        api_job = ApiJob(
-            job_name=settings.COMPRESSION_JOB_NAME,
-            dst_api_url=f'http://{settings.COMPRESSION_HOST}:{8000}',
-            queue_name=settings.COMPRESSION_JOB_QUEUE,
-            request_path=f'/demucs/separated-audio/{audiofile.audiofile_id}/zip',
-            job_timeout=settings.COMPRESSION_JOB_TIMEOUT,
-            request_headers={settings.HTTP_HEADER_CONSUMER_ID:audiofile.consumer_id},
-            request_read_timeout=settings.COMPRESSION_JOB_TIMEOUT,
-        )
-        job = job_router.submit_jobs([api_job])[0]
-        return EventSourceResponse(
-            job_router.stream_job_status(job=job)
-        )
-        
-    else:
-        raise HTTPException(
-            status_code=400,
-            detail='音声の分離が完了していません。'
-        )
-    
-@router.post('/separated-audio/{audiofile_id}/zip', description='内部処理用のため非公開。処理結果をZIP圧縮する。')
-def zip_separated_audio(request: Request, audiofile: Audiofile = Depends(get_audiofile)) -> EventSourceResponse:
-    if '127.0.0.1' != request.client[0]:
-        raise HTTPException(
-            status_code=404,
-            detail='Not Found.'
-        )
-    separated_path = audiofile.audiofile_directory / 'separated'
-    with tempfile.TemporaryDirectory() as tmp_dir:
-            for f in os.listdir(separated_path):
-                if f == 'other.wav':
-                    continue
-                wav_audio = AudioSegment.from_wav(separated_path / f)
-                wav_audio.export(Path(tmp_dir) / (Path(f).stem + '.mp3'), format='mp3')
-            shutil.make_archive(separated_path, 'zip', tmp_dir)
-    return 'ok'
\ No newline at end of file
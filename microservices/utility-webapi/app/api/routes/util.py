@@ -1,7 +1,22 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+from app.api.deps import get_heavy_job, get_redis_pool_stats
+from app.core.dispatch_client import get_dispatch_overhead_stats
+from app.core.heavy_job import HeavyJob
 
 router = APIRouter()
 
 @router.get('/server-status', description='okを返すだけ。')
 def responseOk():
-    return {'status': 'ok'}
\ No newline at end of file
+    return {'status': 'ok'}
+
+@router.get('/analysis-store', description='解析結果のストアのヒット率を返す。')
+def responseAnalysisStoreStats(job_router: HeavyJob = Depends(get_heavy_job)):
+    return job_router.analysis_store.stats()
+
+@router.get('/dispatch-overhead', description='宛先API毎の、リクエストの送信を開始するまでの平均時間とコネクションの再利用率を返す。')
+def responseDispatchOverheadStats(job_router: HeavyJob = Depends(get_heavy_job)):
+    return get_dispatch_overhead_stats(job_router.redis_conn)
+
+@router.get('/redis-pool', description='Redisのコネクションプールの使用状況を返す。')
+def responseRedisPoolStats():
+    return get_redis_pool_stats()
@@ -142,11 +142,13 @@ def analyze_lyric(
         job_timeout=settings.WHISPER_JOB_TIMEOUT,
         request_body=request_body,
         request_read_timeout=settings.WHISPER_JOB_TIMEOUT,
+        cache_artifacts=audiofile.analysis_artifacts('lyric', variant=language_code.value),
     )
 
-    job = job_router.submit_jobs([api_job])[0]
+    api_jobs, cached_api_jobs = job_router.restore_cached_jobs([api_job])
+    jobs = job_router.submit_jobs(api_jobs)
     return EventSourceResponse(
-        job_router.stream_job_status(job=job)
+        job_router.stream_job_status(jobs=jobs, cached_api_jobs=cached_api_jobs)
     )
 
 @router.get('/lyric/{audiofile_id}')
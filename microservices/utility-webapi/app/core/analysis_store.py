@@ -0,0 +1,136 @@
+"""解析結果のコンテンツアドレス型ストアを扱うモジュール。
+
+アップロードされた音声のハッシュをキーとして、完了した解析結果(分離音源、コード進行、
+スペクトログラム、音楽構造、歌詞)をコンシューマー間で共有するストアに格納します。
+同じ音声が再びアップロードされた場合は、ジョブを実行せずにストアからハードリンク(またはコピー)で復元します。
+
+ストアの構成:
+    {CONSUMER_VOLUME_PATH}/{ANALYSIS_STORE_DIRECTORY_NAME}/{音声のハッシュ}/{オーディオファイルディレクトリと同じ構成}
+"""
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+import shortuuid
+from redis import Redis
+from app.core.config import settings
+from app.models import AnalysisArtifact
+
+HITS_KEY = 'analysis_store:hits'
+MISSES_KEY = 'analysis_store:misses'
+
+def get_analysis_store_directory() -> Path:
+    return Path(settings.CONSUMER_VOLUME_PATH, settings.ANALYSIS_STORE_DIRECTORY_NAME)
+
+def calculate_file_hash(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """ファイルのSHA-256ハッシュを計算する。
+
+    Args:
+        file_path (Path): 対象のファイル。
+        chunk_size (int, optional): 一度に読み込むバイト数。
+
+    Returns:
+        str: 16進数表記のハッシュ。
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _link_or_copy(src: str, dst: str):
+    """ハードリンクを作成する。別のファイルシステムなどでリンクできない場合はコピーする。"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _place(src: Path, dst: Path):
+    """srcをdstに配置する。途中の状態が見えないように、一時パスに配置してからリネームする。
+
+    Raises:
+        FileExistsError: 既にdstが存在する。
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f'.{dst.name}.{shortuuid.uuid()}.tmp')
+    try:
+        if src.is_dir():
+            shutil.copytree(src, tmp, copy_function=_link_or_copy)
+        else:
+            _link_or_copy(src, tmp)
+        if dst.exists():
+            raise FileExistsError(dst)
+        os.rename(tmp, dst)
+    finally:
+        if tmp.is_dir():
+            shutil.rmtree(tmp)
+        elif tmp.exists():
+            os.remove(tmp)
+
+class AnalysisStore:
+    def __init__(self, store_directory: Path, redis_conn: Optional[Redis] = None):
+        """
+        Args:
+            store_directory (Path): ストアのルートディレクトリ。
+            redis_conn (Optional[Redis], optional): ヒット率を記録するためのRedisのコネクション。
+        """
+        self.store_directory = store_directory
+        self.redis_conn = redis_conn
+
+    def _store_path(self, artifact: AnalysisArtifact) -> Path:
+        return self.store_directory / artifact.audio_hash / artifact.store_relative_path
+
+    def _record_lookup(self, hit: bool):
+        if self.redis_conn is not None:
+            self.redis_conn.incr(HITS_KEY if hit else MISSES_KEY)
+
+    def restore(self, artifacts: list[AnalysisArtifact]) -> bool:
+        """ストアから解析結果をオーディオファイルディレクトリに復元する。
+
+        ジョブ1つ分の解析結果がすべてストアに揃っている場合のみ復元する。
+
+        Args:
+            artifacts (list[AnalysisArtifact]): 復元したい解析結果。
+
+        Returns:
+            bool: 復元できた場合はTrue。
+        """
+        if not artifacts:
+            return False
+        hit = all(self._store_path(artifact).exists() for artifact in artifacts)
+        self._record_lookup(hit)
+        if not hit:
+            return False
+        for artifact in artifacts:
+            try:
+                _place(self._store_path(artifact), artifact.audiofile_artifact_path)
+            except FileExistsError:
+                pass
+        return True
+
+    def publish(self, artifacts: list[AnalysisArtifact]):
+        """完了した解析結果をストアに格納する。既に格納済みの場合は何もしない。
+
+        Args:
+            artifacts (list[AnalysisArtifact]): 格納したい解析結果。
+        """
+        for artifact in artifacts:
+            src = artifact.audiofile_artifact_path
+            if not src.exists() or self._store_path(artifact).exists():
+                continue
+            try:
+                _place(src, self._store_path(artifact))
+            except FileExistsError:
+                # 別のジョブが先に格納した
+                pass
+
+    def stats(self) -> dict:
+        """ストアのヒット率を返す。"""
+        hits, misses = (int(v or 0) for v in self.redis_conn.mget(HITS_KEY, MISSES_KEY))
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else None
+        }
@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Optional
 from typing_extensions import Union
 
 TimeoutType = Union[int, float] | None
@@ -16,14 +17,22 @@ class Settings(BaseSettings):
     
     CONSUMER_VOLUME_PATH: str
 
+    # 解析結果を音声のハッシュで共有するストアのディレクトリ名(CONSUMER_VOLUME_PATH配下)
+    ANALYSIS_STORE_DIRECTORY_NAME: str = '.analysis_store'
+
     REDIS_HOST: str = 'redis'
     REDIS_PORT: int = 6379
+    # プロセス全体で共有する同期Redisのコネクションプールの上限と、空きを待つ秒数
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: int = 20
 
     # demucs-webapiの設定
     DEMUCS_HOST: str = 'demucs-webapi'
     DEMUCS_JOB_NAME: str = 'demucs'
     DEMUCS_JOB_QUEUE: str = 'gpu_queue'
     DEMUCS_JOB_TIMEOUT: TimeoutType = 300 # ジョブが実行されてからのタイムアウト時間
+    # 分離とスペクトログラム抽出を両方実行する場合は、分離と同時にallin1のスペクトログラムを抽出する(抽出ジョブを省く)
+    DEMUCS_FUSED_SPECTROGRAMS: bool = True
 
     # crema-webapiの設定
     CREMA_HOST: str = 'crema-webapi'
@@ -47,11 +56,18 @@ class Settings(BaseSettings):
     ALLIN1_STRUCTURE_JOB_QUEUE: str = 'gpu_queue'
     ALLIN1_STRUCTURE_JOB_TIMEOUT: TimeoutType = 120 # ジョブが実行されてからのタイムアウト時間
     
-    # zip圧縮webapiの設定
-    COMPRESSION_HOST: str = 'localhost'
-    COMPRESSION_JOB_NAME: str = 'compression'
-    COMPRESSION_JOB_QUEUE: str = 'cpu_queue'
-    COMPRESSION_JOB_TIMEOUT: TimeoutType = 120 # ジョブが実行されてからのタイムアウト時間
+    # アップロードされた音声をwavに変換するジョブの設定
+    NORMALIZE_JOB_NAME: str = 'normalize'
+    NORMALIZE_JOB_QUEUE: str = 'normalize_queue' # 他のCPUのジョブの後ろで待たないよう、専用のワーカーで実行する
+    NORMALIZE_JOB_TIMEOUT: TimeoutType = 300 # ジョブが実行されてからのタイムアウト時間
+
+    # 音声の分離後に、各ステムをダウンロード用の形式に変換するジョブの設定
+    STEM_TRANSCODE_JOB_NAME: str = 'stem_transcode'
+    STEM_TRANSCODE_JOB_QUEUE: str = 'cpu_queue'
+    STEM_TRANSCODE_JOB_TIMEOUT: TimeoutType = 300 # ジョブが実行されてからのタイムアウト時間
+    STEM_TRANSCODE_FORMATS: list[str] = ['mp3', 'ogg']
+    STEM_TRANSCODE_WORKERS: Optional[int] = None # 同時に実行する変換の数。未指定の場合はCPUのコア数
+    STEM_TRANSCODE_WAIT_TIMEOUT: float = 120.0 # 変換中のステムのダウンロードを待つ最大の秒数
 
     GPU_WORKER_QUEUE: str = 'gpu_queue'
     GPU_WORKER_MULTIPLICITY: int = 1
@@ -59,5 +75,32 @@ class Settings(BaseSettings):
     CPU_WORKER_QUEUE: str = 'cpu_queue'
     CPU_WORKER_MULTIPLICITY: int = 1
 
+    NORMALIZE_WORKER_QUEUE: str = 'normalize_queue'
+    NORMALIZE_WORKER_MULTIPLICITY: int = 1
+
+    # 全てのジョブを、ジョブ毎にワーカープロセスをフォークせずワーカープロセス内で実行する
+    # ジョブの異常終了やリークがワーカーごと巻き込むため、既定では無効(宛先APIへのリクエストのみワーカープロセス内で実行し、それ以外はフォークする)
+    RQ_SIMPLE_WORKER: bool = False
+
+    # 宛先APIへのリクエストに使うコネクションプールの設定(宛先API毎)
+    DISPATCH_MAX_CONNECTIONS: int = 10
+    DISPATCH_MAX_KEEPALIVE_CONNECTIONS: int = 5
+    DISPATCH_KEEPALIVE_EXPIRY: float = 300.0
+
+    # ジョブの通知ストリームに保持するおおよそのメッセージ数
+    NOTIFY_STREAM_MAXLEN: int = 10000
+
+    # アップロードを読み込む単位(バイト)
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+
+    # コード進行の音声を合成するシンセサイザーの設定。サウンドフォントはワーカー毎に常駐する
+    MIDI_SOUND_FONT_PATH: str = '/usr/share/sounds/sf2/FluidR3_GM.sf2'
+    MIDI_SYNTH_SAMPLE_RATE: int = 44100
+    MIDI_SYNTH_GAIN: float = 1.0
+    MIDI_SYNTH_WORKERS: int = 2
+
+    # 入力ファイルが変わった派生成果物のキャッシュを、古いと判定してから削除するまでの秒数
+    DERIVED_ARTIFACT_STALE_GRACE: float = 3600.0
+
     HTTP_HEADER_CONSUMER_ID: str = 'x_consumer_id'
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""解析結果から派生する成果物のキャッシュを扱うモジュール。
+
+調整済みのコード進行やMIDI、音声ファイルなど、解析結果とリクエストのパラメータから決まる成果物を、
+入力ファイルの状態とパラメータをキーとしたディレクトリに保存します。
+入力ファイルが更新されるとキーが変わるため、古い成果物は使われなくなります。
+
+成果物ごとに入力ファイルが異なるため(コード進行のjsonはchord.jsonのみ、oggは楽曲の音声も含む等)、
+各エントリは自身の入力ファイルの状態をマニフェストとして記録し、
+古くなったかどうかはエントリ自身の入力ファイルで判定します。
+古いエントリの削除は生成時には行わず、sweep_stale_artifactsで別に行います。
+
+キャッシュの構成:
+    {キャッシュディレクトリ}/{入力ファイルのダイジェスト}_{パラメータのダイジェスト}/{成果物}
+    {キャッシュディレクトリ}/{入力ファイルのダイジェスト}_{パラメータのダイジェスト}/.sources.json
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+import shortuuid
+from app.core.config import settings
+
+MANIFEST_FILE_NAME = '.sources.json'
+STALE_MARKER_FILE_NAME = '.stale'
+
+def _digest(data) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+def _source_stats(sources: list[Path]) -> list[list]:
+    """入力ファイルのパス、更新時刻、サイズのリストを返す。
+
+    Raises:
+        FileNotFoundError: 入力ファイルが存在しない。
+    """
+    source_stats = []
+    for source in sources:
+        stat = os.stat(source)
+        source_stats.append([str(source), stat.st_mtime_ns, stat.st_size])
+    return source_stats
+
+class DerivedArtifactCache:
+    def __init__(self, cache_directory: Path, sources: list[Path], params: dict):
+        """
+        Args:
+            cache_directory (Path): キャッシュのルートディレクトリ。
+            sources (list[Path]): 成果物の入力となるファイル。更新時刻とサイズをキーに含める。
+            params (dict): 成果物の生成に使うパラメータ。
+
+        Raises:
+            FileNotFoundError: 入力ファイルが存在しない。
+        """
+        self.cache_directory = cache_directory
+        self.source_stats = _source_stats(sources)
+        self.source_digest = _digest(self.source_stats)
+        self.params_digest = _digest(params)
+
+    @property
+    def directory(self) -> Path:
+        return self.cache_directory / f'{self.source_digest}_{self.params_digest}'
+
+    def path(self, file_name: str) -> Path:
+        return self.directory / file_name
+
+    @contextmanager
+    def build(self) -> Iterator[Path]:
+        """成果物を生成する一時ディレクトリを返し、生成に成功したらキャッシュとして配置する。
+
+        途中の状態が見えないよう、一時ディレクトリごとリネームする。
+        同時に同じ成果物が生成された場合は、先に配置された方を使う。
+        他のエントリは削除しない(配信中のファイルを消さないため)。
+        """
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        tmp_directory = self.cache_directory / f'.{self.directory.name}.{shortuuid.uuid()}.tmp'
+        tmp_directory.mkdir()
+        try:
+            yield tmp_directory
+            with open(tmp_directory / MANIFEST_FILE_NAME, 'w') as f:
+                json.dump(self.source_stats, f)
+            try:
+                os.rename(tmp_directory, self.directory)
+            except OSError:
+                if not self.directory.exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+def _is_stale(entry: Path) -> bool:
+    """エントリ自身の入力ファイルが、生成時から変わっているかどうか。"""
+    try:
+        with open(entry / MANIFEST_FILE_NAME) as f:
+            recorded = json.load(f)
+        return _source_stats([Path(source[0]) for source in recorded]) != recorded
+    except (FileNotFoundError, json.JSONDecodeError, IndexError, TypeError):
+        # マニフェストがない(導入前のエントリ等)、または入力ファイルが削除された
+        return True
+
+def sweep_stale_artifacts(cache_directory: Path, grace_seconds: float = None):
+    """入力ファイルが変わったエントリを削除する。
+
+    配信中のファイルを消さないよう、古いと判定したエントリにはまず印を付け、
+    印を付けてからgrace_seconds以上経過したものだけを削除する。
+    生成途中で残った一時ディレクトリも、同じ時間が経過していれば削除する。
+
+    Args:
+        cache_directory (Path): キャッシュのルートディレクトリ。
+        grace_seconds (float, optional): 削除までの猶予(秒)。未指定の場合はDERIVED_ARTIFACT_STALE_GRACE。
+    """
+    if grace_seconds is None:
+        grace_seconds = settings.DERIVED_ARTIFACT_STALE_GRACE
+    if not cache_directory.exists():
+        return
+    now = time.time()
+    for entry in cache_directory.iterdir():
+        try:
+            if entry.name.startswith('.'):
+                if now - entry.stat().st_mtime > grace_seconds:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            marker = entry / STALE_MARKER_FILE_NAME
+            if not _is_stale(entry):
+                continue
+            if not marker.exists():
+                marker.touch()
+            elif now - marker.stat().st_mtime > grace_seconds:
+                shutil.rmtree(entry, ignore_errors=True)
+        except FileNotFoundError:
+            # 並行して削除された
+            continue
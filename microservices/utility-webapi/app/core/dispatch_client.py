@@ -0,0 +1,101 @@
+"""ジョブの宛先APIへのリクエストに使うHTTPクライアントを扱うモジュール。
+
+RQワーカーのプロセス毎に、宛先API単位でhttpx.Clientを保持し、ジョブ間でコネクションを再利用します。
+route_jobはワーカープロセス内で実行されるため(app.worker.DispatchWorker)、クライアントはワーカープロセスが終了するまで残ります。
+また、リクエストの送信を開始するまでに掛かった時間(コネクションの取得・確立)を宛先API毎に計測します。
+"""
+import atexit
+import os
+import time
+from typing import Optional
+import httpx
+from redis import Redis
+from app.core.config import settings
+
+DISPATCH_OVERHEAD_KEY_PREFIX = 'dispatch_overhead:'
+
+# (プロセスID, 宛先APIのURL)をキーとするクライアント
+_clients: dict[tuple[int, str], httpx.Client] = {}
+
+def get_dispatch_client(base_url: str) -> httpx.Client:
+    """宛先APIへのリクエストに使うクライアントを取得する。
+
+    フォークされた子プロセスでは親プロセスのコネクションを使えないため、プロセスIDもキーに含める。
+
+    Args:
+        base_url (str): 宛先APIのURL。
+
+    Returns:
+        httpx.Client: コネクションプールを持つクライアント。
+    """
+    key = (os.getpid(), base_url)
+    client = _clients.get(key)
+    if client is None:
+        client = httpx.Client(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=settings.DISPATCH_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.DISPATCH_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.DISPATCH_KEEPALIVE_EXPIRY
+            )
+        )
+        _clients[key] = client
+    return client
+
+@atexit.register
+def close_dispatch_clients():
+    pid = os.getpid()
+    for (client_pid, base_url), client in list(_clients.items()):
+        if client_pid == pid:
+            client.close()
+            del _clients[(client_pid, base_url)]
+
+class DispatchTrace:
+    """httpxのtrace拡張として渡し、リクエストの送信を開始するまでの時間を計測する。"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.dispatch_seconds: Optional[float] = None
+        self.new_connection = False
+
+    def __call__(self, event_name: str, info: dict):
+        if event_name == 'connection.connect_tcp.started':
+            # プールに再利用できるコネクションがなかった
+            self.new_connection = True
+        elif event_name.endswith('.send_request_headers.started') and self.dispatch_seconds is None:
+            self.dispatch_seconds = time.perf_counter() - self.started_at
+
+def record_dispatch_overhead(redis_conn: Redis, base_url: str, trace: DispatchTrace):
+    """計測した時間を宛先API毎に集計する。
+
+    Args:
+        redis_conn (Redis): Redisのコネクション。
+        base_url (str): 宛先APIのURL。
+        trace (DispatchTrace): リクエストに渡したDispatchTrace。
+    """
+    if trace.dispatch_seconds is None:
+        return
+    host = httpx.URL(base_url).netloc.decode()
+    key = f'{DISPATCH_OVERHEAD_KEY_PREFIX}{host}'
+    pipeline = redis_conn.pipeline()
+    pipeline.hincrby(key, 'requests', 1)
+    pipeline.hincrby(key, 'new_connections', int(trace.new_connection))
+    pipeline.hincrbyfloat(key, 'total_seconds', trace.dispatch_seconds)
+    pipeline.execute()
+    print(f'宛先:{host}, 送信開始までの時間:{trace.dispatch_seconds:.4f}s, 新規コネクション:{trace.new_connection}')
+
+def get_dispatch_overhead_stats(redis_conn: Redis) -> dict:
+    """宛先API毎の、リクエストの送信を開始するまでの平均時間とコネクションの再利用率を返す。"""
+    stats = {}
+    for key in redis_conn.scan_iter(match=f'{DISPATCH_OVERHEAD_KEY_PREFIX}*'):
+        values = redis_conn.hgetall(key)
+        requests = int(values.get(b'requests', 0))
+        new_connections = int(values.get(b'new_connections', 0))
+        total_seconds = float(values.get(b'total_seconds', 0))
+        host = key.decode().removeprefix(DISPATCH_OVERHEAD_KEY_PREFIX)
+        stats[host] = {
+            'requests': requests,
+            'average_seconds': total_seconds / requests if requests else None,
+            'connection_reuse_rate': 1 - new_connections / requests if requests else None
+        }
+    return stats
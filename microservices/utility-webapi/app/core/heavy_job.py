@@ -10,8 +10,10 @@ from redis import Redis
 import redis.asyncio
 import redis.client
 from rq import Queue, Callback
-from rq.job import Job, JobStatus, Dependency
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus, Dependency, get_current_job
 from rq.results import Result
+from rq.utils import import_attribute
 import shortuuid
 import httpx
 from requests.exceptions import Timeout
@@ -19,12 +21,20 @@ import json
 from typing import Literal, Optional, Union
 from datetime import datetime, timezone
 from collections.abc import AsyncGenerator
+from contextlib import aclosing
+from graphlib import TopologicalSorter
 from pydantic import BaseModel
+from app.core.analysis_store import AnalysisStore, get_analysis_store_directory
+from app.core.config import settings
+from app.core.notify_stream import NotifyStreamHub
+from app.core.dispatch_client import DispatchTrace, get_dispatch_client, record_dispatch_overhead
+from app.models import AnalysisArtifact
 
 async def get_job_result(job: Job, sleep_time: Union[int, float]) -> Result:
     """ジョブの結果を待つ。
 
-    ジョブの結果をsleep_time間隔で取得する。
+    通知ストリームのメッセージにジョブの成否が含まれない場合(古い形式の通知)のみ使う。
+    ジョブの結果をsleep_time間隔で取得する。Redisへの同期的な問い合わせはスレッドで行う。
 
     Args:
         job (Job): Jobのインスタンス。
@@ -35,14 +45,19 @@ async def get_job_result(job: Job, sleep_time: Union[int, float]) -> Result:
     """
     while True:
         await asyncio.sleep(sleep_time)
-        job_result = job.latest_result()
-        print(job_result)
+        job_result = await asyncio.to_thread(job.latest_result)
         if job_result is not None:
             
             break
         print('Job Result is None')
     return job_result
 
+class JobCompletion(BaseModel):
+    """通知ストリームで受け取ったジョブの完了通知。"""
+    job_id: str
+    job_status: Literal['job success', 'job failed']
+    dependent_job_ids: list[str] = []
+
 def _datetime_to_stream_id(dt: datetime, sequence: Union[int, None] = 0) -> str:
     """datetimeをRedis StreamsのStreamId形式に変換する
 
@@ -58,7 +73,7 @@ def _datetime_to_stream_id(dt: datetime, sequence: Union[int, None] = 0) -> str:
         return str(timestamp_ms)
     return f"{timestamp_ms}-{sequence}"
 
-def _queue_name_to_stream_name(queue_name: str) -> str:
+def queue_name_to_stream_name(queue_name: str) -> str:
     return f'{queue_name}_notify_stream'
 
 def _notify_job(job: Job, connection, send_data: dict):
@@ -73,37 +88,74 @@ def _notify_job(job: Job, connection, send_data: dict):
     stream_id = _datetime_to_stream_id(datetime.now(timezone.utc), None)
 
     # 結果の通知先ストリームチャンネル名をキュー名から取得する
-    notify_stream_name = _queue_name_to_stream_name(job.meta.get('queue_name'))
+    notify_stream_name = queue_name_to_stream_name(job.meta.get('queue_name'))
 
-    s_id = connection.xadd(notify_stream_name, send_data, id=stream_id)
+    # ストリームが際限なく大きくならないよう、おおよその上限で古いメッセージを削除する
+    s_id = connection.xadd(notify_stream_name, send_data, id=stream_id, maxlen=settings.NOTIFY_STREAM_MAXLEN, approximate=True)
     print('メッセージを送信しました', 'sid:', s_id)
 
 def _notify_job_success(job: Job, connection, result, *args, **kwargs):
     """ジョブが成功したことを通知する。
 
     rqでジョブをキューに入れる際に、ジョブ成功後に呼び出されるコールバック関数として用いる。
+    コールバックの時点ではジョブの結果がまだ保存されていないため、成否と後続のジョブIDをメッセージに含める。
 
     Args:
         job (Job): jobのインスタンス。
         connection (_type_): Redisのコネクション。
         result (_type_): ジョブの結果。
     """
-    send_data = {'message':f"{job.id}"}
+    send_data = {
+        'message':f"{job.id}",
+        'job_status': 'job success',
+        'dependent_job_ids': json.dumps(job.meta.get('dependent_job_ids', []))
+    }
     _notify_job(job, connection, send_data)
 
+def _cancel_dependent_jobs(job: Job, connection):
+    """失敗したジョブの完了を待っているジョブは実行されることがないため、後続のジョブも含めてキャンセルする。
+
+    キャンセルしたジョブは、状況を追跡しているリクエストが'job canceled'として通知する。
+
+    Args:
+        job (Job): 失敗したジョブのインスタンス。
+        connection (_type_): Redisのコネクション。
+    """
+    dependent_job_ids = list(job.meta.get('dependent_job_ids', []))
+    canceled_job_ids = set()
+    while dependent_job_ids:
+        dependent_job_id = dependent_job_ids.pop()
+        if dependent_job_id in canceled_job_ids:
+            continue
+        canceled_job_ids.add(dependent_job_id)
+        try:
+            dependent_job = Job.fetch(dependent_job_id, connection)
+        except NoSuchJobError:
+            continue
+        if dependent_job.get_status() != JobStatus.DEFERRED:
+            continue
+        dependent_job.cancel()
+        dependent_job_ids.extend(dependent_job.meta.get('dependent_job_ids', []))
+
 def _notify_job_failure(job: Job, connection, type, value, traceback):
     """ジョブが失敗したことを通知する。
 
-    rqでジョブをキューに入れる際に、ジョブ成功後に呼び出されるコールバック関数として用いる。
+    rqでジョブをキューに入れる際に、ジョブ失敗後に呼び出されるコールバック関数として用いる。
+    後続のジョブのキャンセルもここで行うため、状況を追跡しているリクエストがなくても後続のジョブは残らない。
     
     Args:
         job (Job): jobのインスタンス。
         connection (_type_): Redisのコネクション。
-        type (_type_): _description_
-        value (_type_): _description_
-        traceback (_type_): _description_
+        type (_type_): 例外の型。
+        value (_type_): 例外。
+        traceback (_type_): トレースバック。
     """
-    send_data = {'message':f"{job.id}"}
+    send_data = {
+        'message':f"{job.id}",
+        'job_status': 'job failed',
+        'dependent_job_ids': json.dumps(job.meta.get('dependent_job_ids', []))
+    }
+    _cancel_dependent_jobs(job, connection)
     _notify_job(job, connection, send_data)
 
 class ApiJob(BaseModel):
@@ -116,22 +168,51 @@ class ApiJob(BaseModel):
     request_headers: dict = None
     request_body: dict = None
     request_read_timeout: Union[int, float] = None
+    cache_artifacts: list[AnalysisArtifact] = [] # ジョブ成功後にストアへ格納する解析結果
+    depends_on: list[str] = [] # 完了を待つ必要があるジョブのjob_name
 
-async def route_job(
+class LocalJob(BaseModel):
+    """宛先APIを介さず、ワーカープロセス内で関数を実行するジョブ。
+
+    ApiJobと同じくDAGに含めてキューに入れることができる。
+    """
+    job_name: str
+    queue_name: str
+    func: str # 実行する関数のインポートパス(例:'app.services.stem_transcode.transcode_stems')
+    kwargs: dict = {}
+    job_timeout: Union[int, str] = 60
+    cache_artifacts: list[AnalysisArtifact] = [] # ジョブ成功後にストアへ格納する解析結果
+    depends_on: list[str] = [] # 完了を待つ必要があるジョブのjob_name
+
+def run_local_job(
+    local_job: LocalJob,
+    dependent_job_ids: list[str],
+):
+    func = import_attribute(local_job.func)
+    func(**local_job.kwargs)
+    AnalysisStore(get_analysis_store_directory()).publish(local_job.cache_artifacts)
+    return {'dependent_job_ids': dependent_job_ids}
+
+def route_job(
     api_job: ApiJob,
-    next_job_id: Optional[str],
+    dependent_job_ids: list[str],
 ):
-    url = api_job.dst_api_url + api_job.request_path
+    # ワーカープロセスで保持しているクライアントを使い、宛先APIとのコネクションを再利用する
+    client = get_dispatch_client(api_job.dst_api_url)
+    trace = DispatchTrace()
     try:
-        async with httpx.AsyncClient() as client:
-            response: httpx.Response = await client.post(
-                url=url, 
-                json=api_job.request_body, 
-                headers=api_job.request_headers, 
-                timeout=(api_job.dst_api_connect_timeout, api_job.request_read_timeout)
-            )
-            response.raise_for_status()
-        return {'next_job_id': next_job_id}
+        response: httpx.Response = client.post(
+            url=api_job.request_path, 
+            json=api_job.request_body, 
+            headers=api_job.request_headers, 
+            timeout=(api_job.dst_api_connect_timeout, api_job.request_read_timeout),
+            extensions={'trace': trace}
+        )
+        record_dispatch_overhead(get_current_job().connection, api_job.dst_api_url, trace)
+        response.raise_for_status()
+        # 完了した解析結果を同じ音声の後続のアップロードで使えるようにストアに格納
+        AnalysisStore(get_analysis_store_directory()).publish(api_job.cache_artifacts)
+        return {'dependent_job_ids': dependent_job_ids}
     except Timeout as e:
         raise e
     except Exception as e:
@@ -140,12 +221,14 @@ async def route_job(
 class HeavyJob:
     def __init__(
         self,
-        redis_host: str,
-        redis_port: int,
+        redis_conn: Redis,
         redis_asyncio_conn: redis.asyncio.Redis,
+        notify_stream_hub: NotifyStreamHub,
     ):
-        self.redis_conn = Redis(redis_host, redis_port)
+        self.redis_conn = redis_conn
         self.redis_asyncio_conn = redis_asyncio_conn
+        self.notify_stream_hub = notify_stream_hub
+        self.analysis_store = AnalysisStore(get_analysis_store_directory(), self.redis_conn)
 
     async def response_queue_status_from_stream (
             self, 
@@ -153,26 +236,50 @@ class HeavyJob:
             job_id:str, 
             queue_position: Union[int, None], 
             enqueued_at:datetime
-    ) -> AsyncGenerator[int, None]:
+    ) -> AsyncGenerator[Union[int, JobCompletion], None]:
+        """通知ストリームを読み、キューの位置が変わる度にその位置を、最後にジョブの完了通知を返す。"""
         last_stream_id = _datetime_to_stream_id(enqueued_at)
-        while True:
-            messages = await self.redis_asyncio_conn.xread(streams={stream_name: last_stream_id}, count=100, block=0)
-            for stream, message_list in messages:
-                for message_id, message_body in message_list:
-                    src_stream_id = message_body['message']
-                    if src_stream_id == job_id:
-                        return
-                    if queue_position is not None:
-                        queue_position -= 1
-                        yield queue_position
-                    last_stream_id = message_id
+        # ストリームの読み込みはプロセス内で共有し、このジョブ宛てに配信されたメッセージを受け取る
+        async with aclosing(self.notify_stream_hub.subscribe(stream_name, job_id, last_stream_id)) as messages:
+            async for message_id, message_body in messages:
+                src_stream_id = message_body['message']
+                if src_stream_id == job_id:
+                    yield await self._to_job_completion(job_id, message_body)
+                    return
+                if queue_position is not None:
+                    queue_position -= 1
+                    yield queue_position
+
+    async def _to_job_completion(self, job_id: str, message_body: dict) -> JobCompletion:
+        if 'job_status' in message_body:
+            return JobCompletion(
+                job_id=job_id,
+                job_status=message_body['job_status'],
+                dependent_job_ids=json.loads(message_body['dependent_job_ids'])
+            )
+        # 成否を含まない古い形式の通知は、ジョブの結果から成否を判断する
+        job = await asyncio.to_thread(self.get_job, job_id)
+        job_result = await get_job_result(job, 0.1)
+        if job_result.type == Result.Type.SUCCESSFUL:
+            return JobCompletion(job_id=job_id, job_status='job success', dependent_job_ids=job_result.return_value['dependent_job_ids'])
+        return JobCompletion(job_id=job_id, job_status='job failed')
             
-    def _generate_job_status_message(self, job_name: str, job_id: str, job_status: Literal['processing soon', 'queued', 'enqueue success', 'job success', 'job failed', 'job completed'], queue_position: int = None) -> dict:
+    def _generate_job_status_message(
+        self,
+        job_name: str,
+        job_id: str,
+        job_status: Literal['processing soon', 'queued', 'enqueue success', 'job success', 'job failed', 'job canceled', 'job completed', 'cache hit'],
+        queue_position: int = None,
+        completed_jobs: int = None,
+        total_jobs: int = None
+    ) -> dict:
         data = {
             'job_name': job_name,
             'job_id': job_id,
             'job_status':job_status, 
-            'queue_position':queue_position
+            'queue_position':queue_position,
+            'completed_jobs': completed_jobs,
+            'total_jobs': total_jobs
         }
         
         return f"{json.dumps(data)}\n\n"
@@ -181,106 +288,200 @@ class HeavyJob:
         job = Job.fetch(job_id, self.redis_conn)
         return job
 
-    def submit_jobs(self, api_jobs: list[ApiJob]) -> list[Job]:
-        api_jobs_with_ids = [{'job_id': shortuuid.ShortUUID().random(length=10), 'api_job': api_job} for api_job in api_jobs]
-        job_list: list[Job] = []
-        for index, api_job_with_id in enumerate(api_jobs_with_ids):
+    def restore_cached_jobs(self, api_jobs: list[Union[ApiJob, LocalJob]]) -> tuple[list[Union[ApiJob, LocalJob]], list[Union[ApiJob, LocalJob]]]:
+        """解析結果がストアに存在するジョブは、実行せずにストアから結果を復元する。
+
+        Args:
+            api_jobs (list[Union[ApiJob, LocalJob]]): 実行したいジョブのリスト。
+
+        Returns:
+            tuple[list[Union[ApiJob, LocalJob]], list[Union[ApiJob, LocalJob]]]: 実行が必要なジョブのリストと、ストアから復元できたジョブのリスト。
+        """
+        remaining_api_jobs = []
+        cached_api_jobs = []
+        for api_job in api_jobs:
+            if self.analysis_store.restore(api_job.cache_artifacts):
+                cached_api_jobs.append(api_job)
+            else:
+                remaining_api_jobs.append(api_job)
+        print(f'キャッシュヒット:{[api_job.job_name for api_job in cached_api_jobs]}')
+        return remaining_api_jobs, cached_api_jobs
+
+    def submit_jobs(self, api_jobs: list[Union[ApiJob, LocalJob]]) -> list[Job]:
+        """ApiJob.depends_onに従って、ジョブをDAGとしてキューに入れる。
+
+        依存関係のないジョブは並行して実行される。
+        今回キューに入れるジョブに含まれない依存先(ストアから復元済みのジョブ等)は無視する。
+
+        Args:
+            api_jobs (list[Union[ApiJob, LocalJob]]): キューに入れたいジョブのリスト。
+
+        Returns:
+            list[Job]: キューに入れたジョブのリスト。依存先のジョブが先に来る順に並ぶ。
+        """
+        api_jobs_by_name = {api_job.job_name: api_job for api_job in api_jobs}
+        job_ids = {job_name: shortuuid.ShortUUID().random(length=10) for job_name in api_jobs_by_name}
+        depends_on = {
+            job_name: [depends_job_name for depends_job_name in api_job.depends_on if depends_job_name in api_jobs_by_name]
+            for job_name, api_job in api_jobs_by_name.items()
+        }
+        # 依存先のジョブから先にキューに入れる
+        sorted_job_names = list(TopologicalSorter(depends_on).static_order())
+        job_graph_ids = [job_ids[job_name] for job_name in sorted_job_names]
+
+        jobs: dict[str, Job] = {}
+        for job_name in sorted_job_names:
             depends_job = None
-            dependent_job_id = None
-            if index != 0:
-                # 先頭のジョブでなければ依存先のジョブをセット
-                depends_job = Dependency(jobs=[job_list[index - 1]])
-            if len(api_jobs_with_ids) -1 > index:
-                # 次に実行するジョブIDをセット
-                dependent_job_id = api_jobs_with_ids[index + 1]['job_id']
-            job = self._enqueue_job(api_job_with_id['api_job'], api_job_with_id['job_id'], depends_job, dependent_job_id)
-            job_list.append(job)
+            if depends_on[job_name]:
+                depends_job = Dependency(jobs=[jobs[depends_job_name] for depends_job_name in depends_on[job_name]])
+            # このジョブの完了を待っているジョブのID
+            dependent_job_ids = [job_ids[name] for name, depends_job_names in depends_on.items() if job_name in depends_job_names]
+            jobs[job_name] = self._enqueue_job(api_jobs_by_name[job_name], job_ids[job_name], depends_job, dependent_job_ids, job_graph_ids)
         
-        return job_list
+        return [jobs[job_name] for job_name in sorted_job_names]
 
-    def _enqueue_job(self, api_job: ApiJob, api_job_id: str, depends_job: Optional[Job], dependent_job_id: Optional[str]) -> Job:
+    def _enqueue_job(self, api_job: Union[ApiJob, LocalJob], api_job_id: str, depends_job: Optional[Dependency], dependent_job_ids: list[str], job_graph_ids: list[str]) -> Job:
         
         q = Queue(name=api_job.queue_name, connection=self.redis_conn)
 
-        job_kwargs = {
-            'next_job_id': dependent_job_id,
-            'api_job': api_job
-        }
+        if isinstance(api_job, LocalJob):
+            job_func = run_local_job
+            job_kwargs = {
+                'dependent_job_ids': dependent_job_ids,
+                'local_job': api_job
+            }
+        else:
+            job_func = route_job
+            job_kwargs = {
+                'dependent_job_ids': dependent_job_ids,
+                'api_job': api_job
+            }
 
         job_queue = q.enqueue(
-            f=route_job,
+            f=job_func,
             job_id=api_job_id,
             result_ttl=259200, # 3day
             job_timeout=api_job.job_timeout,
-            meta={'queue_name': api_job.queue_name, 'job_name': api_job.job_name},
+            meta={
+                'queue_name': api_job.queue_name,
+                'job_name': api_job.job_name,
+                'dependent_job_ids': dependent_job_ids,
+                'job_graph_ids': job_graph_ids # 同時にキューに入れたジョブ全体のID
+            },
             kwargs=job_kwargs,
             depends_on=depends_job,
             on_success=Callback(_notify_job_success),
             on_failure=Callback(_notify_job_failure))
         
         return job_queue
-    
-    async def stream_job_status(
-        self,
-        job: Job
-    ): 
-        current_status = job.get_status()
-        print(f'カレントステータス:{current_status}')
-        if current_status in (JobStatus.FAILED, JobStatus.CANCELED):
-            yield '中止された'
-
-        retry_count = 0
-        while (current_status == JobStatus.DEFERRED):
-            print('準備中')
-            if retry_count > 2:
-                yield 'タイムアウトしました'
+
+    def get_job_graph(self, job_id: str) -> list[Job]:
+        """ジョブと同時にキューに入れたジョブ全体を取得する。"""
+        job = self.get_job(job_id)
+        job_graph_ids = job.meta.get('job_graph_ids', [job_id])
+        return [job for job in Job.fetch_many(job_graph_ids, self.redis_conn) if job is not None]
+
+    async def _track_job(self, job: Job, message_queue: asyncio.Queue):
+        """1つのジョブの状況を追跡し、(ジョブ, ステータス, キューの位置)をmessage_queueに入れる。
+
+        最後に必ず'job success'、'job failed'、'job canceled'のいずれかを入れる。
+        """
+        job_id = job.get_id()
+        job_name = job.meta.get('job_name')
+        try:
+            # 依存先のジョブが完了するまではキューに入らないため、状態が変わるまで待つ
+            # Redisへの同期的な問い合わせでイベントループを止めないよう、スレッドで行う
+            current_status = await asyncio.to_thread(job.get_status)
+            while current_status == JobStatus.DEFERRED:
+                await asyncio.sleep(1.0)
+                current_status = await asyncio.to_thread(job.get_status)
+            print(f'カレントステータス:{current_status}')
+            if current_status in (JobStatus.CANCELED, JobStatus.STOPPED):
+                await message_queue.put((job, 'job canceled', None))
+                return
+            if current_status in (JobStatus.FINISHED, JobStatus.FAILED):
+                # 完了済みのジョブは、通知が古いメッセージとして削除されている場合があるため結果から成否を判断する
+                job_completion = await self._to_job_completion(job_id, {})
+                await message_queue.put((job, job_completion.job_status, None))
                 return
-            await asyncio.sleep(2.0)
-            current_status = job.get_status
-            retry_count += 1
-
-        while (True):
-            enqueued_at = job.enqueued_at
-            job_id = job.get_id()
-            job_name = job.meta.get('job_name')
-            #yield self._generate_job_status_message(job_name, job_id, 'enqueue success')
-            notify_stream_name = _queue_name_to_stream_name(job.origin)
-
-            queue_position = job.get_position()
+            # キューに入った時刻を反映する
+            await asyncio.to_thread(job.refresh)
+
+            notify_stream_name = queue_name_to_stream_name(job.origin)
+            queue_position = await asyncio.to_thread(job.get_position)
             print(f'job_name:{job_name}, queue_position:{queue_position}')
-            try:
-                if queue_position is None:
-                    # queue_positionが空の状態は、既に処理中であることを示す。
-                    yield self._generate_job_status_message(job_name, job_id, 'processing soon')
-
-                # queue_positionの初期値から現在のキューの位置を推定し、位置に変化がある度に通知する。
-                async for queue_position in self.response_queue_status_from_stream(notify_stream_name, job_id, queue_position, enqueued_at):
-                    if queue_position < 0:
+            if queue_position is None:
+                # queue_positionが空の状態は、既に処理中であることを示す。
+                await message_queue.put((job, 'processing soon', None))
+
+            # queue_positionの初期値から現在のキューの位置を推定し、位置に変化がある度に通知する。
+            # ジョブの成否も通知ストリームのメッセージで受け取る。
+            async with aclosing(self.response_queue_status_from_stream(notify_stream_name, job_id, queue_position, job.enqueued_at)) as events:
+                async for event in events:
+                    if isinstance(event, JobCompletion):
+                        await message_queue.put((job, event.job_status, None))
+                    elif event < 0:
                         # 0未満はキューを抜け出して、処理が始まることを示す。
-                        yield self._generate_job_status_message(job_name, job_id, 'processing soon')
+                        await message_queue.put((job, 'processing soon', None))
+                    else:
+                        await message_queue.put((job, 'queued', event))
+        except Exception as e:
+            print(f'ジョブの状況の取得に失敗しました job_id:{job_id}, {e}')
+            await message_queue.put((job, 'job failed', None))
+
+    async def stream_job_status(
+        self,
+        jobs: list[Job],
+        cached_api_jobs: list[Union[ApiJob, LocalJob]] = []
+    ):
+        """ジョブのDAG全体の状況を通知する。
+
+        各ジョブの状況を並行して追跡し、状況が変わった順に通知する。
+        通知には、DAG全体のうち完了したジョブの数が含まれる。
+        ジョブの状態は変更しない(失敗したジョブの後続のキャンセルはワーカーの_notify_job_failureで行う)。
+
+        Args:
+            jobs (list[Job]): 状況を通知するジョブ。submit_jobsの戻り値と同じく依存先が先に来る順に並ぶ。
+            cached_api_jobs (list[Union[ApiJob, LocalJob]], optional): ストアから復元したジョブ。
+        """
+        total_jobs = len(jobs) + len(cached_api_jobs)
+        completed_jobs = 0
+
+        # ストアから復元したジョブは完了済みとして通知
+        for api_job in cached_api_jobs:
+            completed_jobs += 1
+            yield self._generate_job_status_message(api_job.job_name, None, 'cache hit', completed_jobs=completed_jobs, total_jobs=total_jobs)
+        if not jobs:
+            if cached_api_jobs:
+                yield self._generate_job_status_message(cached_api_jobs[-1].job_name, None, 'job completed', completed_jobs=completed_jobs, total_jobs=total_jobs)
+            return
+
+        message_queue: asyncio.Queue[tuple[Job, str, Optional[int]]] = asyncio.Queue()
+        tasks = [asyncio.create_task(self._track_job(job, message_queue)) for job in jobs]
+        try:
+            finished_jobs = 0
+            has_failed = False
+            while finished_jobs < len(jobs):
+                job, job_status, queue_position = await message_queue.get()
+                if job_status in ('job success', 'job failed', 'job canceled'):
+                    finished_jobs += 1
+                    if job_status == 'job success':
+                        completed_jobs += 1
                     else:
-                        yield self._generate_job_status_message(job_name, job_id, 'queued', queue_position)
-
-                # すぐに結果が反映されないので、0.1秒待ってから結果を取得
-                job_result = await get_job_result(job, 0.1)
-                job_result_status = None
-                next_job_id = None
-                if job_result.type == Result.Type.SUCCESSFUL:
-                    job_result_status = 'job success'
-                    next_job_id = job_result.return_value['next_job_id']
-                else:
-                    job_result_status = 'job failed'
-                
-                # ジョブの成否を通知    
-                yield self._generate_job_status_message(job_name, job_id, job_result_status)
-                if job_result_status == 'job failed':
-                    break
-                
-                if next_job_id is None:
-                    yield self._generate_job_status_message(job_name, job_id, 'job completed')
-                    break
-                else:
-                    job = Job.fetch(next_job_id, self.redis_conn)
-            except asyncio.CancelledError as e:
-                print("クライアントからの接続が切れました")
-                break
\ No newline at end of file
+                        has_failed = True
+                yield self._generate_job_status_message(
+                    job.meta.get('job_name'), job.get_id(), job_status, queue_position,
+                    completed_jobs=completed_jobs, total_jobs=total_jobs
+                )
+
+            if not has_failed:
+                last_job = jobs[-1]
+                yield self._generate_job_status_message(
+                    last_job.meta.get('job_name'), last_job.get_id(), 'job completed',
+                    completed_jobs=completed_jobs, total_jobs=total_jobs
+                )
+        except asyncio.CancelledError as e:
+            print("クライアントからの接続が切れました")
+        finally:
+            for task in tasks:
+                task.cancel()
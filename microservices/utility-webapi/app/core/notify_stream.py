@@ -0,0 +1,109 @@
+"""ジョブの通知ストリームを購読者に配信するモジュール。
+
+通知ストリーム毎にバックグラウンドで1つだけXREADを行い、受け取ったメッセージを
+プロセス内の購読者(ジョブID毎のasyncio.Queue)に配信します。
+SSEのクライアント毎にXREADでRedisのコネクションを占有しないことが目的。
+"""
+import asyncio
+from collections.abc import AsyncGenerator
+import redis.asyncio
+
+# (ストリームID, メッセージ)
+StreamMessage = tuple[str, dict]
+
+def _parse_stream_id(stream_id: str) -> tuple[int, int]:
+    timestamp_ms, _, sequence = stream_id.partition('-')
+    return int(timestamp_ms), int(sequence or 0)
+
+class NotifyStreamHub:
+    def __init__(self, redis_asyncio_conn: redis.asyncio.Redis, block_ms: int = 5000):
+        """
+        Args:
+            redis_asyncio_conn (redis.asyncio.Redis): Redisのコネクション。decode_responses=Trueであること。
+            block_ms (int, optional): XREADで新しいメッセージを待つ時間。
+        """
+        self.redis_asyncio_conn = redis_asyncio_conn
+        self.block_ms = block_ms
+        self._readers: dict[str, asyncio.Task] = {}
+        self._reader_ready: dict[str, asyncio.Event] = {}
+        # ストリーム名 -> ジョブID -> 購読者のキュー
+        self._subscribers: dict[str, dict[str, set[asyncio.Queue[StreamMessage]]]] = {}
+
+    def start(self, stream_names: list[str]):
+        for stream_name in stream_names:
+            self._ensure_reader(stream_name)
+
+    async def close(self):
+        for task in self._readers.values():
+            task.cancel()
+        await asyncio.gather(*self._readers.values(), return_exceptions=True)
+        self._readers.clear()
+        self._reader_ready.clear()
+
+    def _ensure_reader(self, stream_name: str) -> asyncio.Event:
+        if stream_name not in self._readers:
+            self._reader_ready[stream_name] = asyncio.Event()
+            self._readers[stream_name] = asyncio.create_task(self._read(stream_name))
+        return self._reader_ready[stream_name]
+
+    async def _read(self, stream_name: str):
+        """ストリームを読み続け、メッセージを購読者に配信する。"""
+        # 読み始める位置を、現在ストリームにある最後のメッセージとする
+        while True:
+            try:
+                last_messages = await self.redis_asyncio_conn.xrevrange(stream_name, '+', '-', count=1)
+                break
+            except Exception as e:
+                print(f'通知ストリームの読み込みに失敗しました stream:{stream_name}, {e}')
+                await asyncio.sleep(1.0)
+        last_stream_id = last_messages[0][0] if last_messages else '0-0'
+        self._reader_ready[stream_name].set()
+        while True:
+            try:
+                messages = await self.redis_asyncio_conn.xread(streams={stream_name: last_stream_id}, count=100, block=self.block_ms)
+            except Exception as e:
+                print(f'通知ストリームの読み込みに失敗しました stream:{stream_name}, {e}')
+                await asyncio.sleep(1.0)
+                continue
+            for stream, message_list in messages:
+                for message_id, message_body in message_list:
+                    for queues in self._subscribers.get(stream_name, {}).values():
+                        for queue in queues:
+                            queue.put_nowait((message_id, message_body))
+                    last_stream_id = message_id
+
+    async def subscribe(self, stream_name: str, job_id: str, since_stream_id: str) -> AsyncGenerator[StreamMessage, None]:
+        """since_stream_idより後のメッセージを順に返す。
+
+        購読開始前に追加されたメッセージはXRANGEで読み直し、以降はバックグラウンドの読み込みから受け取る。
+        両者で重複したメッセージは除く。
+
+        Args:
+            stream_name (str): 通知ストリーム名。
+            job_id (str): 購読するジョブのID。
+            since_stream_id (str): このストリームIDより後のメッセージを返す。
+        """
+        ready = self._ensure_reader(stream_name)
+        await ready.wait()
+
+        queue: asyncio.Queue[StreamMessage] = asyncio.Queue()
+        self._subscribers.setdefault(stream_name, {}).setdefault(job_id, set()).add(queue)
+        try:
+            last_delivered_id = _parse_stream_id(since_stream_id)
+            for message_id, message_body in await self.redis_asyncio_conn.xrange(stream_name, min=since_stream_id, max='+'):
+                if _parse_stream_id(message_id) <= last_delivered_id:
+                    continue
+                last_delivered_id = _parse_stream_id(message_id)
+                yield message_id, message_body
+
+            while True:
+                message_id, message_body = await queue.get()
+                if _parse_stream_id(message_id) <= last_delivered_id:
+                    continue
+                last_delivered_id = _parse_stream_id(message_id)
+                yield message_id, message_body
+        finally:
+            job_subscribers = self._subscribers[stream_name]
+            job_subscribers[job_id].discard(queue)
+            if not job_subscribers[job_id]:
+                del job_subscribers[job_id]
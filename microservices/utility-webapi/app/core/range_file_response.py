@@ -0,0 +1,111 @@
+"""HTTPのRangeリクエストに対応したFileResponse。
+
+プレイヤーのシーク時に、ファイルの先頭から送り直さずに要求された範囲だけを206で返します。
+範囲が1つのリクエストのみ部分的に返し、複数の範囲が指定された場合はファイル全体を返します。
+"""
+import os
+import stat
+from typing import Optional
+import anyio
+import anyio.to_thread
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[tuple[int, int]]:
+    """Rangeヘッダーを解析し、返す範囲(先頭, 末尾)を返す。末尾を含む。
+
+    Returns:
+        Optional[tuple[int, int]]: ファイル全体を返す場合はNone。
+
+    Raises:
+        RangeNotSatisfiable: 範囲がファイルの外にある。
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    start, sep, end = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start == '':
+            # 末尾からのバイト数(bytes=-500)
+            suffix_length = int(end)
+            if suffix_length <= 0:
+                raise RangeNotSatisfiable()
+            return max(file_size - suffix_length, 0), file_size - 1
+        start = int(start)
+        end = int(end) if end else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or start > end:
+        raise RangeNotSatisfiable()
+    return start, min(end, file_size - 1)
+
+class RangeFileResponse(FileResponse):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(stat_result)
+            self.stat_result = stat_result
+        self.headers['accept-ranges'] = 'bytes'
+
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get('range')
+        if_range = request_headers.get('if-range')
+        # If-Rangeがファイルの現在のETagや更新日時と一致しない場合は、ファイル全体を返す
+        if range_header is None or (if_range is not None and if_range not in (self.headers.get('etag'), self.headers.get('last-modified'))):
+            return await super().__call__(scope, receive, send)
+
+        file_size = self.stat_result.st_size
+        try:
+            byte_range = parse_range_header(range_header, file_size)
+        except RangeNotSatisfiable:
+            await send({
+                'type': 'http.response.start',
+                'status': 416,
+                'headers': [(b'content-range', f'bytes */{file_size}'.encode('latin-1')), (b'content-length', b'0')],
+            })
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        if byte_range is None:
+            return await super().__call__(scope, receive, send)
+
+        start, end = byte_range
+        self.status_code = 206
+        self.headers['content-range'] = f'bytes {start}-{end}/{file_size}'
+        self.headers['content-length'] = str(end - start + 1)
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers,
+        })
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        else:
+            async with await anyio.open_file(self.path, mode='rb') as file:
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': remaining > 0,
+                    })
+                if remaining > 0:
+                    # 送信中にファイルが短くなった
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,73 @@
+"""使用状況を数えるRedisのコネクションプールを扱うモジュール。
+
+redis-pyのプールは使用状況を公開していないため、コネクションの生成・取得・返却を上書きして自身で数えます。
+"""
+import threading
+import redis.asyncio
+from redis import BlockingConnectionPool
+
+class CountingBlockingConnectionPool(BlockingConnectionPool):
+    """生成したコネクションと、使用中のコネクションの数を数える同期のプール。"""
+
+    def reset(self):
+        super().reset()
+        # 生成時のほか、フォーク後にも呼ばれるため、数もここで初期化する
+        self._stats_lock = threading.Lock()
+        self._created_connections = 0
+        self._in_use_connections = set()
+
+    def make_connection(self):
+        connection = super().make_connection()
+        with self._stats_lock:
+            self._created_connections += 1
+        return connection
+
+    def get_connection(self, *args, **kwargs):
+        connection = super().get_connection(*args, **kwargs)
+        with self._stats_lock:
+            self._in_use_connections.add(connection)
+        return connection
+
+    def release(self, connection):
+        with self._stats_lock:
+            # 取得に失敗した場合も返却されるため、取得済みのものだけを数から除く
+            self._in_use_connections.discard(connection)
+        super().release(connection)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created_connections': self._created_connections,
+                'in_use_connections': len(self._in_use_connections)
+            }
+
+class CountingAsyncConnectionPool(redis.asyncio.ConnectionPool):
+    """生成したコネクションと、使用中のコネクションの数を数える非同期のプール。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._created_connections = 0
+        self._in_use_connections = set()
+
+    def make_connection(self):
+        connection = super().make_connection()
+        self._created_connections += 1
+        return connection
+
+    async def get_connection(self, *args, **kwargs):
+        connection = await super().get_connection(*args, **kwargs)
+        self._in_use_connections.add(connection)
+        return connection
+
+    async def release(self, connection):
+        # 取得に失敗した場合も返却されるため、取得済みのものだけを数から除く
+        self._in_use_connections.discard(connection)
+        await super().release(connection)
+
+    def stats(self) -> dict:
+        return {
+            'max_connections': self.max_connections,
+            'created_connections': self._created_connections,
+            'in_use_connections': len(self._in_use_connections)
+        }
@@ -4,20 +4,41 @@ from contextlib import asynccontextmanager
 from app.worker import launch_workers, kill_worker
 from app.api.main import api_router
 from app.core.config import settings
-from app.api.deps import get_redis_asyncio_pool
+from app.api.deps import get_notify_stream_hub, get_redis_asyncio_pool, get_redis_pool
+from app.core.heavy_job import queue_name_to_stream_name
+from app.services.chord_db import load_guitar_chord_table
+from app.services.midi_generator import get_midi_synth_pool
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     
     app.state.redis_asyncio_conn = get_redis_asyncio_pool()
-    kill_worker()
+    app.state.redis_conn = get_redis_pool()
+    # ワーカーを起動する前にコードDBをプリコンパイルしておく
+    load_guitar_chord_table()
+    # コード進行の音声合成に使うサウンドフォントを読み込んでおく
+    try:
+        get_midi_synth_pool().preload()
+    except Exception as e:
+        print(f'シンセサイザーの準備に失敗しました:{e}')
+    # 通知ストリームの読み込みを開始
+    notify_stream_hub = get_notify_stream_hub()
+    notify_stream_hub.start([
+        queue_name_to_stream_name(settings.GPU_WORKER_QUEUE),
+        queue_name_to_stream_name(settings.CPU_WORKER_QUEUE),
+        queue_name_to_stream_name(settings.NORMALIZE_WORKER_QUEUE)
+    ])
+    kill_worker(app.state.redis_conn)
     launch_workers(queue_name=settings.GPU_WORKER_QUEUE, worker_multiplicity=settings.GPU_WORKER_MULTIPLICITY)
     launch_workers(queue_name=settings.CPU_WORKER_QUEUE, worker_multiplicity=settings.CPU_WORKER_MULTIPLICITY)
+    launch_workers(queue_name=settings.NORMALIZE_WORKER_QUEUE, worker_multiplicity=settings.NORMALIZE_WORKER_MULTIPLICITY)
 
     yield
     # 起動中のワーカーをキル
-    kill_worker()
+    kill_worker(app.state.redis_conn)
+    await notify_stream_hub.close()
     await app.state.redis_asyncio_conn.close()
+    app.state.redis_conn.close()
     
 app = FastAPI(
     lifespan=lifespan,
@@ -1,7 +1,8 @@
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
-from typing import List, TypeVar, Union
+from typing import List, Literal, Optional, TypeVar, Union
 from fastapi import HTTPException
 import numpy as np
 import pandas
@@ -26,13 +27,56 @@ class Consumer(ConsumerHeaders):
 class ConsumerCreate(ConsumerHeaders):
     pass
         
+# アップロードされた音声のwavへの正規化の状態
+NormalizationStatus = Literal['pending', 'done', 'failed']
+
 class AudiofileCreateResponse(BaseModel):
     audiofile_id: str
+    normalization: NormalizationStatus = 'done'
+
+# 解析結果をコンテンツアドレス型ストアに格納する単位と、オーディオファイルディレクトリからの相対パス
+ANALYSIS_ARTIFACT_PATHS = {
+    'separated': 'separated',
+    'chord': 'chord/chord.json',
+    'spectrograms': 'spectrograms.npy',
+    'structure': 'structure',
+    'lyric': 'lyric.txt',
+}
+
+class AnalysisArtifact(BaseModel):
+    audio_hash: str
+    audiofile_directory: Path
+    name: Literal['separated', 'chord', 'spectrograms', 'structure', 'lyric']
+    variant: Optional[str] = None # 歌詞解析の言語コードなど、同じ音声でも結果が変わる条件
+
+    @property
+    def audiofile_artifact_path(self) -> Path:
+        return self.audiofile_directory / ANALYSIS_ARTIFACT_PATHS[self.name]
+
+    @property
+    def store_relative_path(self) -> Path:
+        relative_path = Path(ANALYSIS_ARTIFACT_PATHS[self.name])
+        if self.variant is None:
+            return relative_path
+        return relative_path.with_name(f'{relative_path.stem}_{self.variant}{relative_path.suffix}')
+
+class AudioInfo(BaseModel):
+    duration: float # 秒
+    sample_rate: int
+    channels: int
+    frames: int
+
+    def frames_at(self, sample_rate: int) -> int:
+        """sample_rateにリサンプリングした場合のフレーム数。"""
+        return round(self.frames * sample_rate / self.sample_rate)
 
 class Audiofile(Consumer):
     audiofile_id: str
     audiofile_directory: Path
     audiofile_path: Path
+    audio_hash: Optional[str] = None
+    audio_info: Optional[AudioInfo] = None
+    normalization: NormalizationStatus = 'done'
 
     @field_validator('audiofile_directory', mode='before')
     def check_audiofile_directory_exists(cls, v:Path) -> Path:
@@ -44,6 +88,12 @@ class Audiofile(Consumer):
                 detail='音声ファイルディレクトリが存在しません。'
             )
 
+    def analysis_artifacts(self, name: str, variant: Optional[str] = None) -> List[AnalysisArtifact]:
+        """ジョブの結果をストアに格納するための情報を返す。音声のハッシュが無い場合は空のリストを返す。"""
+        if self.audio_hash is None:
+            return []
+        return [AnalysisArtifact(audio_hash=self.audio_hash, audiofile_directory=self.audiofile_directory, name=name, variant=variant)]
+
 class CsvConvertibleBase(BaseModel):
     def to_csv(self, save_path: Path, target_property_names: List[str] = None):
         """自身のインスタンスが持つプロパティをCSVに変換して保存します。
@@ -101,6 +151,20 @@ class JsonLoadableBase(CsvConvertibleBase):
         with open(save_path, 'w') as f:
             f.write(json_data)
     
+AUDIOFILE_METADATA_FILE_NAME = 'metadata.json'
+
+class AudiofileMetadata(JsonLoadableBase):
+    # アップロードされたファイルのハッシュ
+    sha256: str
+    normalization: NormalizationStatus = 'done'
+    # 正規化したwavのヘッダーから取得した音声の情報
+    audio: Optional[AudioInfo] = None
+
+class AudiofileStatusResponse(BaseModel):
+    audiofile_id: str
+    normalization: NormalizationStatus
+    audio: Optional[AudioInfo] = None
+
 class Chord(BaseModel):
     time: float
     duration: float
@@ -122,6 +186,28 @@ class Segment(BaseModel):
 
 TStructure = TypeVar('T', bound='Structure')
 
+BeatSubdivision = Literal['quarter', 'eighth', 'sixteenth', 'triplet']
+
+# ビートの分割方法毎の、1ビートあたりの分割数
+BEAT_SUBDIVISIONS: dict[str, int] = {
+    'quarter': 1,
+    'eighth': 2,
+    'sixteenth': 4,
+    'triplet': 3,
+}
+
+def _round_half_even(values: np.ndarray, ndigits: int) -> np.ndarray:
+    """Pythonのround()と同じ結果になるように、配列をまとめて丸める。
+
+    np.roundは値を10**ndigits倍した時点で誤差が生じ、round()と結果が異なる場合があるため、
+    仮数部が十分に長いlongdoubleで誤差なく10**ndigits倍してから偶数丸めする。
+    longdoubleの精度が足りない環境ではround()を使う。
+    """
+    scale = 10 ** ndigits
+    if np.finfo(np.longdouble).nmant < np.finfo(np.float64).nmant + scale.bit_length():
+        return np.vectorize(lambda value: round(value, ndigits), otypes=[np.float64])(values)
+    return np.rint(values.astype(np.longdouble) * scale).astype(np.float64) / scale
+
 class Structure(JsonLoadableBase):
     bpm: int
     beats: List[float]
@@ -135,23 +221,68 @@ class Structure(JsonLoadableBase):
 
         return bpm
     
+    def subdivide(self: TStructure, subdivision: BeatSubdivision) -> TStructure:
+        """各ビートの間を等分したビートを追加した音楽構造を返す。
+
+        全ビート間の分割を配列演算でまとめて行う。追加したビートの時間は小数点以下2桁に丸める。
+
+        Args:
+            subdivision (BeatSubdivision): ビートの分割方法。
+
+        Returns:
+            TStructure: ビートとビートの位置を分割した音楽構造。
+        """
+        divisions = BEAT_SUBDIVISIONS[subdivision]
+        if divisions == 1 or len(self.beats) < 2:
+            return self.model_copy(deep=True)
+
+        beats = np.asarray(self.beats, dtype=np.float64)
+        beat_positions = np.asarray(self.beat_positions, dtype=np.float64)
+        fractions = np.arange(divisions) / divisions
+
+        # (ビートの数 - 1, 分割数)の格子。先頭の列は元のビート
+        subdivided_beats = beats[:-1, np.newaxis] + np.diff(beats)[:, np.newaxis] * fractions
+        subdivided_beats[:, 1:] = _round_half_even(subdivided_beats[:, 1:], 2)
+        subdivided_beat_positions = beat_positions[:-1, np.newaxis] + fractions
+
+        # 最後のビートも追加
+        subdivided_beats = np.append(subdivided_beats.ravel(), beats[-1])
+        subdivided_beat_positions = np.append(subdivided_beat_positions.ravel(), beat_positions[-1])
+        # 整数の位置は元と同じくintで返す
+        beat_position_list = [
+            int(position) if position.is_integer() else position for position in subdivided_beat_positions.tolist()
+        ]
+
+        return Structure(
+            bpm=self.bpm,
+            beats=subdivided_beats.tolist(),
+            downbeats=self.downbeats,
+            beat_positions=beat_position_list,
+            segments=self.segments
+        )
+
     def convert_splited_beats_into_eighths(self: TStructure) -> TStructure:
-        eighth_beats = []
-        eighth_beat_positions = []
-        beats = self.beats
-        beat_positions = self.beat_positions
-        for i in range(len(beats) - 1):
-            beat_start = beats[i]
-            beat_end = beats[i + 1]
-            # 4分音符の開始ビート
-            eighth_beats.append(beat_start)
-            eighth_beat_positions.append(beat_positions[i])
-            # その4分音符の中点を追加（8分音符に相当）
-            eighth_beats.append(round(beat_start + (beat_end - beat_start) / 2, 2))
-            eighth_beat_positions.append(beat_positions[i] + 0.5)
-    
-        # 最後の4分音符のビートも追加
-        eighth_beats.append(beats[-1])
-        eighth_beat_positions.append(beat_positions[-1])
-    
-        return Structure(bpm=self.bpm, beats=eighth_beats, downbeats=self.downbeats, beat_positions=eighth_beat_positions, segments=self.segments)
\ No newline at end of file
+        return self.subdivide('eighth')
+
+    @classmethod
+    def load_subdivided_from_json_file(cls, json_path: Path, subdivision: Optional[BeatSubdivision]) -> 'Structure':
+        """音楽構造のJSONファイルを読み取り、ビートを分割した結果を返す。
+
+        結果はファイルのパスと更新時刻、分割方法毎に保持し、同じ組み合わせでは読み取りと分割を省く。
+        保持しているインスタンスをそのまま返すため、呼び出し元では変更しないこと(変更する場合はmodel_copy(deep=True)したものを使う)。
+
+        Args:
+            json_path (Path): 音楽構造のJSONファイルのパス。
+            subdivision (Optional[BeatSubdivision]): ビートの分割方法。Noneの場合は分割しない。
+
+        Raises:
+            FileNotFoundError: JSONファイルが存在しない。
+
+        Returns:
+            Structure: 音楽構造。他のリクエストと共有する読み取り専用のインスタンス。
+        """
+        return _load_subdivided_structure(str(json_path), os.stat(json_path).st_mtime_ns, subdivision or 'quarter')
+
+@lru_cache(maxsize=256)
+def _load_subdivided_structure(json_path: str, mtime_ns: int, subdivision: BeatSubdivision) -> Structure:
+    return Structure.load_from_json_file(Path(json_path)).subdivide(subdivision)
\ No newline at end of file
@@ -10,9 +10,12 @@
     closest_beat_time(time, beat_times, average_beat_interval):
         指定された時間に最も近いビートの時間を見つけます。
 
-    adjust_chord_timing(beat_times, chords):
+    adjust_chord_time(beat_times, chords):
         コードのタイミングを最も近いビートに合わせて調整します。
 
+    adjust_chord_times(songs):
+        複数の曲のコードのタイミングをまとめて調整します。
+
 使用例:
     ビートに合わせてコードのタイミングを調整する例:
 
@@ -40,7 +43,9 @@
     この結果は、各コードの開始時刻が最も近いビートに調整され、各コードの持続時間が次のコードの開始時刻またはビートまでの時間で計算されたことを示しています。
 """
 
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
+
+import numpy as np
 
 from app.models import AdjustedChord, AdjustedChordList, ChordList
 
@@ -99,40 +104,140 @@ def closest_beat_time(
     return closest_time, True
 
 
+def _first_non_increasing_indices(beats: np.ndarray) -> np.ndarray:
+    """各インデックスk以降で、最初にbeats[j+1] <= beats[j]となるjを求めます。
+
+    ビートの時間が重複している場合、closest_beat_timeの走査はそこで打ち切られるため、その位置を事前に求めておきます。
+    該当がない場合はlen(beats)-1とします。
+
+    Args:
+        beats (np.ndarray): ビートの時間。
+
+    Returns:
+        np.ndarray: 長さlen(beats)の配列。
+    """
+    n = len(beats)
+    stop = np.full(n, n - 1, dtype=np.intp)
+    if n > 1:
+        positions = np.where(beats[1:] <= beats[:-1], np.arange(n - 1), n - 1)
+        # 後ろから累積最小値を取ることで、各k以降で最初の位置を求める
+        stop[:-1] = np.minimum.accumulate(positions[::-1])[::-1]
+    return stop
+
+def _closest_beat_indices(
+        times: np.ndarray,
+        beats: np.ndarray,
+        starts: np.ndarray,
+        first_non_increasing: np.ndarray
+) -> np.ndarray:
+    """beats[starts:]に対してclosest_beat_timeと同じ走査をした場合に、走査が止まるインデックスを求めます。
+
+    Args:
+        times (np.ndarray): ビートと比較したい時間。
+        beats (np.ndarray): ビートの時間。昇順にソートされている必要があります。
+        starts (np.ndarray): 走査を開始するインデックス。len(beats)未満である必要があります。
+        first_non_increasing (np.ndarray): _first_non_increasing_indicesの結果。
+
+    Returns:
+        np.ndarray: 走査が止まったビートのインデックス。
+    """
+    n = len(beats)
+    # beats[insert - 1] < time <= beats[insert]
+    insert = np.maximum(np.searchsorted(beats, times, side='left'), starts)
+    # 指定の時間より前のビートは時間が近づく一方なので、重複したビートでしか止まらない
+    stopped_early = first_non_increasing[starts] < insert - 1
+    previous = np.maximum(insert - 1, starts)
+    following = np.minimum(insert, n - 1)
+    # 指定の時間を挟む2つのビートのうち、近い方(同じ場合は前の方)で止まる
+    stop_previous = (insert == n) | (np.abs(beats[following] - times) >= np.abs(beats[previous] - times))
+    indices = np.where(stop_previous, previous, following)
+    indices = np.where(insert <= starts, starts, indices)
+    return np.where(stopped_early, first_non_increasing[starts], indices)
+
+def _snap_to_beats(
+        times: np.ndarray,
+        beats: np.ndarray,
+        starts: np.ndarray,
+        first_non_increasing: np.ndarray,
+        average_beat_interval: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """closest_beat_timeをbeats[starts:]に対してまとめて適用します。
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 調整後の時間と、調整されたかどうかを示すフラグ。
+    """
+    n = len(beats)
+    has_remaining = starts < n
+    safe_starts = np.minimum(starts, n - 1)
+    indices = _closest_beat_indices(times, beats, safe_starts, first_non_increasing)
+    # 最後のビートまで走査した場合は誤差を確認しない
+    too_far = (indices < n - 1) & (np.abs(beats[indices] - times) > average_beat_interval)
+    was_adjusted = has_remaining & ~too_far
+    return np.where(was_adjusted, beats[indices], times), was_adjusted
+
 def adjust_chord_time(
         beat_times: List[float], 
         chords: ChordList
 ) -> AdjustedChordList:
     """コードのタイミングを最も近いビートに合わせて調整します。
 
+    各コードは、それまでのコードの調整後の時間より後のビートにのみ合わせます。
+    次のコードの開始時刻は次のコード自身の調整後の時間と一致するため、全コードの調整後の時間を
+    二分探索でまとめて求めた後、前のコードより後のビートという制約を満たさない位置からのみ順に求め直します。
+
     Args:
-        beat_times (List[float]): ビートの時間のリスト。
+        beat_times (List[float]): ビートの時間のリスト。昇順にソートされている必要があります。
         chords (ChordList): コードの時間、持続時間、コード名を含むChordクラスのリスト。
 
     Returns:
         AdjustedChordList: 調整されたコードのタイミングと持続時間、コード名に加えて
         調整されたかどうかを示すブール値を含むAdjustedChordのリストを格納したAdjustedChordListを返します。
     """
-    adjusted_chords = []
-    remaining_beats = beat_times.copy() # 残りのビート
-
     # ビートの平均間隔を計算
     average_beat_interval = calculate_average_beat_interval(beat_times)
+    if not chords.chords:
+        return AdjustedChordList(chords=[])
 
-    for i, chord in enumerate(chords.chords):
-        
-        # コードの開始時刻を最も近いビートに合わせる
-        adjusted_time, was_adjusted = closest_beat_time(chord.time, remaining_beats, average_beat_interval)
+    beats = np.asarray(beat_times, dtype=np.float64)
+    times = np.array([chord.time for chord in chords.chords], dtype=np.float64)
+    first_non_increasing = _first_non_increasing_indices(beats)
 
-        # adjusted_time以下のビートをすべて削除
-        remaining_beats = [beat for beat in remaining_beats if beat > adjusted_time]
-        
+    # 制約を無視して、全コードを先頭のビートから探した場合の調整後の時間
+    adjusted_times, was_adjusted = _snap_to_beats(
+        times, beats, np.zeros(len(times), dtype=np.intp), first_non_increasing, average_beat_interval
+    )
+    # 各コードで探索を始めるビート(それまでのコードの調整後の時間以下のビートは除く)
+    starts = np.zeros(len(times), dtype=np.intp)
+    starts[1:] = np.searchsorted(beats, np.maximum.accumulate(adjusted_times)[:-1], side='right')
+    # 先頭から探した結果が探索開始位置以降にあれば、制約を考慮しても結果は変わらない
+    indices = _closest_beat_indices(times, beats, np.zeros(len(times), dtype=np.intp), first_non_increasing)
+    violations = np.flatnonzero((starts >= len(beats)) | (indices < starts))
+    if len(violations) > 0:
+        # 制約を満たさない最初のコード以降は、それまでのコードの結果を使って順に求め直す
+        first_violation = violations[0]
+        latest_time = adjusted_times[:first_violation].max() if first_violation > 0 else None
+        for i in range(first_violation, len(times)):
+            start = 0 if latest_time is None else np.searchsorted(beats, latest_time, side='right')
+            time, adjusted = _snap_to_beats(
+                times[i:i + 1], beats, np.array([start], dtype=np.intp), first_non_increasing, average_beat_interval
+            )
+            adjusted_times[i] = time[0]
+            was_adjusted[i] = adjusted[0]
+            latest_time = time[0] if latest_time is None else max(latest_time, time[0])
+
+    adjusted_time_list = adjusted_times.tolist()
+    was_adjusted_list = was_adjusted.tolist()
+    latest_adjusted_time = max(adjusted_time_list)
+    adjusted_chords = []
+    for i, chord in enumerate(chords.chords):
+        adjusted_time = adjusted_time_list[i]
         if i < len(chords.chords) - 1:
-            # 次のコードの開始時刻を探す
-            next_time, _ = closest_beat_time(chords.chords[i + 1].time, remaining_beats, average_beat_interval)
+            # 次のコードの開始時刻
+            next_time = adjusted_time_list[i + 1]
         else:
             # 最後のコードの場合
-            if not remaining_beats:
+            if max(beat_times) <= latest_adjusted_time:
+                # 残りのビートがない
                 next_time = chord.time + chord.duration
             else:
                 next_time = max(beat_times)
@@ -144,7 +249,17 @@ def adjust_chord_time(
             time = adjusted_time,
             duration = adjusted_duration,
             value = chord.value,
-            was_adjusted = was_adjusted
+            was_adjusted = was_adjusted_list[i]
         ))
     return AdjustedChordList(chords=adjusted_chords)
 
+def adjust_chord_times(songs: Iterable[Tuple[List[float], ChordList]]) -> List[AdjustedChordList]:
+    """複数の曲のコードのタイミングをまとめて調整します。
+
+    Args:
+        songs (Iterable[Tuple[List[float], ChordList]]): 曲毎のビートの時間のリストとコードのリストの組。
+
+    Returns:
+        List[AdjustedChordList]: 曲毎の調整結果。
+    """
+    return [adjust_chord_time(beat_times, chords) for beat_times, chords in songs]
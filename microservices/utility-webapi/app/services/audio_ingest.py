@@ -0,0 +1,103 @@
+"""アップロードされた音声をwavに正規化するモジュール。
+
+変換はRQのワーカーで実行されるジョブで行うため、Webプロセスが再起動しても失われません。
+ffmpegのプロセスで変換し、音声をPythonのメモリにデコードしません。
+変換ジョブが失われて'pending'のまま残った場合(ワーカーの異常終了等)は、'failed'として記録します。
+"""
+import os
+import time
+from pathlib import Path
+from typing import Optional
+import shortuuid
+from redis import Redis
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from app.core.config import settings
+from app.models import AUDIOFILE_METADATA_FILE_NAME, Audiofile, AudiofileMetadata, NormalizationStatus
+from app.services.audio_probe import probe_audio
+from app.services.transcode import transcode_audio
+
+# 変換ジョブが完了していないことを示す状態
+PENDING_JOB_STATUSES = (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED, JobStatus.STARTED)
+
+# メタデータを保存してから変換ジョブを記録するまでの猶予(秒)。この間はジョブが見つからなくても変換中とみなす
+ENQUEUE_GRACE_SECONDS = 30
+
+def _job_key(audiofile_directory: Path) -> str:
+    return f'normalize_job:{audiofile_directory}'
+
+def save_audiofile_metadata(metadata: AudiofileMetadata, audiofile_dir: Path):
+    # 読み込み中のリクエストに書きかけの状態が見えないよう、一時ファイルからリネームする
+    tmp = audiofile_dir / f'.{AUDIOFILE_METADATA_FILE_NAME}.{shortuuid.uuid()}.tmp'
+    metadata.save_as_json_file(tmp)
+    os.replace(tmp, audiofile_dir / AUDIOFILE_METADATA_FILE_NAME)
+
+def normalize_audiofile(audiofile_path: str, wav_audiofile_path: str):
+    """アップロードされた音声をwavに変換し、メタデータに音声の情報と状態を記録する。ワーカーで実行するジョブ。
+
+    Raises:
+        TranscodeError: ffmpegが失敗した(app.services.transcode)。メタデータには'failed'を記録した上で送出し、ジョブを失敗とする。
+    """
+    audiofile_path = Path(audiofile_path)
+    wav_audiofile_path = Path(wav_audiofile_path)
+    audiofile_dir = wav_audiofile_path.parent
+    error = None
+    audio = None
+    try:
+        transcode_audio(audiofile_path, wav_audiofile_path)
+        audio = probe_audio(wav_audiofile_path)
+    except Exception as e:
+        print(f'音声の正規化に失敗しました:{audiofile_path}, {e}')
+        error = e
+    try:
+        metadata = AudiofileMetadata.load_from_json_file(audiofile_dir / AUDIOFILE_METADATA_FILE_NAME)
+    except FileNotFoundError:
+        # 正規化中に削除された場合は記録しない
+        return
+    metadata.audio = audio
+    metadata.normalization = 'failed' if error is not None else 'done'
+    save_audiofile_metadata(metadata, audiofile_dir)
+    if error is not None:
+        raise error
+
+def record_normalize_job(redis_conn: Redis, audiofile_directory: Path, jobs: list[Job]):
+    """キューに入れた変換ジョブのIDを、状態の確認に使えるように記録する。"""
+    for job in jobs:
+        if job.meta.get('job_name') == settings.NORMALIZE_JOB_NAME:
+            redis_conn.set(_job_key(audiofile_directory), job.get_id(), ex=86400)
+
+def _fetch_normalize_job(redis_conn: Redis, audiofile_directory: Path) -> Optional[Job]:
+    job_id = redis_conn.get(_job_key(audiofile_directory))
+    if job_id is None:
+        return None
+    try:
+        return Job.fetch(job_id.decode(), redis_conn)
+    except NoSuchJobError:
+        return None
+
+def resolve_normalization_status(redis_conn: Redis, audiofile: Audiofile) -> NormalizationStatus:
+    """正規化の状態を返す。
+
+    'pending'なのに変換ジョブが見つからない、または変換ジョブが終了している場合は、
+    変換ジョブが失われたとみなして'failed'を記録する。
+    """
+    if audiofile.normalization != 'pending':
+        return audiofile.normalization
+    job = _fetch_normalize_job(redis_conn, audiofile.audiofile_directory)
+    if job is not None and job.get_status() in PENDING_JOB_STATUSES:
+        return 'pending'
+    metadata_path = audiofile.audiofile_directory / AUDIOFILE_METADATA_FILE_NAME
+    try:
+        if job is None and time.time() - metadata_path.stat().st_mtime < ENQUEUE_GRACE_SECONDS:
+            # アップロード直後で、変換ジョブの記録がまだ済んでいない
+            return 'pending'
+        # 変換ジョブが直前に完了した場合に備えて読み直す
+        metadata = AudiofileMetadata.load_from_json_file(metadata_path)
+    except FileNotFoundError:
+        return audiofile.normalization
+    if metadata.normalization != 'pending':
+        return metadata.normalization
+    print(f'音声の正規化ジョブが失われました:{audiofile.audiofile_directory}')
+    metadata.normalization = 'failed'
+    save_audiofile_metadata(metadata, audiofile.audiofile_directory)
+    return 'failed'
@@ -0,0 +1,88 @@
+"""音声ファイルの長さやサンプルレートを、デコードせずにヘッダーから取得するモジュール。
+
+soundfileで読めるフォーマット(WAV、FLAC、OGG等)はヘッダーを読み、読めない場合はffprobeで取得します。
+アップロード時に取得した結果はオーディオファイルのメタデータに記録し、以降はそれを使います。
+"""
+import json
+import subprocess
+from pathlib import Path
+from typing import Optional
+import soundfile
+from app.models import AUDIOFILE_METADATA_FILE_NAME, Audiofile, AudiofileMetadata, AudioInfo
+
+class AudioProbeError(Exception):
+    pass
+
+def _probe_with_soundfile(audio_path: Path) -> AudioInfo:
+    info = soundfile.info(audio_path)
+    return AudioInfo(
+        duration=info.frames / info.samplerate,
+        sample_rate=info.samplerate,
+        channels=info.channels,
+        frames=info.frames
+    )
+
+def _probe_with_ffprobe(audio_path: Path) -> AudioInfo:
+    result = subprocess.run(
+        [
+            'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+            '-show_entries', 'stream=sample_rate,channels,duration:format=duration',
+            '-of', 'json', str(audio_path)
+        ],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise AudioProbeError(f'ffprobeで音声の情報を取得できませんでした:{audio_path}, {result.stderr.strip()}')
+    try:
+        probe = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        raise AudioProbeError(f'ffprobeの出力を解釈できませんでした:{audio_path}')
+    if not probe.get('streams'):
+        raise AudioProbeError(f'音声ストリームが見つかりませんでした:{audio_path}')
+    stream = probe['streams'][0]
+    try:
+        # ストリームに長さがないコンテナ(webm等)はフォーマットの長さを使う
+        duration = float(stream.get('duration') or probe.get('format', {}).get('duration'))
+        sample_rate = int(stream['sample_rate'])
+        channels = int(stream['channels'])
+    except (KeyError, TypeError, ValueError):
+        # 長さやサンプルレートがない、または'N/A'等の数値でない値
+        raise AudioProbeError(f'ffprobeで音声の長さ、サンプルレート、チャンネル数を取得できませんでした:{audio_path}, {stream}')
+    return AudioInfo(
+        duration=duration,
+        sample_rate=sample_rate,
+        channels=channels,
+        frames=round(duration * sample_rate)
+    )
+
+def probe_audio(audio_path: Path) -> AudioInfo:
+    """音声ファイルの長さ、サンプルレート、チャンネル数、フレーム数を取得する。
+
+    Raises:
+        AudioProbeError: 音声の情報を取得できない。
+    """
+    try:
+        return _probe_with_soundfile(audio_path)
+    except soundfile.LibsndfileError:
+        return _probe_with_ffprobe(audio_path)
+
+def get_audio_info(audiofile: Audiofile) -> Optional[AudioInfo]:
+    """オーディオファイルの音声の情報を返す。
+
+    メタデータに記録されていない(情報の記録前にアップロードされた)場合は取得してメタデータに追記する。
+    取得できない場合はNoneを返す。
+    """
+    if audiofile.audio_info is not None:
+        return audiofile.audio_info
+    try:
+        audio_info = probe_audio(audiofile.audiofile_path)
+    except (AudioProbeError, OSError, ValueError) as e:
+        print(f'音声の情報を取得できませんでした:{e}')
+        return None
+    metadata_path = audiofile.audiofile_directory / AUDIOFILE_METADATA_FILE_NAME
+    if metadata_path.exists():
+        metadata = AudiofileMetadata.load_from_json_file(metadata_path)
+        metadata.audio = audio_info
+        metadata.save_as_json_file(metadata_path)
+    return audio_info
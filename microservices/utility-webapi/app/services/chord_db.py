@@ -1,7 +1,9 @@
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+import numpy as np
 from pychord import Chord as pychord, utils as pychord_utils
 
 # Cremaが出力したコード名のキーをコードDBで扱える形式に変換
@@ -104,132 +106,269 @@ REVERSAL_SUFFIX_TO_NORMAL_SUFFIX_MAP = {
     "sus2": "sus2",
 }
 
+# 分数コードの/の右側(最低音の度数)から、第n転回形への変換表
+CHORD_REVERSALS_MAP = {
+    "maj": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    },
+    "min": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    },
+    "dim": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    },
+    "dim7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "aug": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    },
+    "7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "hdim7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "min7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "maj7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "minmaj7": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+    },
+    "maj6": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        6: 3,   # 第三転回形: 6番目の音が最も低い
+    },
+    "min6": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        6: 3,   # 第三転回形: 6番目の音が最も低い
+    },
+    "9": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+        9: 4,   # 第四転回形: 9番目の音が最も低い
+    },
+    "maj9": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+        9: 4,   # 第四転回形: 9番目の音が最も低い
+    },
+    "min9": {
+        3: 1,   # 第一転回形: 3番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+        7: 3,   # 第三転回形: 7番目の音が最も低い
+        9: 4,   # 第四転回形: 9番目の音が最も低い
+    },
+    "sus4": {
+        4: 1,   # 第一転回形: 4番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    },
+    "sus2": {
+        2: 1,   # 第一転回形: 2番目の音が最も低い
+        5: 2,   # 第二転回形: 5番目の音が最も低い
+    }
+}
+
 GUITAR_CHORD_DB_JSON_PATH = Path(os.path.dirname(__file__), '..', 'assets', 'chords.json')
+# chords.jsonをプリコンパイルした配列。初回ロード時に生成し、以降はメモリマップして読み込む
+GUITAR_CHORD_DB_NPY_PATH = Path(os.path.dirname(__file__), '..', 'assets', 'chords.npy')
+
+STRING_COUNT = 6
+NO_POSITION = -1 # 弦を弾かない('x')
+
+STANDARTD_TUNING_OPEN_STRINGS_NOTE = {
+    6: 40,
+    5: 45,
+    4: 50,
+    3: 55,
+    2: 59,
+    1: 64,
+}
+# positionsの並び(6弦から1弦)に対応する開放弦のノート
+OPEN_STRINGS_NOTES = np.array([STANDARTD_TUNING_OPEN_STRINGS_NOTE[6 - index] for index in range(STRING_COUNT)], dtype=np.int16)
+
+def _guitar_chord_table_dtype(key_length: int) -> np.dtype:
+    return np.dtype([
+        ('key', f'U{key_length}'),
+        ('positions', 'i1', (STRING_COUNT,)),
+        ('fingerings', 'i1', (STRING_COUNT,)),
+        ('has_info', '?'), # chords.jsonで情報がnullのコードはFalse
+    ])
+
+def build_guitar_chord_table(json_path: Path = GUITAR_CHORD_DB_JSON_PATH, npy_path: Path = GUITAR_CHORD_DB_NPY_PATH):
+    """chords.jsonを、キーでソートされた固定長の構造化配列に変換して保存する。
+
+    各コードの先頭の情報のみを保持する(chords.jsonの各コードの情報は1つ、運指も1つのみ)。
+    複数のプロセスが同時に生成しても壊れないよう、一時ファイルに書き込んでからリネームする。
+
+    Args:
+        json_path (Path, optional): chords.jsonのパス。
+        npy_path (Path, optional): 保存先のパス。
+    """
+    with open(json_path, "r", encoding="utf-8") as file:
+        raw_data = json.load(file)
+
+    keys = sorted(raw_data)
+    table = np.zeros(len(keys), dtype=_guitar_chord_table_dtype(max(len(key) for key in keys)))
+    table['key'] = keys
+    for index, key in enumerate(keys):
+        chord_info = raw_data[key][0] if raw_data[key] else None
+        if chord_info is None:
+            continue
+        if len(chord_info['fingerings']) != 1:
+            raise ValueError(f'運指が1つではないコードは変換できません:{key}')
+        table['positions'][index] = [NO_POSITION if position == 'x' else int(position) for position in chord_info['positions']]
+        table['fingerings'][index] = [int(finger) for finger in chord_info['fingerings'][0]]
+        table['has_info'][index] = True
+
+    tmp_path = npy_path.with_name(f'.{npy_path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmp_path, npy_path)
+
+class GuitarChordTable:
+    """プリコンパイルしたコードDBを引くクラス。"""
+
+    def __init__(self, table: np.ndarray):
+        """
+        Args:
+            table (np.ndarray): build_guitar_chord_tableで生成した構造化配列。
+        """
+        self.table = table
+        self.keys = table['key']
+
+    def find_index(self, chord_name: str) -> Optional[int]:
+        """コード名に対応する行を二分探索する。該当なし、または情報がnullの場合はNoneを返す。"""
+        index = int(np.searchsorted(self.keys, chord_name))
+        if index >= len(self.keys) or self.keys[index] != chord_name or not self.table['has_info'][index]:
+            return None
+        return index
+
+    def positions(self, index: int) -> np.ndarray:
+        return self.table['positions'][index]
+
+    def chord_info(self, index: int) -> dict:
+        """chords.jsonと同じ形式のコード情報を返す。"""
+        return {
+            'positions': ['x' if position == NO_POSITION else str(position) for position in self.table['positions'][index].tolist()],
+            'fingerings': [[str(finger) for finger in self.table['fingerings'][index].tolist()]]
+        }
+
+_guitar_chord_table = None
+def load_guitar_chord_table() -> GuitarChordTable:
+    """プロセス内で共有するコードDBを取得する。
+
+    プリコンパイルした配列がないか、chords.jsonより古い場合は生成し直す。
+    配列はメモリマップで読み込むため、同じファイルを読み込むプロセス間でページが共有される。
+    """
+    global _guitar_chord_table
+    if _guitar_chord_table is None:
+        if (not GUITAR_CHORD_DB_NPY_PATH.exists()
+                or GUITAR_CHORD_DB_NPY_PATH.stat().st_mtime < GUITAR_CHORD_DB_JSON_PATH.stat().st_mtime):
+            build_guitar_chord_table()
+        _guitar_chord_table = GuitarChordTable(np.load(GUITAR_CHORD_DB_NPY_PATH, mmap_mode='r'))
+    return _guitar_chord_table
+
+# 分数コードの変換やDBの検索をコード名毎に一度だけ行うため、結果を保持する
+# Cremaが出力するコード名は、ルート(12) x サフィックス(17) x 転回形・臨時記号の組み合わせに限られる
+CHORD_NAME_CACHE_SIZE = 4096
+
+def _convert_to_correct_reversal(key: str, suffix: str) -> str:
+    base_suffix, root_interval = suffix.split('/') # maj/3だったら maj, 3
+    # pychordが認識できるsuffixに変換
+    pychord_base_suffix = SHORTHAND_TO_PYCHORD_SUFFIX_MAP[base_suffix]
+
+    if 'b' in root_interval or '#' in root_interval:
+        # 分数コードの右側にbや#が含まれる場合
+        accidentals = None
+        if 'b' in root_interval:
+            accidentals = 'b'
+        elif '#' in root_interval:
+            accidentals = '#'
+        replaced_root_interval = root_interval.replace(accidentals, '')
+
+        reversal = CHORD_REVERSALS_MAP[base_suffix][int(replaced_root_interval)]
+        c = pychord(key + pychord_base_suffix + '/' + str(reversal))
+        if accidentals == '#':
+            root_note = pychord_utils.transpose_note(c.components()[0], 1)
+        elif accidentals == 'b':
+            root_note = pychord_utils.transpose_note(c.components()[0], -1)
+    else:
+        # 第n転回形形式に変換
+        reversal = CHORD_REVERSALS_MAP[base_suffix][int(root_interval)]
+        c = pychord(key + pychord_base_suffix + '/' + str(reversal))
+
+        # ルート音
+        root_note = c.components()[0]
+
+    # suffixを上書き
+    suffix = REVERSAL_SUFFIX_MAP[base_suffix] + '/' + root_note
+    return suffix
+
+@lru_cache(maxsize=CHORD_NAME_CACHE_SIZE)
+def convert_shorthand_to_chords_json_format(chord_name: str) -> str:
+    """Cremaが出力するコード名の形式を'chords.json'の形式に変換
+
+    Args:
+        chord_name (str): Cremaが出力したコード名
+
+    Returns:
+        str: 'chords.json'のキーとして扱えるコード名
+    """
+    if chord_name in ('N', 'X'):
+        return chord_name
+
+    key_suffix = chord_name.split(':')
+    key = key_suffix[0]
+    suffix = key_suffix[1]
+
+    if "/" in suffix:
+        # 分数コードであれば第n転回形式に変換
+        suffix = _convert_to_correct_reversal(key, suffix)
+    else:
+        suffix = SHORTHAND_TO_SUFFIX_MAP[suffix]
+    key = SHORTHAND_TO_KEY_MAP[key]
+    return key + suffix
+
+@lru_cache(maxsize=CHORD_NAME_CACHE_SIZE)
+def _get_midi_notes(shorthand_chord_name: str) -> tuple[int, ...]:
+    converted_chord_name = convert_shorthand_to_chords_json_format(shorthand_chord_name)
+    chord_table = load_guitar_chord_table()
+    index = chord_table.find_index(converted_chord_name)
+    if index is None:
+        return (60,)
+    positions = chord_table.positions(index)
+    played = positions != NO_POSITION
+    return tuple((OPEN_STRINGS_NOTES[played] + positions[played]).tolist())
 
 class GuitarData:
     def __init__(self):
-        # JSONファイルを開いてロード
-        with open(GUITAR_CHORD_DB_JSON_PATH, "r", encoding="utf-8") as file:
-            raw_data = json.load(file)
-
-        self.chord_index = raw_data
-
-    def _convert_to_correct_reversal(self, key: str, suffix: str) -> str:
-        CHORD_REVERSALS_MAP = {
-            "maj": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            },
-            "min": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            },
-            "dim": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            },
-            "dim7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "aug": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            },
-            "7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "hdim7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "min7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "maj7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "minmaj7": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-            },
-            "maj6": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                6: 3,   # 第三転回形: 6番目の音が最も低い
-            },
-            "min6": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                6: 3,   # 第三転回形: 6番目の音が最も低い
-            },
-            "9": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-                9: 4,   # 第四転回形: 9番目の音が最も低い
-            },
-            "maj9": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-                9: 4,   # 第四転回形: 9番目の音が最も低い
-            },
-            "min9": {
-                3: 1,   # 第一転回形: 3番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-                7: 3,   # 第三転回形: 7番目の音が最も低い
-                9: 4,   # 第四転回形: 9番目の音が最も低い
-            },
-            "sus4": {
-                4: 1,   # 第一転回形: 4番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            },
-            "sus2": {
-                2: 1,   # 第一転回形: 2番目の音が最も低い
-                5: 2,   # 第二転回形: 5番目の音が最も低い
-            }
-        }
-        base_suffix, root_interval = suffix.split('/') # maj/3だったら maj, 3
-        # pychordが認識できるsuffixに変換
-        pychord_base_suffix = SHORTHAND_TO_PYCHORD_SUFFIX_MAP[base_suffix]
-
-        if 'b' in root_interval or '#' in root_interval:
-            # 分数コードの右側にbや#が含まれる場合
-            accidentals = None
-            if 'b' in root_interval:
-                accidentals = 'b'
-            elif '#' in root_interval:
-                accidentals = '#'
-            replaced_root_interval = root_interval.replace(accidentals, '')
-            
-            reversal = CHORD_REVERSALS_MAP[base_suffix][int(replaced_root_interval)]
-            c = pychord(key + pychord_base_suffix + '/' + str(reversal))
-            if accidentals == '#':
-                root_note = pychord_utils.transpose_note(c.components()[0], 1)
-            elif accidentals == 'b':
-                root_note = pychord_utils.transpose_note(c.components()[0], -1)
-        else:
-            # 第n転回形形式に変換
-            reversal = CHORD_REVERSALS_MAP[base_suffix][int(root_interval)]
-            c = pychord(key + pychord_base_suffix + '/' + str(reversal))
-
-            # ルート音
-            root_note = c.components()[0]
-
-        # suffixを上書き
-        suffix = REVERSAL_SUFFIX_MAP[base_suffix] + '/' + root_note
-        return suffix
-    
+        # プロセス内で共有するコードDBを参照する
+        self.chord_table = load_guitar_chord_table()
+
     def convert_shorthand_to_chords_json_format(self, chord_name: str) -> str:
         """Cremaが出力するコード名の形式を'chords.json'の形式に変換
 
@@ -239,29 +378,15 @@ class GuitarData:
         Returns:
             str: 'chords.json'のキーとして扱えるコード名
         """
-        if chord_name in ('N', 'X'):
-            return chord_name
-        
-        key_suffix = chord_name.split(':')
-        key = key_suffix[0]
-        suffix = key_suffix[1]
-    
-        if "/" in suffix:
-            # 分数コードであれば第n転回形式に変換
-         
-            suffix = self._convert_to_correct_reversal(key, suffix)
-        else:
-            suffix = SHORTHAND_TO_SUFFIX_MAP[suffix]
-        key = SHORTHAND_TO_KEY_MAP[key]
-        return key + suffix
+        return convert_shorthand_to_chords_json_format(chord_name)
 
     def get_chord_info(self, chord_name) -> any:
-        try:
-            # 該当するコードの先頭の情報を返す
-            return self.chord_index[chord_name][0]
-        except (KeyError, IndexError):
+        index = self.chord_table.find_index(chord_name)
+        if index is None:
             # 該当なしの場合はNone を返す
             return None
+        # 該当するコードの先頭の情報を返す
+        return self.chord_table.chord_info(index)
         
     def get_midi_notes(self, shorthand_chord_name: str) -> List[int]:
         """Cremaの出力結果のコード名からmidiのノートを取得
@@ -272,21 +397,5 @@ class GuitarData:
         Returns:
             List[int]: midiノート
         """
-        STANDARTD_TUNING_OPEN_STRINGS_NOTE = {
-            6: 40,
-            5: 45,
-            4: 50,
-            3: 55,
-            2: 59,
-            1: 64,
-        }
-        converted_chord_name = self.convert_shorthand_to_chords_json_format(shorthand_chord_name)
-        chord_info = self.get_chord_info(converted_chord_name)
-        midi_notes = []
-        if chord_info is None:
-            return [60]
-        else:
-            for index, position in enumerate(chord_info['positions']):
-                if position != 'x':
-                    midi_notes.append(STANDARTD_TUNING_OPEN_STRINGS_NOTE[6 - index] + int(position))
-            return midi_notes
\ No newline at end of file
+        # キャッシュを書き換えられないよう、コピーを返す
+        return list(_get_midi_notes(shorthand_chord_name))
\ No newline at end of file
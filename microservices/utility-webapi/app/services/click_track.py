@@ -0,0 +1,76 @@
+"""音楽構造の解析結果(ビート、ダウンビート)からクリック音を生成するモジュール。
+
+クリック音1つ分の波形(カーネル)を一度だけ計算し、各ビートのサンプル位置に足し合わせて生成します。
+テンポの倍率を指定すると、ビートの時間を倍率で割った位置にクリック音を置きます(2倍なら2倍速の練習用)。
+"""
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import soundfile
+from app.models import Structure
+
+CLICK_SAMPLE_RATE = 44100
+CLICK_DURATION = 0.1
+
+# ダウンビートとの差がこの秒数以下のビートは、ダウンビートのクリック音のみ鳴らす
+DOWNBEAT_TOLERANCE = 0.03
+
+# 形式毎のsoundfileの書き出しオプション
+SOUNDFILE_OPTIONS = {
+    'wav': {'format': 'WAV', 'subtype': 'PCM_16'},
+    'mp3': {'format': 'MP3', 'subtype': 'MPEG_LAYER_III'},
+    'ogg': {'format': 'OGG', 'subtype': 'VORBIS'},
+}
+
+@lru_cache(maxsize=16)
+def get_click_kernel(click_freq: float, sample_rate: int = CLICK_SAMPLE_RATE, click_duration: float = CLICK_DURATION) -> np.ndarray:
+    """指数的に減衰する正弦波のクリック音1つ分の波形。librosa.clicksと同じ波形。"""
+    decay = np.logspace(0, -10, num=int(round(sample_rate * click_duration)), base=2.0)
+    kernel = decay * np.sin(2 * np.pi * click_freq / sample_rate * np.arange(len(decay)))
+    kernel = kernel.astype(np.float32)
+    kernel.flags.writeable = False
+    return kernel
+
+def _place_kernel(signal: np.ndarray, times: np.ndarray, kernel: np.ndarray, sample_rate: int):
+    """signalのtimes(秒)の位置にkernelを足し合わせる。信号の外にはみ出す部分は捨てる。"""
+    offsets = (times * sample_rate).astype(np.int64)
+    offsets = offsets[(offsets >= 0) & (offsets < len(signal))]
+    indices = offsets[:, np.newaxis] + np.arange(len(kernel))
+    mask = indices < len(signal)
+    # クリック音が重なる場合も正しく足し合わせる
+    np.add.at(signal, indices[mask], np.broadcast_to(kernel, indices.shape)[mask])
+
+def render_click_track(
+        structure: Structure,
+        length: int,
+        tempo_factor: float = 1.0,
+        beat_click_freq: float = 1500,
+        downbeat_click_freq: float = 3000,
+        sample_rate: int = CLICK_SAMPLE_RATE
+) -> np.ndarray:
+    """ビートとダウンビートのクリック音を1つの信号として生成する。
+
+    Args:
+        structure (Structure): 音楽構造の解析結果。
+        length (int): 生成する信号のサンプル数。
+        tempo_factor (float, optional): テンポの倍率。
+        beat_click_freq (float, optional): ビートのクリック音の周波数。
+        downbeat_click_freq (float, optional): ダウンビートのクリック音の周波数。
+        sample_rate (int, optional): サンプルレート。
+
+    Returns:
+        np.ndarray: [-1, 1]に収めたfloat32の信号。
+    """
+    downbeats = np.asarray(structure.downbeats, dtype=np.float64)
+    beats = np.asarray(structure.beats, dtype=np.float64)
+    if len(downbeats) and len(beats):
+        beats = beats[np.abs(downbeats[:, np.newaxis] - beats).min(axis=0) > DOWNBEAT_TOLERANCE]
+
+    signal = np.zeros(length, dtype=np.float32)
+    _place_kernel(signal, beats / tempo_factor, get_click_kernel(beat_click_freq, sample_rate), sample_rate)
+    _place_kernel(signal, downbeats / tempo_factor, get_click_kernel(downbeat_click_freq, sample_rate), sample_rate)
+    return np.clip(signal, -1.0, 1.0, out=signal)
+
+def save_click_track(signal: np.ndarray, save_path: Path, sample_rate: int = CLICK_SAMPLE_RATE):
+    """クリック音を保存先の拡張子の形式で保存する。"""
+    soundfile.write(save_path, signal, sample_rate, **SOUNDFILE_OPTIONS[save_path.suffix.lstrip('.')])
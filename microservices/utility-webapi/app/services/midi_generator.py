@@ -1,16 +1,22 @@
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+import queue
+import threading
+from typing import List, Optional
 import mido
 from mido import Message, MetaMessage, MidiFile, MidiTrack, second2tick
-from app.models import Chord
+import numpy as np
+import soundfile
+from app.core.config import settings
+from app.models import AudioInfo, Chord
 from app.services.chord_db import GuitarData
-from midi2audio import FluidSynth
-from pydub import AudioSegment
-import subprocess
 
 TICKS_PER_BEAT = 480
 
-def convert_chords_to_midi(chords: List[Chord], bpm: float, program: int, save_path: Path):
+# 長さの指定がない場合に、MIDIの終わりに加える余韻の秒数
+RELEASE_TAIL_SECONDS = 2.0
+
+def convert_chords_to_midi(chords: List[Chord], bpm: float, program: int, save_path: Optional[Path] = None) -> MidiFile:
     guitar_data = GuitarData()
     mid = MidiFile()
     track = MidiTrack()
@@ -63,65 +69,138 @@ def convert_chords_to_midi(chords: List[Chord], bpm: float, program: int, save_p
             else:
                 track.append(Message('note_off', note=note, velocity=100, time=0))
     
-    mid.save(save_path)
-
-# オーバライド
-__all__ = ['FluidSynth']
+    if save_path is not None:
+        mid.save(save_path)
+    return mid
 
-DEFAULT_SOUND_FONT = '~/.fluidsynth/default_sound_font.sf2'
-DEFAULT_SAMPLE_RATE = 44100
-DEFAULT_GAIN = 0.2
+class MidiSynthPool:
+    """サウンドフォントを読み込んだシンセサイザーを常駐させ、MIDIを音声のサンプルにレンダリングする。
 
-class CustomFluidSynth(FluidSynth):
-    def __init__(self, sound_font=DEFAULT_SOUND_FONT, sample_rate=DEFAULT_SAMPLE_RATE, gain=DEFAULT_GAIN):
-        # FluidSynthのコンストラクタを呼び出して、基本的な初期化
-        super().__init__(sound_font, sample_rate)
-        # gainパラメータを追加
+    シンセサイザーはワーカー数だけ作成し、レンダリング毎に1つを借りて使う。
+    全て使用中の場合は返却されるまで待つため、同時にレンダリングする数はワーカー数までとなる。
+    """
+    def __init__(self, sound_font: str, sample_rate: int, gain: float, workers: int):
+        self.sound_font = sound_font
+        self.sample_rate = sample_rate
         self.gain = gain
+        self.workers = workers
+        self._idle_synths: queue.LifoQueue = queue.LifoQueue()
+        self._created_synths = 0
+        self._lock = threading.Lock()
 
-    def midi_to_audio(self, midi_file: str, audio_file: str, verbose=True):
-        # 標準出力を抑制するオプション
-        if verbose:
-            stdout = None
-        else:
-            stdout = subprocess.DEVNULL
-        
-        # FluidSynthコマンドに-gオプションで音量調整を追加
-        subprocess.call(
-            ['fluidsynth', '-ni', '-g', str(self.gain), self.sound_font, midi_file, '-F', audio_file, '-r', str(self.sample_rate)], 
-            stdout=stdout
-        )
+    def _create_synth(self):
+        # libfluidsynthはOSのパッケージのため、シンセサイザーの作成時に読み込む
+        import fluidsynth
+        synth = fluidsynth.Synth(gain=self.gain, samplerate=float(self.sample_rate))
+        if synth.sfload(self.sound_font) == -1:
+            synth.delete()
+            raise FileNotFoundError(f'サウンドフォントを読み込めませんでした:{self.sound_font}')
+        return synth
+
+    def preload(self):
+        """全てのワーカーのシンセサイザーを作成し、サウンドフォントを読み込んでおく。"""
+        while True:
+            with self._lock:
+                if self._created_synths >= self.workers:
+                    return
+                self._created_synths += 1
+            try:
+                self._idle_synths.put(self._create_synth())
+            except Exception:
+                with self._lock:
+                    self._created_synths -= 1
+                raise
+
+    @contextmanager
+    def _acquire(self):
+        synth = None
+        try:
+            synth = self._idle_synths.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created_synths < self.workers
+                if can_create:
+                    self._created_synths += 1
+            if can_create:
+                try:
+                    synth = self._create_synth()
+                except Exception:
+                    with self._lock:
+                        self._created_synths -= 1
+                    raise
+            else:
+                synth = self._idle_synths.get()
+        try:
+            yield synth
+        finally:
+            # 前回のレンダリングの発音やコントロールチェンジを引き継がない
+            synth.system_reset()
+            self._idle_synths.put(synth)
 
-    def play_midi(self, midi_file):
-        # MIDI再生時に音量調整を追加
-        subprocess.call(
-            ['fluidsynth', '-i', '-g', str(self.gain), self.sound_font, midi_file, '-r', str(self.sample_rate)]
+    def render(self, midi: MidiFile, num_frames: Optional[int] = None) -> np.ndarray:
+        """MIDIをレンダリングし、ステレオのサンプル(フレーム数, 2)をint16で返す。
+
+        Args:
+            midi (MidiFile): レンダリングするMIDI。
+            num_frames (Optional[int]): 出力するフレーム数。MIDIより短い場合は切り詰め、長い場合は続けてレンダリングする(発音の余韻、無音)。
+                Noneの場合はMIDIの長さに余韻としてRELEASE_TAIL_SECONDSを加えた長さ。
+        """
+        if num_frames is None:
+            num_frames = round((midi.length + RELEASE_TAIL_SECONDS) * self.sample_rate)
+        samples = np.zeros(num_frames * 2, dtype=np.int16)
+        with self._acquire() as synth:
+            rendered_frames = 0
+            elapsed = 0.0
+
+            def render_until(frame: int):
+                nonlocal rendered_frames
+                frame = min(frame, num_frames)
+                if frame > rendered_frames:
+                    samples[rendered_frames * 2:frame * 2] = synth.get_samples(frame - rendered_frames)
+                    rendered_frames = frame
+
+            # MidiFileを走査すると、テンポを反映した秒単位の時間でメッセージが返る
+            for message in midi:
+                elapsed += message.time
+                render_until(round(elapsed * self.sample_rate))
+                if rendered_frames >= num_frames:
+                    break
+                if message.type == 'note_on':
+                    synth.noteon(message.channel, message.note, message.velocity)
+                elif message.type == 'note_off':
+                    synth.noteoff(message.channel, message.note)
+                elif message.type == 'program_change':
+                    synth.program_change(message.channel, message.program)
+                elif message.type == 'control_change':
+                    synth.cc(message.channel, message.control, message.value)
+                elif message.type == 'pitchwheel':
+                    synth.pitch_bend(message.channel, message.pitch)
+            render_until(num_frames)
+        return samples.reshape(-1, 2)
+
+_midi_synth_pool = None
+def get_midi_synth_pool() -> MidiSynthPool:
+    global _midi_synth_pool
+    if _midi_synth_pool is None:
+        _midi_synth_pool = MidiSynthPool(
+            sound_font=settings.MIDI_SOUND_FONT_PATH,
+            sample_rate=settings.MIDI_SYNTH_SAMPLE_RATE,
+            gain=settings.MIDI_SYNTH_GAIN,
+            workers=settings.MIDI_SYNTH_WORKERS
         )
+    return _midi_synth_pool
 
-def match_audio_length(source_audio_path, target_audio_path, output_path):
-    # 音声ファイルを読み込む
-    source_audio = AudioSegment.from_file(source_audio_path)
-    target_audio = AudioSegment.from_file(target_audio_path)
-    
-    # 音声の長さを取得（ミリ秒単位）
-    source_length = len(source_audio)
-    target_length = len(target_audio)
-    
-    # 目標の長さに合わせるため、無音を追加
-    if source_length < target_length:
-        # 足りない時間を無音で補う
-        silence_duration = target_length - source_length
-        silence = AudioSegment.silent(duration=silence_duration)
-        # 無音を後ろに追加
-        adjusted_audio = source_audio + silence
-    else:
-        # 長さが長い場合はカット
-        adjusted_audio = source_audio[:target_length]
-    
-    # 出力ファイルに保存
-    adjusted_audio.export(output_path, format="ogg")
-   
-def convert_midi_to_audio(midi_file_path: Path, save_path: Path):
-    fs = CustomFluidSynth(sound_font='/usr/share/sounds/sf2/FluidR3_GM.sf2', sample_rate=44100, gain=1)
-    fs.midi_to_audio(midi_file_path, save_path)
-            
\ No newline at end of file
+def render_midi_to_audio(midi: MidiFile, save_path: Path, target_audio_info: Optional[AudioInfo] = None):
+    """MIDIを常駐するシンセサイザーでレンダリングし、oggとして保存する。
+
+    Args:
+        midi (MidiFile): レンダリングするMIDI。
+        save_path (Path): 保存先。
+        target_audio_info (Optional[AudioInfo]): 指定した場合、出力する音声をこの音声の長さに合わせる(無音で補う、またはカット)。
+    """
+    synth_pool = get_midi_synth_pool()
+    num_frames = None
+    if target_audio_info is not None:
+        num_frames = target_audio_info.frames_at(synth_pool.sample_rate)
+    samples = synth_pool.render(midi, num_frames)
+    soundfile.write(save_path, samples, synth_pool.sample_rate, format='OGG', subtype='VORBIS')
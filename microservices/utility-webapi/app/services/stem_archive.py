@@ -0,0 +1,111 @@
+"""分離したステムをまとめたZIPを、先頭から順に生成して配信するモジュール。
+
+mp3は既に圧縮されているため、エントリは無圧縮(STORED)で格納します。
+エントリの内容はZIPに追加する時点でファイルとして揃っているため、CRCとサイズを
+ローカルファイルヘッダーに書くことができ、シークせずにZIPを生成できます。
+生成したZIPはレスポンスとして送りながらキャッシュファイルにも書き込みます。
+"""
+import asyncio
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections.abc import AsyncGenerator
+from pathlib import Path
+import anyio
+import shortuuid
+from redis import Redis
+from app.services.stem_transcode import STEMS, ensure_transcoded_stem
+
+ARCHIVE_FORMAT = 'mp3'
+READ_CHUNK_SIZE = 1024 * 1024
+
+def _crc32(path: Path) -> int:
+    crc = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+class StoredZipStream:
+    """無圧縮のZIPのバイト列を先頭から順に生成する。ZIP64には対応しない。"""
+    def __init__(self):
+        self._entries: list[tuple[zipfile.ZipInfo, int]] = []
+        self._offset = 0
+
+    def _advance(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def local_header(self, arcname: str, crc: int, size: int, mtime: float) -> bytes:
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(mtime)[:6])
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.CRC = crc
+        zinfo.compress_size = zinfo.file_size = size
+        if self._offset + size >= zipfile.ZIP64_LIMIT:
+            raise ValueError('ZIP64が必要なサイズには対応していません')
+        self._entries.append((zinfo, self._offset))
+        # 後続のデータ分もオフセットを進めておく
+        header = self._advance(zinfo.FileHeader(zip64=False))
+        self._offset += size
+        return header
+
+    def central_directory(self) -> bytes:
+        start = self._offset
+        records = []
+        for zinfo, header_offset in self._entries:
+            dt = zinfo.date_time
+            dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+            dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+            filename, flag_bits = zinfo._encodeFilenameFlags()
+            records.append(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                zinfo.create_version, zinfo.create_system, zinfo.extract_version, zinfo.reserved,
+                zinfo.flag_bits | flag_bits, zinfo.compress_type, dostime, dosdate,
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size,
+                len(filename), 0, 0, 0, zinfo.internal_attr, zinfo.external_attr, header_offset
+            ) + filename)
+        central_directory = b''.join(records)
+        end_record = struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, len(self._entries), len(self._entries), len(central_directory), start, 0
+        )
+        return self._advance(central_directory + end_record)
+
+async def stream_separated_zip(redis_conn: Redis, audiofile_directory: Path, cache_path: Path) -> AsyncGenerator[bytes, None]:
+    """全てのステムをmp3にしたZIPを生成しながら返し、最後まで生成できたらcache_pathに保存する。
+
+    変換済みでないステムは並行して変換し、変換が終わった順にZIPに追加する。
+    変換ジョブの完了はイベントループ上で待ち、その場で変換する場合は専用のスレッドプール(get_transcode_executor)を使う。
+    """
+    tasks = [
+        asyncio.create_task(ensure_transcoded_stem(redis_conn, audiofile_directory, stem, ARCHIVE_FORMAT))
+        for stem in STEMS
+    ]
+    zip_stream = StoredZipStream()
+    tmp = cache_path.with_name(f'.{cache_path.name}.{shortuuid.uuid()}.tmp')
+    completed = False
+    try:
+        async with await anyio.open_file(tmp, 'wb') as cache_file:
+            for task in asyncio.as_completed(tasks):
+                stem_path: Path = await task
+                crc = await asyncio.to_thread(_crc32, stem_path)
+                stat = stem_path.stat()
+                header = zip_stream.local_header(stem_path.name, crc, stat.st_size, stat.st_mtime)
+                await cache_file.write(header)
+                yield header
+                async with await anyio.open_file(stem_path, 'rb') as stem_file:
+                    while chunk := await stem_file.read(READ_CHUNK_SIZE):
+                        await cache_file.write(chunk)
+                        yield chunk
+            central_directory = zip_stream.central_directory()
+            await cache_file.write(central_directory)
+            yield central_directory
+        os.replace(tmp, cache_path)
+        completed = True
+    finally:
+        if not completed:
+            # クライアントが切断した場合等。変換中のステムはキャッシュとして残るよう最後まで実行させる
+            tmp.unlink(missing_ok=True)
@@ -0,0 +1,124 @@
+"""音声の分離結果(ステム)を、ダウンロード用の形式に変換するモジュール。
+
+音声の分離後に実行されるジョブで、全てのステムを設定された形式に並行して変換し、
+separated_{形式}/ に保存します。全てのステムの変換が完了すると、完了を示すファイルを作成します。
+ステムのダウンロードは変換済みのファイルを返すだけとなり、変換中の場合はイベントループ上でジョブの完了を待ちます。
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from redis import Redis
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from app.core.config import settings
+from app.services.transcode import transcode_audio
+
+STEMS = ['vocals', 'drums', 'bass', 'guitar', 'piano', 'other_6s']
+
+COMPLETE_MARKER_FILE_NAME = '.complete'
+
+# 変換ジョブが完了していないことを示す状態
+PENDING_JOB_STATUSES = (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED, JobStatus.STARTED)
+
+def get_transcoded_stem_directory(audiofile_directory: Path, format: str) -> Path:
+    return audiofile_directory / f'separated_{format}'
+
+def _job_key(audiofile_directory: Path) -> str:
+    return f'stem_transcode_job:{audiofile_directory}'
+
+def transcode_stems(audiofile_directory: str, formats: list[str]):
+    """全てのステムをformatsの各形式に変換する。変換済みのステムは変換しない。
+
+    ffmpegのプロセスを並行して実行するため、CPUの複数のコアで変換される。
+    """
+    audiofile_directory = Path(audiofile_directory)
+    separated_path = audiofile_directory / 'separated'
+    tasks = []
+    for format in formats:
+        get_transcoded_stem_directory(audiofile_directory, format).mkdir(exist_ok=True)
+        for stem in STEMS:
+            dst = get_transcoded_stem_directory(audiofile_directory, format) / f'{stem}.{format}'
+            if not dst.exists():
+                tasks.append((separated_path / f'{stem}.wav', dst))
+
+    with ThreadPoolExecutor(max_workers=settings.STEM_TRANSCODE_WORKERS or os.cpu_count()) as executor:
+        # 1つでも失敗した場合は例外を送出し、ジョブを失敗とする
+        for _ in executor.map(lambda task: transcode_audio(*task), tasks):
+            pass
+
+    for format in formats:
+        (get_transcoded_stem_directory(audiofile_directory, format) / COMPLETE_MARKER_FILE_NAME).touch()
+
+_transcode_executor = None
+def get_transcode_executor() -> ThreadPoolExecutor:
+    """リクエストの処理中にffmpegで変換する場合に使うスレッドプールを返す。
+
+    同時に実行するffmpegの数をSTEM_TRANSCODE_WORKERSで制限し、既定のスレッドプールを占有しないようにする。
+    """
+    global _transcode_executor
+    if _transcode_executor is None:
+        _transcode_executor = ThreadPoolExecutor(
+            max_workers=settings.STEM_TRANSCODE_WORKERS or os.cpu_count(),
+            thread_name_prefix='stem_transcode'
+        )
+    return _transcode_executor
+
+def is_transcode_complete(audiofile_directory: Path, format: str) -> bool:
+    return (get_transcoded_stem_directory(audiofile_directory, format) / COMPLETE_MARKER_FILE_NAME).exists()
+
+def record_stem_transcode_job(redis_conn: Redis, audiofile_directory: Path, jobs: list[Job]):
+    """キューに入れたジョブのうち変換ジョブのIDを、ダウンロード時に完了を待てるように記録する。"""
+    for job in jobs:
+        if job.meta.get('job_name') == settings.STEM_TRANSCODE_JOB_NAME:
+            redis_conn.set(_job_key(audiofile_directory), job.get_id(), ex=86400)
+
+def _fetch_stem_transcode_job(redis_conn: Redis, audiofile_directory: Path) -> Optional[Job]:
+    job_id = redis_conn.get(_job_key(audiofile_directory))
+    if job_id is None:
+        return None
+    try:
+        return Job.fetch(job_id.decode(), redis_conn)
+    except NoSuchJobError:
+        return None
+
+def is_stem_transcode_pending(redis_conn: Redis, audiofile_directory: Path) -> bool:
+    """変換ジョブがキューにある、または実行中かどうか。"""
+    job = _fetch_stem_transcode_job(redis_conn, audiofile_directory)
+    return job is not None and job.get_status() in PENDING_JOB_STATUSES
+
+async def wait_for_transcoded_stem(redis_conn: Redis, audiofile_directory: Path, stem_path: Path) -> bool:
+    """変換中のステムが保存されるまで、最大でSTEM_TRANSCODE_WAIT_TIMEOUT秒待つ。
+
+    待っている間はスレッドを占有しないよう、イベントループ上で待つ。Redisへの同期的な問い合わせはスレッドで行う。
+
+    Returns:
+        bool: ステムが保存された場合はTrue。変換ジョブがない、失敗した、または時間切れの場合はFalse。
+    """
+    if stem_path.exists() or is_transcode_complete(audiofile_directory, stem_path.suffix.lstrip('.')):
+        return stem_path.exists()
+    job = await asyncio.to_thread(_fetch_stem_transcode_job, redis_conn, audiofile_directory)
+    if job is None:
+        return stem_path.exists()
+    deadline = time.monotonic() + settings.STEM_TRANSCODE_WAIT_TIMEOUT
+    while not stem_path.exists():
+        if await asyncio.to_thread(job.get_status) not in PENDING_JOB_STATUSES or time.monotonic() > deadline:
+            return stem_path.exists()
+        await asyncio.sleep(0.5)
+    return True
+
+async def ensure_transcoded_stem(redis_conn: Redis, audiofile_directory: Path, stem: str, format: str) -> Path:
+    """変換済みのステムのパスを返す。
+
+    変換ジョブが実行中であれば完了を待つ。変換ジョブがない(変換ジョブの導入前に分離した等)、
+    または失敗した場合はその場で変換する。
+    """
+    stem_path = get_transcoded_stem_directory(audiofile_directory, format) / f'{stem}.{format}'
+    if not await wait_for_transcoded_stem(redis_conn, audiofile_directory, stem_path):
+        stem_path.parent.mkdir(exist_ok=True)
+        await asyncio.get_running_loop().run_in_executor(
+            get_transcode_executor(), transcode_audio, audiofile_directory / 'separated' / f'{stem}.wav', stem_path
+        )
+    return stem_path
@@ -0,0 +1,90 @@
+"""ffmpegで音声ファイルの形式を変換するモジュール。
+
+変換結果はファイルに保存するほか、変換しながらクライアントに送ることもできます。
+いずれの場合も一時ファイルに書き出し、変換が完了してからリネームするため、
+書きかけのファイルがキャッシュとして使われることはありません。
+"""
+import asyncio
+import os
+import subprocess
+from collections.abc import AsyncGenerator
+from pathlib import Path
+import anyio
+import shortuuid
+
+# 形式毎のffmpegの出力オプション
+FFMPEG_OUTPUT_OPTIONS = {
+    'mp3': ['-f', 'mp3', '-acodec', 'libmp3lame'],
+    'ogg': ['-f', 'ogg', '-acodec', 'libvorbis'],
+    'wav': ['-f', 'wav', '-acodec', 'pcm_s16le'],
+}
+
+# 変換しながら送ることができる形式。wavはヘッダーにサイズを書くため、パイプへの出力では正しいファイルにならない
+STREAMABLE_FORMATS = ('mp3', 'ogg')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class TranscodeError(Exception):
+    pass
+
+def _tmp_path(dst: Path) -> Path:
+    return dst.with_name(f'.{dst.name}.{shortuuid.uuid()}.tmp')
+
+def transcode_audio(src: Path, dst: Path):
+    """srcをdstの拡張子の形式に変換して保存する。
+
+    Raises:
+        TranscodeError: ffmpegが失敗した。
+    """
+    format = dst.suffix.lstrip('.')
+    tmp = _tmp_path(dst)
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', str(src), '-vn', *FFMPEG_OUTPUT_OPTIONS[format], str(tmp)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        if result.returncode != 0:
+            raise TranscodeError(f'変換に失敗しました:{src}, {result.stderr.decode(errors="replace").strip()}')
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+async def stream_transcode_audio(src: Path, dst: Path) -> AsyncGenerator[bytes, None]:
+    """srcをdstの拡張子の形式に変換しながら、変換された順にバイト列を返す。
+
+    最後まで変換できた場合はdstに保存する。途中でクライアントが切断した場合はffmpegを止める。
+
+    Raises:
+        TranscodeError: ffmpegが失敗した。送信済みのレスポンスを正常に終わらせず、途切れたファイルとして扱わせるため送出する。
+    """
+    format = dst.suffix.lstrip('.')
+    if format not in STREAMABLE_FORMATS:
+        raise ValueError(f'{format}は変換しながら送ることができません')
+    tmp = _tmp_path(dst)
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', str(src), *FFMPEG_OUTPUT_OPTIONS[format], 'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # パイプが詰まらないよう、エラー出力は並行して読み込む
+    stderr_task = asyncio.create_task(process.stderr.read())
+    completed = False
+    try:
+        async with await anyio.open_file(tmp, 'wb') as cache_file:
+            while chunk := await process.stdout.read(STREAM_CHUNK_SIZE):
+                await cache_file.write(chunk)
+                yield chunk
+        if await process.wait() != 0:
+            stderr = (await stderr_task).decode(errors='replace').strip()
+            print(f'変換に失敗しました:{src}, {stderr}')
+            raise TranscodeError(f'ffmpegが終了コード{process.returncode}で終了しました:{stderr}')
+        os.replace(tmp, dst)
+        completed = True
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        if not completed:
+            tmp.unlink(missing_ok=True)
@@ -4,11 +4,11 @@
 import os
 import subprocess
 import sys
-from rq import Worker, Queue, Connection, command
+from rq import SimpleWorker, Worker, Queue, Connection, command
+from rq.job import Job
 from redis import Redis
 from app.core.config import settings
-
-r = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+from app.core.heavy_job import route_job
 
 root_dir = os.path.dirname(__file__)
 file_path = os.path.join(root_dir, 'worker.py')
@@ -24,22 +24,44 @@ def launch_workers(queue_name: str, worker_multiplicity: int):
     for _ in range(worker_multiplicity):
         subprocess.Popen(["python3", file_path, queue_name])
 
+# ワーカープロセス内で実行するジョブの関数
+IN_PROCESS_JOB_FUNC_NAMES = {f'{route_job.__module__}.{route_job.__qualname__}'}
+
+class DispatchWorker(SimpleWorker):
+    """宛先APIへのリクエスト(route_job)だけをワーカープロセス内で実行し、それ以外のジョブはフォークして実行するワーカー。
+
+    route_jobはリクエストを送って応答を待つだけのため、ワーカープロセス内で実行して
+    プロセス内のHTTPクライアント(dispatch_client)のコネクションをジョブ間で再利用する。
+    関数を実行するジョブ(LocalJob)は、異常終了がワーカーに及ばないようジョブ毎にフォークする。
+    """
+
+    def execute_job(self, job: Job, queue: Queue):
+        if job.func_name in IN_PROCESS_JOB_FUNC_NAMES:
+            super().execute_job(job, queue)
+        else:
+            Worker.execute_job(self, job, queue)
+
 def start_worker(queue_name: str):
     """ワーカーを起動
 
     Args:
         queue_name (str): キュー名
     """
+    # ワーカーは別プロセスで起動するため、専用のコネクションを使う
+    r = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
     with Connection(r):
         queue = Queue(queue_name)
-        worker = Worker([queue])
+        # SimpleWorker(RQ_SIMPLE_WORKERで有効化)は全てのジョブをワーカープロセス内で実行する
+        # 既定のDispatchWorkerは宛先APIへのリクエストのみワーカープロセス内で実行し、HTTPクライアントをジョブ間で使い回す
+        worker_class = SimpleWorker if settings.RQ_SIMPLE_WORKER else DispatchWorker
+        worker = worker_class([queue])
         worker.work()
 
 if __name__ == '__main__':
     queue_name = sys.argv[1]
     start_worker(queue_name)
 
-def kill_worker():
+def kill_worker(r: Redis):
     workers = Worker.all(r)
     print(f'workers: {workers}')
     for worker in workers:
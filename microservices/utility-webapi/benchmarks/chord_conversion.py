@@ -0,0 +1,62 @@
+"""Cremaのコード名からコードDB形式・MIDIノートへの変換を計測するベンチマーク。
+
+キャッシュが空の状態(1曲毎にpychordで分数コードを解析していた従来と同等)と、
+キャッシュ済みの状態で、1曲分のコード進行を変換する時間を比較する。
+
+実行方法(utility-webapiディレクトリで):
+    python -m benchmarks.chord_conversion
+"""
+import random
+import time
+from app.services.chord_db import (
+    CHORD_REVERSALS_MAP,
+    SHORTHAND_TO_KEY_MAP,
+    SHORTHAND_TO_SUFFIX_MAP,
+    GuitarData,
+    _get_midi_notes,
+    convert_shorthand_to_chords_json_format,
+)
+
+SONG_LENGTH = 300
+REPEAT = 20
+
+def generate_song(length: int, seed: int = 0) -> list[str]:
+    """Cremaが出力し得るコード名からランダムなコード進行を生成する。半分程度を分数コードにする。"""
+    rng = random.Random(seed)
+    keys = list(SHORTHAND_TO_KEY_MAP)
+    suffixes = list(SHORTHAND_TO_SUFFIX_MAP)
+    song = []
+    for _ in range(length):
+        key = rng.choice(keys)
+        suffix = rng.choice(suffixes)
+        if rng.random() < 0.5:
+            interval = rng.choice(list(CHORD_REVERSALS_MAP[suffix]))
+            accidental = rng.choice(['', '', 'b', '#'])
+            suffix = f'{suffix}/{accidental}{interval}'
+        song.append(f'{key}:{suffix}')
+    return song
+
+def convert_song(guitar_data: GuitarData, song: list[str]):
+    for chord_name in song:
+        guitar_data.convert_shorthand_to_chords_json_format(chord_name)
+        guitar_data.get_midi_notes(chord_name)
+
+def measure(song: list[str], clear_cache: bool) -> float:
+    guitar_data = GuitarData()
+    elapsed = 0.0
+    for _ in range(REPEAT):
+        if clear_cache:
+            convert_shorthand_to_chords_json_format.cache_clear()
+            _get_midi_notes.cache_clear()
+        start = time.perf_counter()
+        convert_song(guitar_data, song)
+        elapsed += time.perf_counter() - start
+    return elapsed / REPEAT
+
+if __name__ == '__main__':
+    song = generate_song(SONG_LENGTH)
+    # コードDBのロードを計測に含めない
+    GuitarData()
+    cold = measure(song, clear_cache=True)
+    warm = measure(song, clear_cache=False)
+    print(f'{SONG_LENGTH}コードの変換 キャッシュなし:{cold * 1000:.2f}ms, キャッシュあり:{warm * 1000:.2f}ms, {cold / warm:.1f}倍')